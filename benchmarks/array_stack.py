@@ -0,0 +1,50 @@
+"""
+Tuple stacks compared with array stacks
+
+Builds a deep stack both ways, and reports the memory it takes and the
+time to look at a value deep inside it.
+
+Usage: python benchmarks/array_stack.py [depth]
+"""
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gurklang.types import ArrayStack, Int  # noqa: E402
+from gurklang.vm_utils import peek, repr_stack  # noqa: E402
+
+
+def tuple_stack(values):
+    stack = None
+    for value in values:
+        stack = (value, stack)
+    return stack
+
+
+def measure(build, values):
+    tracemalloc.start()
+    stack = build(values)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(100):
+        peek(stack, len(values) - 1)
+        repr_stack(stack)
+    elapsed = (time.perf_counter() - start) / 100
+    return size, elapsed
+
+
+def main(depth: int):
+    values = [Int(i) for i in range(depth)]
+    print(f"{depth:,} values")
+    print(f"{'':8}{'KB':>10}{'peek+list ms':>14}")
+    for name, build in (("tuples", tuple_stack), ("array", ArrayStack.from_values)):
+        size, elapsed = measure(build, values)
+        print(f"{name:8}{size / 1024:>10.1f}{elapsed * 1000:>14.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
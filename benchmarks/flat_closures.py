@@ -0,0 +1,57 @@
+"""
+Scopes made by a loop that passes lambdas to `if`
+
+Counts the scopes each engine creates, and times the loop.
+
+Usage: python benchmarks/flat_closures.py [iterations]
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gurklang import vm  # noqa: E402
+from gurklang.parser import parse  # noqa: E402
+from gurklang.types import Machine  # noqa: E402
+
+LOOP = """
+:math (- + *) import
+{ :n def
+  n 0 = { 0 } { n 2 * 1 + drop n 1 - loop } if !
+} :loop jar
+"""
+
+
+def count_scopes(program, engine: str) -> int:
+    made = 0
+    make_scope = Machine.make_scope
+
+    def counting(self, *args, **kwargs):
+        nonlocal made
+        made += 1
+        return make_scope(self, *args, **kwargs)
+
+    Machine.make_scope = counting  # type: ignore
+    try:
+        vm.run(program, engine=engine)
+    finally:
+        Machine.make_scope = make_scope  # type: ignore
+    return made
+
+
+def main(iterations: int):
+    program = parse(f"{LOOP} {iterations} loop")
+    print(f"{'engine':12}{'scopes':>10}{'seconds':>10}")
+    for engine in ("fast", "bytecode", "persistent"):
+        scopes = count_scopes(program, engine)
+        times = []
+        for _ in range(5):
+            start = time.perf_counter()
+            vm.run(program, engine=engine)
+            times.append(time.perf_counter() - start)
+        print(f"{engine:12}{scopes:>10,}{min(times):>10.3f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
@@ -0,0 +1,50 @@
+"""
+Superinstruction hit rates of the bytecode engine
+
+Runs the examples and the test suite with the bytecode engine and reports
+how many of the executed instructions were part of a superinstruction.
+
+Usage: python benchmarks/fusion_report.py [--no-tests]
+"""
+import os
+import sys
+from pathlib import Path
+
+os.environ["GURKLANG_ENGINE"] = "bytecode"
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from gurklang import bytecode, vm  # noqa: E402
+from gurklang.parser import parse  # noqa: E402
+
+
+def report(title: str, profile: bytecode.OpProfile):
+    print(f"== {title}")
+    print(profile.report())
+    print()
+
+
+def main(args):
+    total = bytecode.OpProfile()
+
+    for path in sorted((ROOT / "examples").glob("*.gurk")):
+        with bytecode.profiling() as profile:
+            vm.run(parse(path.read_text()))
+        report(path.name, profile)
+        total.ops.update(profile.ops)
+        total.instructions.update(profile.instructions)
+
+    if "--no-tests" not in args:
+        import pytest
+        with bytecode.profiling() as profile:
+            pytest.main(["-q", "-p", "no:cacheprovider", str(ROOT / "tests")])
+        report("test suite", profile)
+        total.ops.update(profile.ops)
+        total.instructions.update(profile.instructions)
+
+    report("total", total)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
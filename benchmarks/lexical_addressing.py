@@ -0,0 +1,49 @@
+"""
+Name lookups with and without lexical addresses
+
+Runs a loop that uses names defined a few scopes up, parsed by
+`parser.parse` and by `resolver.parse`, and times each engine.
+
+Usage: python benchmarks/lexical_addressing.py [iterations]
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gurklang import vm  # noqa: E402
+from gurklang.parser import parse  # noqa: E402
+from gurklang import resolver  # noqa: E402
+
+LOOP = """
+:math (- + *) import
+{ :step def :limit def
+  { :n def :acc def
+    n limit = { acc } { acc n + n step + loop } if !
+  } :loop jar
+  0 0 loop
+} :run jar
+"""
+
+
+def best_of(program, engine: str, repeat: int = 5) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        vm.run(program, engine=engine)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(iterations: int):
+    source = f"{LOOP} {iterations} 1 run"
+    programs = {"parse": parse(source), "resolve": resolver.parse(source)}
+    print(f"{'engine':12}" + "".join(f"{name:>10}" for name in programs))
+    for engine in ("fast", "bytecode", "persistent"):
+        times = [best_of(program, engine) for program in programs.values()]
+        print(f"{engine:12}" + "".join(f"{t:>10.3f}" for t in times))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
@@ -0,0 +1,54 @@
+"""
+Startup time of a big program with and without the program cache
+
+Parses a generated program with `optimizer.parse`, then loads it from a
+fresh on-disk cache with `program_cache.parse`.
+
+Usage: python benchmarks/program_cache.py [functions]
+"""
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gurklang import optimizer, program_cache  # noqa: E402
+
+
+def make_program(functions: int) -> str:
+    lines = [":math (+ - * <) import"]
+    for i in range(functions):
+        lines.append(f'{{ :n def n {i} < {{ n 2 * }} {{ n 1 - "f{i}" drop }} if ! }} :f{i} jar')
+    return "\n".join(lines)
+
+
+def best_of(fn, repeat: int = 5) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(functions: int):
+    source = make_program(functions)
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["GURKLANG_CACHE_DIR"] = directory
+        program_cache.parse(source)
+
+        def load():
+            program_cache._memory.clear()
+            program_cache.parse(source)
+
+        parse_time = best_of(lambda: optimizer.parse(source))
+        load_time = best_of(load)
+    print(f"{len(source):,} characters")
+    print(f"parse:      {parse_time:.3f}s")
+    print(f"cache hit:  {load_time:.3f}s")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2_000)
@@ -0,0 +1,74 @@
+"""
+Scope creation throughput across threads
+
+Compares the old allocator, a counter behind a global lock, with the
+per-thread id blocks of `vm.generate_scope_id`, first on bare id allocation
+and then on interpreters that create a scope for every call.
+
+Usage: python benchmarks/scope_ids.py [max-threads]
+"""
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gurklang import vm  # noqa: E402
+from gurklang.parser import parse  # noqa: E402
+
+IDS_PER_THREAD = 200_000
+CALLS_PER_THREAD = 2_000
+
+
+_lock = threading.Lock()
+_last_id = 0
+
+
+def locked_scope_id() -> int:
+    global _last_id
+    with _lock:
+        _last_id += 1
+    return _last_id
+
+
+def in_threads(n: int, target: Callable[[], None]) -> float:
+    threads = [threading.Thread(target=target) for _ in range(n)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def allocate(generate: Callable[[], int]):
+    def target():
+        for _ in range(IDS_PER_THREAD):
+            generate()
+    return target
+
+
+PROGRAM = parse("{ { 1 drop } ! } :f jar " + "f " * CALLS_PER_THREAD)
+
+
+def interpret():
+    vm.run(PROGRAM)
+
+
+def main(max_threads: int):
+    print(f"{'threads':>8}{'locked ids/s':>16}{'per-thread ids/s':>18}{'scopes/s':>12}")
+    n = 1
+    while n <= max_threads:
+        ids = n * IDS_PER_THREAD
+        locked = ids / in_threads(n, allocate(locked_scope_id))
+        per_thread = ids / in_threads(n, allocate(vm.generate_scope_id))
+        # Every call of `f` and of the inner function makes a scope
+        scopes = n * CALLS_PER_THREAD * 2 / in_threads(n, interpret)
+        print(f"{n:>8}{locked:>16,.0f}{per_thread:>18,.0f}{scopes:>12,.0f}")
+        n *= 2
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8)
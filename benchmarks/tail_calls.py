@@ -0,0 +1,54 @@
+"""
+Memory use of a long tail-recursive loop
+
+Runs a loop that calls itself in tail position through `case` for a
+growing number of iterations, and prints the peak resident memory after
+each run. With tail calls eliminated, the peak stays flat.
+
+Usage: python benchmarks/tail_calls.py [iterations] [engine]
+"""
+import resource
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gurklang import vm  # noqa: E402
+from gurklang.parser import parse  # noqa: E402
+
+LOOP = """
+:math (-) import
+{ { (0) { :done }
+    (n) { n 1 - loop }
+  } case
+} :loop jar
+"""
+
+
+def peak_rss_mb() -> float:
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main(iterations: int, engine: str):
+    print(f"{'iterations':>12}{'seconds':>10}{'peak MB':>10}")
+    n = 1000
+    while True:
+        n = min(n, iterations)
+        program = parse(f"{LOOP} {n} loop")
+        start = time.perf_counter()
+        state = vm.run(program, engine=engine)
+        elapsed = time.perf_counter() - start
+        assert state.stack is not None and state.stack[0].value == "done"  # type: ignore
+        print(f"{n:>12,}{elapsed:>10.2f}{peak_rss_mb():>10.1f}")
+        if n == iterations:
+            break
+        n *= 10
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000,
+        sys.argv[2] if len(sys.argv) > 2 else "bytecode",
+    )
@@ -0,0 +1,72 @@
+"""
+Memory per value and hamt throughput
+
+Reports the memory a value takes (including the values it holds), and how
+fast `immutables.Map`, which backs `ds.hamt`, inserts and looks up tuple
+keys.
+
+Usage: python benchmarks/values.py [count]
+"""
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from immutables import Map  # noqa: E402
+
+from gurklang.types import Atom, Box, Int, Str, Vec  # noqa: E402
+
+
+def bytes_per_value(make, count: int) -> float:
+    tracemalloc.start()
+    values = [make(i) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del values
+    return size / count
+
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def hamt_throughput(count: int):
+    keys = [Vec((Atom("point"), Int(i % 100), Int(i // 100))) for i in range(count)]
+
+    def insert():
+        hamt = Map()
+        for key in keys:
+            hamt = hamt.set(key, key)
+        return hamt
+
+    hamt = insert()
+
+    def look_up():
+        for key in keys:
+            hamt[key]
+
+    return count / min(timed(insert) for _ in range(3)), count / min(timed(look_up) for _ in range(3))
+
+
+def main(count: int):
+    makers = {
+        "Int": lambda i: Int(i % 100),
+        "big Int": lambda i: Int(i + 10**6),
+        "Str": lambda i: Str(str(i % 100)),
+        "Vec": lambda i: Vec((Int(i % 100), Int(i % 7))),
+        "Box": lambda i: Box(i),
+    }
+    print(f"{'value':10}{'bytes':>8}")
+    for name, make in makers.items():
+        print(f"{name:10}{bytes_per_value(make, count):>8.1f}")
+    (inserts, lookups) = hamt_throughput(count)
+    print(f"hamt inserts/s: {inserts:12,.0f}")
+    print(f"hamt lookups/s: {lookups:12,.0f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,68 @@
+"""
+Fan-out of many tiny tasks
+
+Compares the old `run-concurrently`, which started a thread and a fresh
+interpreter for every function, with the worker pool it runs on now.
+
+Usage: python benchmarks/worker_pool.py [tasks] [workers]
+"""
+import sys
+import threading
+import time
+from pathlib import Path
+from queue import Queue
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gurklang import vm, worker_pool  # noqa: E402
+from gurklang.parser import parse  # noqa: E402
+from gurklang.types import Code, Int, State  # noqa: E402
+
+TASK = parse("1 swap drop")
+
+
+def run_in_threads(n: int):
+    results: Queue = Queue()
+
+    def target(i: int):
+        begin_state = State.make(vm.global_scope, vm.builtin_scope).with_stack((Int(i), None))
+        end_state = vm.call(begin_state, Code(TASK, None, name="task"))
+        results.put((i, end_state.stack))
+
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for _ in threads:
+        results.get()
+    for thread in threads:
+        thread.join()
+
+
+def run_in_pool(n: int):
+    pool = worker_pool.get_pool()
+    tasks = [pool.submit(TASK, "task", None, (Int(i), None)) for i in range(n)]
+    for task in tasks:
+        pool.wait(task)
+
+
+def timed(fn, n: int) -> float:
+    start = time.perf_counter()
+    fn(n)
+    return time.perf_counter() - start
+
+
+def main(n: int, workers: int):
+    worker_pool.set_pool_size(workers)
+    run_in_pool(n)  # warm up the workers
+    threads = min(timed(run_in_threads, n) for _ in range(3))
+    pool = min(timed(run_in_pool, n) for _ in range(3))
+    print(f"{n} tasks, {workers} workers")
+    print(f"thread per task: {threads * 1000:8.1f} ms")
+    print(f"worker pool:     {pool * 1000:8.1f} ms  ({threads / pool:.1f}x, {worker_pool.get_pool().steals} steals)")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else worker_pool.DEFAULT_SIZE,
+    )
@@ -1,5 +1,5 @@
 import sys
-from . import repl, vm, parser
+from . import optimizer, parser, program_cache, repl, vm
 
 args = sys.argv[1:]
 
@@ -7,22 +7,29 @@ if args == []:
     repl.repl()
 elif args == ["-i"]:
     source = sys.stdin.read()
-    parsed = parser.parse(source)
+    parsed = program_cache.parse(source)
     vm.run(parsed)
 elif args[0] == "-r":
     filename = args[1]
     with open(filename) as source_file:
         source = source_file.read()
     repl.run_and_open_repl(source)
+elif args[0] == "--counts":
+    for filename in args[1:]:
+        with open(filename) as source_file:
+            source = source_file.read()
+        before = optimizer.count_instructions(parser.parse(source))
+        after = optimizer.count_instructions(optimizer.parse(source))
+        print(f"{filename}: {before} -> {after} instructions")
 elif len(args) == 1:
     filename = args[0]
     with open(filename) as source_file:
         source = source_file.read()
-    parsed = parser.parse(source)
+    parsed = program_cache.parse(source)
     vm.run(parsed)
 elif args[0] == "-c":
     source = " ".join(args[1:])
-    parsed = parser.parse(source)
+    parsed = program_cache.parse(source)
     vm.run(parsed)
 else:
     print("Invalid arguments. Valid execution modes:")
@@ -31,3 +38,4 @@ else:
     print("gurklang -r path/to/file : run a program from file and open the REPL")
     print("gurklang -c 'program' : run a program specified in the arguments after `-c`")
     print("gurklang -i : run a program read from the standard input")
+    print("gurklang --counts path/to/file... : print instruction counts before and after constant folding")
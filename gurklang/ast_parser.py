@@ -2,7 +2,7 @@
 Alternative parser that produces an AST instead of a sequencence of instructions.
 """
 from __future__ import annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from types import SimpleNamespace
 from typing import Any, Callable, Iterator, List, Optional, Sequence, Tuple, Type, Union
 from ast import literal_eval
@@ -31,6 +31,8 @@ class VecLiteral:
 @dataclass(frozen=True)
 class CodeLiteral:
     nodes: List[ASTNode]
+    # Source code of the literal, like `parser.parse` keeps for `PutCode`
+    source_code: Optional[str] = field(default=None, compare=False, repr=False)
 
 
 ASTNode = Union[IntLiteral, AtomLiteral, StrLiteral, VecLiteral, NameCall, CodeLiteral]
@@ -42,11 +44,16 @@ def parse_as_ast(source: str) -> CodeLiteral:
     stream = parser.lex(source)
     stream.push(parser.Token("RIGHT_BRACE", ")", len(source)))
 
-    return _parse_code_literal(stream)
+    return _parse_code_literal(stream, source)
 
 
-def _parse_code_literal(stream: parser.Stream) -> CodeLiteral:
+def _parse_code_literal(
+    stream: parser.Stream,
+    source: Optional[str] = None,
+    start: Optional[int] = None,
+) -> CodeLiteral:
     nodes: List[ASTNode] = []
+    source_code = None
     for token in stream:
         if token.name == "LEFT_PAREN":
             nodes.append(_parse_vec(stream))
@@ -59,12 +66,14 @@ def _parse_code_literal(stream: parser.Stream) -> CodeLiteral:
         elif token.name == "NAME":
             nodes.append(NameCall(token.value))
         elif token.name == "LEFT_BRACE":
-            nodes.append(_parse_code_literal(stream))
+            nodes.append(_parse_code_literal(stream, source, token.position))
         elif token.name == "RIGHT_BRACE":
+            if source is not None and start is not None:
+                source_code = source[start:token.span[1]]
             break
         else:
             assert False
-    return CodeLiteral(nodes)
+    return CodeLiteral(nodes, source_code)
 
 
 def _parse_vec(stream: parser.Stream) -> VecLiteral:
@@ -0,0 +1,171 @@
+"""
+Running gurklang programs on an asyncio event loop
+
+A `Process` is an interpreter that can stop between any two instructions
+and continue later. Its execution state is the pipe of instructions and the
+`Machine`, so stopping it doesn't need any Python frames to be kept alive.
+The fast engine is a process that runs without stopping.
+
+`call_async` runs a process until it calls a native function that waits
+for I/O (see `NativeFunction.async_fn`), awaits that function and resumes
+the process. Programs running on one event loop take turns whenever one of
+them waits, so a single thread can serve many of them.
+"""
+from collections import deque
+from typing import Optional, Sequence, Union
+
+from . import vm
+from .types import Code, CodeFlags, Instruction, Machine, NativeFunction, State, Vec
+
+
+class Process:
+    """
+    An interpreter that runs in slices
+    """
+    def __init__(self, state: State, function: Union[Code, NativeFunction]):
+        self.machine = Machine(state)
+        self.pipe: "deque[Instruction]" = deque()
+        vm._load_function(self.pipe, function)
+        self.refcounts = vm.ScopeRefcounts(self.machine)
+        # A native function waiting to be awaited, its arguments are on the stack
+        self.waiting_for: Optional[NativeFunction] = None
+
+    @property
+    def done(self) -> bool:
+        return not self.pipe and self.waiting_for is None
+
+    def run(
+        self,
+        budget: Optional[int] = None,
+        suspend_on_io: bool = True,
+        middleware: "Optional[vm.MiddlewareT]" = None,
+    ) -> int:
+        """
+        Execute instructions until the process is done, `budget` instructions
+        have been executed, or it calls an asynchronous native function
+
+        In the last case, the function is stored in `waiting_for`. Return the
+        number of executed instructions.
+        """
+        machine = self.machine
+        pipe = self.pipe
+        refcounts = self.refcounts
+        introducer = refcounts.introduce
+        finalizer = refcounts.finalize
+        finalizers = refcounts.finalizers
+        collector = refcounts.collector
+        executed = 0
+
+        while pipe:
+            if executed == budget:
+                return executed
+            executed += 1
+            finalizers.advance()
+
+            instruction = pipe.pop()
+            old_stack = machine.stack
+            tag = instruction.tag
+
+            if tag == "put":
+                machine.stack = (instruction.value, machine.stack)
+
+            elif tag == "call" or tag == "call_by_value":
+                if tag == "call_by_value":
+                    (function, machine.stack) = machine.stack  # type: ignore
+                elif instruction.address is None:
+                    function = machine.look_up_name_in_current_scope(instruction.function_name)
+                else:
+                    function = machine.look_up_address(instruction.function_name, instruction.address)
+
+                if function.tag == "code":
+                    vm._load_function(pipe, function)
+                elif suspend_on_io and function.async_fn is not None:
+                    self.waiting_for = function
+                    return executed
+                elif function.stack_fn is not None:
+                    machine.stack = function.stack_fn(machine.stack)
+                else:
+                    try:
+                        refcounts.load(function.fn(machine.snapshot()))
+                    except:
+                        print(f"{function=}")
+                        raise
+
+            elif tag == "put_code":
+                scope_id = machine.scope_stack[0]  # type: ignore
+                machine.stack = (
+                    Code(
+                        instructions=instruction.instructions,
+                        closure=scope_id,
+                        source_code=instruction.source_code,
+                        flags=instruction.flags,
+                        introducer=refcounts.introducer_ref,
+                        finalizer=refcounts.finalizer_ref,
+                    ),
+                    machine.stack
+                )
+                introducer(scope_id)
+
+            elif tag == "make_vec":
+                stack = machine.stack
+                elements = []
+                for _ in range(instruction.size):
+                    head, stack = stack  # type: ignore
+                    elements.append(head)
+                machine.stack = (Vec(elements[::-1]), stack)
+
+            elif tag == "make_scope":
+                if instruction.flat:
+                    machine.enter_scope(instruction.parent_id)
+                    introducer(instruction.parent_id)
+                else:
+                    new_id = vm.generate_scope_id()
+                    machine.make_scope(instruction.parent_id, new_id, instruction.bindings)
+                    introducer(new_id)
+                    if collector.due():
+                        collector.collect(pipe)
+
+            elif tag == "pop_scope":
+                scope_id = machine.scope_stack[0]  # type: ignore
+                machine.pop_scope()
+                finalizer(scope_id)
+
+            else:
+                raise RuntimeError(instruction)
+
+            if middleware is not None:
+                middleware(instruction, old_stack, machine.stack)
+
+        finalizers.flush()
+        return executed
+
+    async def finish_waiting(self):
+        """
+        Await the function the process is waiting for
+        """
+        function = self.waiting_for
+        assert function is not None and function.async_fn is not None
+        self.machine.stack = await function.async_fn(self.machine.stack)
+        self.waiting_for = None
+
+    def result(self) -> State:
+        return self.machine.snapshot()
+
+
+async def call_async(state: State, function: Union[Code, NativeFunction]) -> State:
+    """
+    Call a function without blocking the event loop on I/O
+    """
+    process = Process(state, function)
+    while True:
+        process.run()
+        if process.waiting_for is None:
+            return process.result()
+        await process.finish_waiting()
+
+
+async def run_async(instructions: Sequence[Instruction]) -> State:
+    return await call_async(
+        State.make(vm.global_scope, vm.builtin_scope),
+        Code(instructions, closure=None, name="<entry-point>", flags=CodeFlags.PARENT_SCOPE),
+    )
@@ -4,10 +4,9 @@ Utilities for creating built-in modules
 
 from dataclasses import field, dataclass
 from immutables import Map
-from typing import Callable,  NoReturn, Optional, Sequence, TypeVar, Dict, Union
+from typing import Awaitable, Callable, NamedTuple, NoReturn, Optional, Sequence, Tuple, TypeVar, Dict, Union
 from . import vm_utils
-from . import parser
-from .types import Code, CodeFlags, Instruction, Scope, Stack, State, Value, NativeFunction, Vec
+from .types import ArrayStack, Code, CodeFlags, Instruction, Scope, Stack, State, Value, NativeFunction, Vec
 
 Z = TypeVar("Z", bound=Stack, contravariant=True)
 
@@ -37,9 +36,14 @@ class BuiltinModule:
     def add(self, member_name: str, value: Value):
         self.members[member_name] = value
 
-    def register_simple(self, name: Optional[str] = None):
+    def register_simple(
+        self,
+        name: Optional[str] = None,
+        effect: Optional[str] = None,
+        asynchronous: Optional[Callable[[Z, Fail], Awaitable[Stack]]] = None,
+    ):
         def inner(fn: Callable[[Z, Fail], Stack]) -> NativeFunction:
-            native_fn = make_simple(name)(fn)  # type: ignore
+            native_fn = make_simple(name, effect, asynchronous)(fn)  # type: ignore
             self.add(native_fn.name, native_fn)
             return native_fn
         return inner
@@ -69,14 +73,14 @@ class GurklangModule:
     source_code: str
 
     def make_scope(self, id: int):
-        from . import vm
+        from . import program_cache, vm
         state = (
             State
             .make(vm.global_scope, vm.builtin_scope)
             .make_scope(vm.global_scope.id, id, persistent=True)
         )
         fn = Code(
-            parser.parse(self.source_code),
+            program_cache.parse(self.source_code),
             closure=None,
             flags=CodeFlags.PARENT_SCOPE,
             name=f"<module-{self.name}>"
@@ -92,13 +96,90 @@ class GurklangModule:
 Module = Union[BuiltinModule, GurklangModule]
 
 
-def make_simple(name: Optional[str] = None):
+class StackEffect(NamedTuple):
+    """
+    Stack effect of a function, parsed from a comment like `x y:int -- y x`
+
+    Names are listed from the deepest value to the topmost one. An input
+    can require a type, like `y:int`. An output that has the name of an
+    input is that input, other outputs can declare their type.
+    """
+    inputs: Tuple[Tuple[str, Optional[str]], ...]
+    outputs: Tuple[Tuple[str, Optional[str]], ...]
+
+    @staticmethod
+    def parse(comment: str) -> "StackEffect":
+        def parse_side(side: str):
+            return tuple(
+                (name, tag or None)
+                for name, _, tag in (word.partition(":") for word in side.split())
+            )
+        inputs, arrow, outputs = comment.partition("--")
+        if not arrow:
+            raise ValueError(f"stack effect without `--`: {comment!r}")
+        return StackEffect(parse_side(inputs), parse_side(outputs))
+
+
+@dataclass(frozen=True)
+class Specialization:
+    """
+    A native function with a known stack effect
+
+    `direct` skips the error handling of the native function, so it can
+    only be called when the stack is known to hold the inputs described by
+    `effect`.
+    """
+    native: NativeFunction
+    effect: StackEffect
+    direct: Callable[[Stack], Stack]
+
+
+# Native functions with known stack effects by name. Only functions that
+# can't fail when the stack matches their inputs are registered here.
+specializations: Dict[str, Specialization] = {}
+
+
+def _cannot_fail(reason: str) -> NoReturn:
+    raise AssertionError(f"specialized function failed: {reason}")
+
+
+def make_simple(
+    name: Optional[str] = None,
+    effect: Optional[str] = None,
+    asynchronous: Optional[Callable[[Z, Fail], Awaitable[Stack]]] = None,
+):
+    """
+    Make a native function that only touches the stack
+
+    `effect` is the stack effect of the function, see `StackEffect`.
+    `asynchronous` is a version of the function that waits for I/O without
+    blocking, used by `async_vm`.
+    """
     def inner(fn: Callable[[Z, Fail], Stack]) -> NativeFunction:
-        def new_fn(state: State, fail: Fail):
-            stack = fn(state.stack, fail)
-            return state.with_stack(stack)
-        new_fn.__name__ = fn.__name__
-        return make_function(name)(new_fn)
+        fn_name = name or fn.__name__.replace("_", "-")
+        def stack_fn(stack: Stack):
+            local_fail: Fail = lambda reason: _fail(fn_name, reason, stack)
+            try:
+                return fn(stack, local_fail)  # type: ignore
+            except Exception as e:
+                local_fail(f"uncaught exception {type(e).__name__}: {' '.join(map(str, e.args))}")
+        def new_fn(state: State):
+            return state.with_stack(stack_fn(state.stack))
+        async_fn = None
+        if asynchronous is not None:
+            async def async_stack_fn(stack: Stack):
+                local_fail: Fail = lambda reason: _fail(fn_name, reason, stack)
+                try:
+                    return await asynchronous(stack, local_fail)  # type: ignore
+                except Exception as e:
+                    local_fail(f"uncaught exception {type(e).__name__}: {' '.join(map(str, e.args))}")
+            async_fn = async_stack_fn
+        native_fn = NativeFunction(new_fn, fn_name, stack_fn=stack_fn, async_fn=async_fn)
+        if effect is not None:
+            def direct(stack: Stack):
+                return fn(stack, _cannot_fail)  # type: ignore
+            specializations[fn_name] = Specialization(native_fn, StackEffect.parse(effect), direct)
+        return native_fn
     return inner
 
 
@@ -131,24 +212,23 @@ def raw_function(*instructions: Instruction, name: str = "<raw>", source_code: O
 
 
 def vec_to_stack(t: Value, fail: Fail) -> Stack:
-    stack = None
+    values = []
     if t.tag != "vec":
         fail(f"expected tuple, got {t}")
     while True:
         if len(t.values) == 0:
-            return stack
+            return ArrayStack.from_values(values)
         if len(t.values) != 2:
             fail(f"got tuple of size {len(t.values)} {vm_utils.stringify_value(t)}, expected 2")
         head, rest = t.values
         if rest.tag != "vec":
             fail(f"expected tuple as second element, got {rest}")
         t = rest
-        stack = (head, stack)
+        values.append(head)
 
 
 def stack_to_vec(stack: Stack) -> Vec:
     rv = Vec([])
-    while stack is not None:
-        head, stack = stack  # type: ignore
+    for head in vm_utils.unwrap_stack(stack):
         rv = Vec([head, rv])
     return rv
@@ -0,0 +1,787 @@
+"""
+Bytecode engine
+
+`compile` turns a sequence of instructions into a `Block`: a flat tuple of
+integer opcodes and their arguments, plus a table of constants referred to
+by the arguments. The interpreter runs blocks with a program counter and a
+return stack of frames, so calling a function doesn't copy its instructions
+anywhere.
+
+Blocks are compiled lazily, the first time a function is called, and cached.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from immutables import Map
+
+from .types import (
+    Address, CallByValue, Code, CodeFlags, Instruction, Machine, MakeScope, NativeFunction, PopScope, Scope, Stack,
+    State, Value, Vec
+)
+from .builtin_utils import specializations
+from . import vm
+
+
+# Opcodes. Every opcode is followed by exactly one argument.
+PUT = 0         # push consts[arg]
+PUT_CODE = 1    # push a closure over the current scope, consts[arg] is a `PutCode`
+CALL_NAME = 2   # call the function named consts[arg]
+CALL_VALUE = 3  # pop a function from the stack and call it
+MAKE_VEC = 4    # collect `arg` elements into a vector
+MAKE_SCOPE = 5  # create a scope, consts[arg] is a `MakeScope`
+POP_SCOPE = 6   # discard the topmost scope
+
+# Superinstructions, see `fuse`
+PUT_VEC = 7         # push a constant vector, consts[arg] is `(vector, extra code units to skip)`
+CALL_CONST = 8      # PUT f, CALL_VALUE
+PUT_CALL_NAME = 9   # PUT x, CALL_NAME n
+CALL_NAME_NAME = 10 # CALL_NAME a, CALL_NAME b
+PUT_PUT = 11        # PUT x, PUT y
+
+CALL_DIRECT = 12    # like CALL_NAME, for a function with a verified stack effect, see `_specialize`
+DIRECT_RUN = 13     # a sequence of PUT and CALL_DIRECT, consts[arg] is `(steps, extra code units to skip)`
+
+OPCODE_NAMES = {
+    PUT: "PUT",
+    PUT_CODE: "PUT_CODE",
+    CALL_NAME: "CALL_NAME",
+    CALL_VALUE: "CALL_VALUE",
+    MAKE_VEC: "MAKE_VEC",
+    MAKE_SCOPE: "MAKE_SCOPE",
+    POP_SCOPE: "POP_SCOPE",
+    PUT_VEC: "PUT_VEC",
+    CALL_CONST: "CALL_CONST",
+    PUT_CALL_NAME: "PUT_CALL_NAME",
+    CALL_NAME_NAME: "CALL_NAME_NAME",
+    PUT_PUT: "PUT_PUT",
+    CALL_DIRECT: "CALL_DIRECT",
+    DIRECT_RUN: "DIRECT_RUN",
+}
+
+
+class Block:
+    """
+    Compiled instructions of a function
+
+    `caches` holds the inline caches of `CALL_NAME` sites. The cache of a
+    site lives at the same index as the name in `consts`, and so does the
+    lexical address of the name, if it has one.
+
+    `code` can only be run if the stack passes the `entry_tags` check,
+    otherwise `fallback_code` is run. The two only differ in `CALL_DIRECT`.
+    """
+    __slots__ = ("code", "consts", "instructions", "caches", "addresses", "fallback_code", "entry_tags")
+
+    def __init__(
+        self,
+        code: Tuple[int, ...],
+        consts: Tuple[object, ...],
+        instructions: Sequence[Instruction],
+        fallback_code: Optional[Tuple[int, ...]] = None,
+        entry_tags: Tuple[Optional[str], ...] = (),
+        addresses: Optional[Dict[int, Address]] = None,
+    ):
+        self.code = code
+        self.consts = consts
+        self.instructions = instructions
+        self.caches: List[Tuple[CacheEntry, ...]] = [()] * len(consts)
+        self.addresses: List[Optional[Address]] = [None] * len(consts)
+        for slot, address in (addresses or {}).items():
+            self.addresses[slot] = address
+        self.fallback_code = code if fallback_code is None else fallback_code
+        self.entry_tags = entry_tags
+
+    def code_for(self, stack: Stack) -> Tuple[int, ...]:
+        """
+        Pick the code to run when the block is entered with `stack`
+        """
+        for tag in self.entry_tags:
+            if stack is None:
+                return self.fallback_code
+            (value, stack) = stack  # type: ignore
+            if tag is not None and value.tag != tag:
+                return self.fallback_code
+        return self.code
+
+    def __len__(self):
+        return len(self.code) // 2
+
+    def __repr__(self):
+        return f"<Block of {len(self)} ops>"
+
+
+def compile(instructions: Sequence[Instruction], fuse: bool = True) -> Block:
+    code: List[int] = []
+    consts: List[object] = []
+    name_slots: Dict[str, int] = {}
+    addresses: Dict[int, Optional[Address]] = {}
+
+    def add_const(value: object) -> int:
+        consts.append(value)
+        return len(consts) - 1
+
+    def add_name(name: str, address: Optional[Address]) -> int:
+        if name not in name_slots:
+            name_slots[name] = add_const(name)
+            addresses[name_slots[name]] = address
+        elif addresses[name_slots[name]] != address:
+            addresses[name_slots[name]] = None
+        return name_slots[name]
+
+    for instruction in instructions:
+        if instruction.tag == "put":
+            code += (PUT, add_const(instruction.value))
+        elif instruction.tag == "put_code":
+            code += (PUT_CODE, add_const(instruction))
+        elif instruction.tag == "call":
+            code += (CALL_NAME, add_name(instruction.function_name, instruction.address))
+        elif instruction.tag == "call_by_value":
+            code += (CALL_VALUE, 0)
+        elif instruction.tag == "make_vec":
+            code += (MAKE_VEC, instruction.size)
+        elif instruction.tag == "make_scope":
+            code += (MAKE_SCOPE, add_const(instruction))
+        elif instruction.tag == "pop_scope":
+            code += (POP_SCOPE, 0)
+        else:
+            raise RuntimeError(instruction)
+
+    fallback_code = list(code)
+    entry_tags = _specialize(code, consts)
+    if fuse:
+        _fuse(code, consts)
+        if entry_tags is not None:
+            _fuse(fallback_code, consts)
+    return Block(
+        tuple(code),
+        tuple(consts),
+        instructions,
+        None if entry_tags is None else tuple(fallback_code),
+        entry_tags or (),
+        {slot: address for slot, address in addresses.items() if address is not None},
+    )
+
+
+# <stack effects>
+#
+# Calls to natives with known stack effects (see `builtin_utils.StackEffect`)
+# are verified by running the block on abstract values: tags of constants,
+# positions on the stack the block was entered with, or unknown values. A
+# call is verified if its inputs are certainly on the stack and have the
+# right tags. Verified calls become `CALL_DIRECT`, which calls the native
+# without any error handling.
+#
+# Verifying a call can require the entry stack to have some depth and some
+# tags, which is checked once when the block is entered. If the check fails,
+# or if a `CALL_DIRECT` name resolves to a different function, the code
+# without `CALL_DIRECT` is run instead.
+#
+# After a call that isn't verified nothing is known about the stack.
+
+class _Unknown:
+    """Abstract value of the stack below an unknown call"""
+
+_UNKNOWN = _Unknown()
+
+# An abstract value is a tag, a position on the entry stack, or `None`
+AbstractValue = Union[str, int, None, _Unknown]
+
+
+def _specialize(code: List[int], consts: List[object]) -> Optional[Tuple[Optional[str], ...]]:
+    """
+    Replace verified `CALL_NAME` with `CALL_DIRECT`
+
+    Return the tags the entry stack must have, or `None` if nothing was
+    specialized.
+    """
+    stack: List[AbstractValue] = []
+    entry_tags: List[Optional[str]] = []
+    entry_depth = 0
+    at_entry = True  # Values below `stack` are on the entry stack
+    specialized = False
+
+    def pop() -> AbstractValue:
+        if stack:
+            return stack.pop()
+        if not at_entry:
+            return _UNKNOWN
+        entry_tags.append(None)
+        return len(entry_tags) - 1
+
+    for i in range(0, len(code), 2):
+        op, arg = code[i], code[i + 1]
+        if op == PUT:
+            stack.append(getattr(consts[arg], "tag", None))
+        elif op == PUT_CODE:
+            stack.append("code")
+        elif op == MAKE_VEC:
+            for _ in range(arg):
+                pop()
+            stack.append("vec")
+        elif op == CALL_NAME and consts[arg] in specializations:
+            effect = specializations[consts[arg]].effect
+            inputs = {name: pop() for name, _ in reversed(effect.inputs)}
+            verified = True
+            required: Dict[int, str] = {}
+            for name, tag in effect.inputs:
+                value = inputs[name]
+                if value is _UNKNOWN:
+                    verified = False
+                elif isinstance(value, int):
+                    if tag is not None:
+                        if entry_tags[value] not in (None, tag):
+                            verified = False
+                        required[value] = tag
+                elif tag is not None and value != tag:
+                    verified = False
+            if verified:
+                code[i] = CALL_DIRECT
+                specialized = True
+                for position, tag in required.items():
+                    entry_tags[position] = tag
+                entry_depth = max([entry_depth, *(v + 1 for v in inputs.values() if isinstance(v, int))])
+                stack.extend(inputs.get(name, tag) for name, tag in effect.outputs)
+            else:
+                # The name isn't guarded, so it could be any function
+                stack.clear()
+                at_entry = False
+        elif op == CALL_NAME or op == CALL_VALUE:
+            stack.clear()
+            at_entry = False
+
+    return tuple(entry_tags[:entry_depth]) if specialized else None
+
+# </stack effects>
+
+
+# <superinstructions>
+#
+# A fused opcode replaces the first opcode of a sequence, and the rest of
+# the sequence is left in place: the fused opcode reads the arguments of the
+# following opcodes and jumps over them. The program counter still maps to
+# `Block.instructions`, and a function called in the middle of a sequence
+# can return into it.
+#
+# Vectors of constants, like the patterns of `case`, are built at compile
+# time and pushed with a single `PUT_VEC`.
+
+def _fuse(code: List[int], consts: List[object]):
+    _fold_constant_vectors(code, consts)
+
+    i = 0
+    end = len(code) - 2
+    while i < end:
+        op = code[i]
+        if op == PUT_VEC:
+            i += 2 + consts[code[i + 1]][1]  # type: ignore
+            continue
+        if op == PUT or op == CALL_DIRECT:
+            run_end = i
+            while run_end < len(code) and code[run_end] in (PUT, CALL_DIRECT):
+                run_end += 2
+            if run_end - i > 2 and CALL_DIRECT in code[i:run_end:2]:
+                _fuse_direct_run(code, consts, i, run_end)
+                i = run_end
+                continue
+        next_op = code[i + 2]
+        if op == PUT:
+            value = consts[code[i + 1]]
+            if next_op == CALL_VALUE and getattr(value, "tag", None) in ("code", "native"):
+                code[i] = CALL_CONST
+            elif next_op == CALL_NAME:
+                code[i] = PUT_CALL_NAME
+            elif next_op == PUT:
+                code[i] = PUT_PUT
+            else:
+                i += 2
+                continue
+        elif op == CALL_NAME and next_op == CALL_NAME:
+            code[i] = CALL_NAME_NAME
+        else:
+            i += 2
+            continue
+        i += 4
+
+
+def _fuse_direct_run(code: List[int], consts: List[object], start: int, end: int):
+    # Steps are (offset from `start`, const index, specialization or `None` for PUT)
+    steps = tuple(
+        (i - start, code[i + 1], specializations[consts[code[i + 1]]] if code[i] == CALL_DIRECT else None)  # type: ignore
+        for i in range(start, end, 2)
+    )
+    code[start] = DIRECT_RUN
+    code[start + 1] = len(consts)
+    consts.append((steps, end - start - 2))
+
+
+def _fold_constant_vectors(code: List[int], consts: List[object]):
+    # (code offset, value) of constants pushed since the last other opcode
+    constants: List[Tuple[int, Value]] = []
+    for i in range(0, len(code), 2):
+        op = code[i]
+        if op == PUT:
+            constants.append((i, consts[code[i + 1]]))  # type: ignore
+        elif op == MAKE_VEC and code[i + 1] <= len(constants):
+            size = code[i + 1]
+            elements = constants[len(constants) - size:]
+            start = elements[0][0] if elements else i
+            vec = Vec([value for _, value in elements])
+            code[start] = PUT_VEC
+            code[start + 1] = len(consts)
+            consts.append((vec, i - start))
+            del constants[len(constants) - size:]
+            constants.append((start, vec))
+        else:
+            constants.clear()
+
+
+_FUSED_OPS = frozenset((PUT_VEC, CALL_CONST, PUT_CALL_NAME, CALL_NAME_NAME, PUT_PUT, DIRECT_RUN))
+
+
+def _width(op: int, arg: int, block: "Block") -> int:
+    """
+    Number of instructions executed by an opcode
+    """
+    if op == PUT_VEC or op == DIRECT_RUN:
+        return block.consts[arg][1] // 2 + 1  # type: ignore
+    elif op in _FUSED_OPS:
+        return 2
+    else:
+        return 1
+
+
+class OpProfile:
+    """
+    Counts of executed opcodes, see `profiling`
+    """
+    __slots__ = ("ops", "instructions")
+
+    def __init__(self):
+        self.ops: "Counter[int]" = Counter()
+        self.instructions: "Counter[int]" = Counter()
+
+    def record(self, op: int, arg: int, block: "Block"):
+        self.ops[op] += 1
+        self.instructions[op] += _width(op, arg, block)
+
+    def hit_rate(self) -> float:
+        """
+        Fraction of instructions executed as part of a superinstruction
+        """
+        total = sum(self.instructions.values())
+        fused = sum(n for op, n in self.instructions.items() if op in _FUSED_OPS)
+        return fused / total if total else 0.0
+
+    def report(self) -> str:
+        total = sum(self.instructions.values())
+        lines = [f"{'opcode':<16}{'executed':>12}{'instructions':>14}{'share':>8}"]
+        for op, n in self.instructions.most_common():
+            lines.append(f"{OPCODE_NAMES[op]:<16}{self.ops[op]:>12}{n:>14}{n / total:>8.1%}")
+        lines.append(f"superinstruction hit rate: {self.hit_rate():.1%}")
+        return "\n".join(lines)
+
+
+_profile: Optional[OpProfile] = None
+
+
+@contextmanager
+def profiling() -> Iterator[OpProfile]:
+    """
+    Count the opcodes executed by the bytecode engine inside the block
+    """
+    global _profile
+    outer, _profile = _profile, OpProfile()
+    try:
+        yield _profile
+    finally:
+        _profile = outer
+
+# </superinstructions>
+
+
+# Blocks are cached by the identity of the instruction sequence. The cache
+# holds on to the sequence, so its `id` can't be reused by another object.
+# Unfused blocks are only used when a middleware traces every instruction.
+_BLOCK_CACHE_SIZE = 4096
+_block_caches: Dict[bool, Dict[int, Tuple[Sequence[Instruction], Block]]] = {True: {}, False: {}}
+
+
+def get_block(instructions: Sequence[Instruction], fuse: bool = True) -> Block:
+    block_cache = _block_caches[fuse]
+    entry = block_cache.get(id(instructions))
+    if entry is not None and entry[0] is instructions:
+        return entry[1]
+    block = compile(instructions, fuse)
+    if len(block_cache) >= _BLOCK_CACHE_SIZE:
+        block_cache.pop(next(iter(block_cache), None), None)  # type: ignore
+    block_cache[id(instructions)] = (instructions, block)
+    return block
+
+
+# <inline caches>
+#
+# Looking up a name walks the scope chain, doing a few `Map` lookups per
+# scope. Names like `dup` or `+` live at the very top of the chain, so they
+# pay for the whole walk every time.
+#
+# Every scope gets a shape: two scopes have the same shape if they define
+# the same names and their parents have the same shape. Resolving a name in
+# scopes of the same shape takes the same number of hops. Persistent scopes
+# (the global scope, the built-in scope and module scopes) have unique
+# shapes, so a name resolved in one of them always resolves to the same
+# value, which is then cached directly.
+#
+# A name with a lexical address (see `resolver.py`) is looked up there and
+# skips the caches. Other names are first looked up in the current scope.
+# If it's not there, the site's cache is consulted with the shape of the
+# parent scope as the key.
+#
+# Shapes are computed lazily and stored in `Machine.shapes`. When a scope
+# that already has a shape gains or loses a name, all shapes and caches are
+# invalidated by replacing `Machine.cache_epoch`.
+
+# Sites that have seen more shapes than this fall back to plain lookups
+POLYMORPHIC_LIMIT = 4
+
+
+class Shape:
+    __slots__ = ("root", "transitions")
+
+    def __init__(self, root: Optional[int]):
+        self.root = root
+        self.transitions: Dict[frozenset, Shape] = {}
+
+    def child(self, names: frozenset) -> "Shape":
+        shape = self.transitions.get(names)
+        if shape is None:
+            shape = self.transitions[names] = Shape(None)
+        return shape
+
+
+# (epoch, parent shape, hops from the parent, value if resolved in a persistent scope)
+CacheEntry = Tuple[object, Shape, int, Optional[Value]]
+_MEGAMORPHIC: Tuple[CacheEntry, ...] = ((object(), Shape(None), 0, None),)
+
+
+def shape_of(machine: Machine, scope_id: int) -> Shape:
+    shape = machine.shapes.get(scope_id)
+    if shape is not None:
+        return shape
+    scope = machine.get_scope(scope_id)
+    if scope.persistent or scope.parent is None or scope_id in _pinned_scopes():
+        shape = Shape(scope_id)
+    else:
+        shape = shape_of(machine, scope.parent).child(frozenset(scope.values.keys()))
+    machine.shapes[scope_id] = shape
+    return shape
+
+
+def _pinned_scopes() -> Tuple[int, int]:
+    return (vm.builtin_scope.id, vm.global_scope.id)
+
+
+def invalidate_caches(machine: Machine):
+    machine.shapes.clear()
+    machine.cache_epoch = object()
+
+
+def on_scopes_changed(machine: Machine, old_scopes: "Map[int, Scope]"):
+    """
+    Invalidate the caches if a scope with a known shape has changed
+
+    Call this after a native function returns a `State` with different
+    scopes. Natives change the bindings of the current scope with
+    `set_name`, `forget_name` and `set_names`, and add new scopes with
+    `set_scope`. Any other change invalidates the caches too.
+    """
+    scope_id: int = machine.scope_stack[0]  # type: ignore
+    if old_scopes.get(scope_id) is machine.scopes.get(scope_id) or scope_id in machine.shapes:
+        invalidate_caches(machine)
+
+
+def look_up(machine: Machine, block: Block, slot: int) -> Value:
+    name: str = block.consts[slot]  # type: ignore
+    address = block.addresses[slot]
+    if address is not None:
+        return machine.look_up_address(name, address)
+    scope = machine.scopes[machine.scope_stack[0]]  # type: ignore
+    if name in scope.values:
+        return scope.values[name]
+    if scope.parent is None:
+        raise KeyError(name)
+
+    shape = shape_of(machine, scope.parent)
+    epoch = machine.cache_epoch
+    entries = block.caches[slot]
+    for (entry_epoch, entry_shape, hops, value) in entries:
+        if entry_epoch is epoch and entry_shape is shape:
+            if value is not None:
+                return value
+            scope = machine.scopes[scope.parent]
+            for _ in range(hops):
+                scope = machine.scopes[scope.parent]
+            return scope.values[name]
+
+    parent_id: int = scope.parent
+    hops = 0
+    scope = machine.get_scope(parent_id)
+    while name not in scope.values:
+        if scope.parent is None:
+            raise KeyError(name)
+        scope = machine.get_scope(scope.parent)
+        hops += 1
+    value = scope.values[name]
+
+    if entries is not _MEGAMORPHIC:
+        entries = tuple(entry for entry in entries if entry[0] is epoch)
+        if len(entries) >= POLYMORPHIC_LIMIT:
+            block.caches[slot] = _MEGAMORPHIC
+        else:
+            cached = value if shape_of(machine, scope.id).root is not None else None
+            block.caches[slot] = (*entries, (epoch, shape, hops, cached))
+    return value
+
+# </inline caches>
+
+
+_CALL_OPS = frozenset((CALL_NAME, CALL_VALUE, PUT_CALL_NAME, CALL_CONST, CALL_NAME_NAME))
+
+
+def _call_native(machine: Machine, function: NativeFunction, refcounts: vm.ScopeRefcounts):
+    if function.stack_fn is not None:
+        machine.stack = function.stack_fn(machine.stack)
+    else:
+        old_scopes = machine.scopes
+        refcounts.load(function.fn(machine.snapshot()))
+        if machine.scopes is not old_scopes:
+            on_scopes_changed(machine, old_scopes)
+
+
+def _enter(machine: Machine, function: Code, introduce: Callable[[int], None]):
+    """
+    Give a call of `function` its scope
+    """
+    if function.flags & CodeFlags.FLAT and function.bindings is None:
+        machine.enter_scope(function.closure)  # type: ignore
+        introduce(function.closure)  # type: ignore
+    else:
+        new_id = vm.generate_scope_id()
+        machine.make_scope(function.closure, new_id, function.bindings)  # type: ignore
+        introduce(new_id)
+
+
+# Used for calling a native function that's passed to `call` directly
+_CALL_VALUE_BLOCK = compile((CallByValue(),))
+_POP_SCOPE = PopScope()
+
+
+def call(
+    state: State,
+    function: Union[Code, NativeFunction],
+    middleware: Optional[vm.MiddlewareT],
+) -> State:
+    """
+    Call a function with the bytecode engine
+    """
+    machine = Machine(state)
+    refcounts = vm.ScopeRefcounts(machine)
+    finalizers = refcounts.finalizers
+    introduce = refcounts.introduce
+    finalize = refcounts.finalize
+    collector = refcounts.collector
+    # Superinstructions would hide instructions from the middleware
+    fuse = middleware is None
+    profile = _profile
+
+    # The return stack. Each frame is (block, code, program counter, owns scope).
+    # A frame that owns a scope pops it when the frame is exhausted.
+    frames: List[Tuple[Block, Tuple[int, ...], int, bool]] = []
+
+    owns_scope = False
+    if function.tag == "native":
+        machine.stack = (function, machine.stack)
+        block = _CALL_VALUE_BLOCK
+    else:
+        block = get_block(function.instructions, fuse)
+        if not (function.flags & CodeFlags.PARENT_SCOPE or function.closure is None):
+            _enter(machine, function, introduce)
+            owns_scope = True
+
+    code = block.code_for(machine.stack)
+    consts = block.consts
+    end = len(code)
+    pc = 0
+
+    traced: Instruction = _POP_SCOPE
+    old_stack: Stack = None
+
+    while True:
+        if pc == end:
+            if owns_scope:
+                finalizers.advance()
+                old_stack = machine.stack
+                scope_id: int = machine.scope_stack[0]  # type: ignore
+                machine.pop_scope()
+                finalize(scope_id)
+                if middleware is not None:
+                    middleware(_POP_SCOPE, old_stack, machine.stack)
+            if not frames:
+                break
+            block, code, pc, owns_scope = frames.pop()
+            consts = block.consts
+            end = len(code)
+            continue
+
+        finalizers.advance()
+
+        if middleware is not None:
+            traced = block.instructions[pc >> 1]
+            old_stack = machine.stack
+
+        op = code[pc]
+        arg = code[pc + 1]
+        pc += 2
+
+        if profile is not None:
+            profile.record(op, arg, block)
+
+        if op == PUT:
+            machine.stack = (consts[arg], machine.stack)  # type: ignore
+
+        elif op == DIRECT_RUN:
+            steps, skip = consts[arg]  # type: ignore
+            stack = machine.stack
+            for offset, slot, specialization in steps:
+                if specialization is None:
+                    stack = (consts[slot], stack)  # type: ignore
+                elif look_up(machine, block, slot) is specialization.native:
+                    stack = specialization.direct(stack)
+                else:
+                    # Continue from this step without specializations
+                    code = block.fallback_code
+                    pc += offset - 2
+                    break
+            else:
+                pc += skip
+            machine.stack = stack
+
+        elif op == CALL_DIRECT:
+            specialization = specializations[consts[arg]]  # type: ignore
+            if look_up(machine, block, arg) is specialization.native:
+                machine.stack = specialization.direct(machine.stack)
+            else:
+                # Run the instruction again as a `CALL_NAME`
+                code = block.fallback_code
+                pc -= 2
+                continue
+
+        elif op in _CALL_OPS:
+            if op == CALL_NAME:
+                function = look_up(machine, block, arg)
+            elif op == CALL_VALUE:
+                (function, machine.stack) = machine.stack  # type: ignore
+            elif op == PUT_CALL_NAME:
+                machine.stack = (consts[arg], machine.stack)  # type: ignore
+                function = look_up(machine, block, code[pc + 1])
+                pc += 2
+            elif op == CALL_CONST:
+                function = consts[arg]  # type: ignore
+                pc += 2
+            else:  # CALL_NAME_NAME
+                function = look_up(machine, block, arg)
+                # If the first function is code, it returns to the second `CALL_NAME`
+                if function.tag == "native":
+                    _call_native(machine, function, refcounts)
+                    function = look_up(machine, block, code[pc + 1])
+                    pc += 2
+
+            if function.tag == "code":
+                callee_owns_scope = not (function.flags & CodeFlags.PARENT_SCOPE or function.closure is None)
+                if pc < end:
+                    frames.append((block, code, pc, owns_scope))
+                    owns_scope = False
+                elif owns_scope and callee_owns_scope:
+                    # A tail call: pop the caller's scope before the call
+                    # instead of after it, so tail recursion runs in constant space
+                    old_stack = machine.stack
+                    scope_id = machine.scope_stack[0]  # type: ignore
+                    machine.pop_scope()
+                    finalize(scope_id)
+                    if middleware is not None:
+                        middleware(_POP_SCOPE, old_stack, machine.stack)
+                    owns_scope = False
+                # Otherwise a function without a scope of its own runs in the
+                # caller's scope, and pops it when it's done
+                block = get_block(function.instructions, fuse)
+                code = block.code_for(machine.stack)
+                consts = block.consts
+                end = len(code)
+                pc = 0
+                if callee_owns_scope:
+                    _enter(machine, function, introduce)
+                    owns_scope = True
+                    if collector.due():
+                        collector.collect((consts, [frame[0].consts for frame in frames]))
+            else:
+                _call_native(machine, function, refcounts)
+
+        elif op == PUT_PUT:
+            machine.stack = (consts[code[pc + 1]], (consts[arg], machine.stack))  # type: ignore
+            pc += 2
+
+        elif op == PUT_VEC:
+            vec, skip = consts[arg]  # type: ignore
+            machine.stack = (vec, machine.stack)
+            pc += skip
+
+        elif op == PUT_CODE:
+            put_code = consts[arg]
+            scope_id = machine.scope_stack[0]  # type: ignore
+            machine.stack = (
+                Code(
+                    instructions=put_code.instructions,  # type: ignore
+                    closure=scope_id,
+                    source_code=put_code.source_code,  # type: ignore
+                    flags=put_code.flags,  # type: ignore
+                    introducer=refcounts.introducer_ref,
+                    finalizer=refcounts.finalizer_ref,
+                ),
+                machine.stack
+            )
+            introduce(scope_id)
+
+        elif op == MAKE_VEC:
+            stack = machine.stack
+            elements: List[Value] = []
+            for _ in range(arg):
+                head, stack = stack  # type: ignore
+                elements.append(head)
+            machine.stack = (Vec(elements[::-1]), stack)
+
+        elif op == MAKE_SCOPE:
+            make_scope: MakeScope = consts[arg]  # type: ignore
+            parent_id = make_scope.parent_id
+            if make_scope.flat:
+                machine.enter_scope(parent_id)
+                introduce(parent_id)
+            else:
+                new_id = vm.generate_scope_id()
+                machine.make_scope(parent_id, new_id, make_scope.bindings)
+                introduce(new_id)
+                if collector.due():
+                    collector.collect((consts, [frame[0].consts for frame in frames]))
+
+        elif op == POP_SCOPE:
+            scope_id = machine.scope_stack[0]  # type: ignore
+            machine.pop_scope()
+            finalize(scope_id)
+
+        else:
+            raise RuntimeError(f"Unknown opcode {op}")
+
+        if middleware is not None:
+            middleware(traced, old_stack, machine.stack)
+
+    finalizers.flush()
+    return machine.snapshot()
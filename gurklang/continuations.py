@@ -0,0 +1,174 @@
+"""
+Persistent engine: first-class continuations
+
+The pipe of this engine is a linked list of frames. A frame is a tuple
+`(instructions, pc, next frame)`, where `pc` is the index of the next
+instruction to run. Frames are never modified, so the rest of the program
+can be captured in O(1) by keeping a reference to the current frame, and
+two continuations share every frame they have in common.
+
+`call/cc` calls a function with the continuation of the call on top of the
+stack. Calling the continuation later, even after `call/cc` has returned,
+continues from where `call/cc` would have returned. It restores the
+scope stack of the capture, and keeps the current stack, so the values a
+continuation is called with are the values `call/cc` returns.
+
+A continuation can hold on to any scope, so this engine doesn't count
+references to scopes. Its scopes are only killed by a `ScopeCollector`.
+The other engines don't support `call/cc`.
+"""
+from dataclasses import dataclass, field
+from typing import Any, Optional, Sequence, Tuple, Union
+
+from .builtin_utils import Fail, make_simple
+from .scope_gc import ScopeCollector
+from .types import Code, CodeFlags, Instruction, Machine, NativeFunction, PopScope, Stack, State, Vec
+
+Frame = Optional[Tuple[Sequence[Instruction], int, Any]]
+
+_POP_SCOPE: Tuple[Instruction, ...] = (PopScope(),)
+
+
+def _unsupported(stack: Stack, fail: Fail):
+    fail("continuations need the persistent engine, run with GURKLANG_ENGINE=persistent")
+
+
+@dataclass(frozen=True)
+class Continuation(NativeFunction):
+    """
+    The rest of a program, captured by `call/cc`
+    """
+    frame: Frame = field(default=None, compare=False, repr=False)
+    scope_stack: Any = field(default=None, compare=False, repr=False)
+
+
+@make_simple("call/cc")
+def call_cc(stack: Stack, fail: Fail):
+    """
+    Call a function with the current continuation
+
+    (function -- function's results)
+    """
+    _unsupported(stack, fail)
+
+
+_resume = make_simple("continuation")(_unsupported)
+
+
+def call(
+    state: State,
+    function: Union[Code, NativeFunction],
+    middleware: Optional[Any],
+) -> State:
+    from .vm import builtin_scope, generate_scope_id, global_scope
+
+    machine = Machine(state)
+    collector = ScopeCollector(machine, (builtin_scope.id, global_scope.id))
+    code: Sequence[Instruction] = ()
+    pc = 0
+    rest: Frame = None
+    # The function to call next
+    pending: Optional[Union[Code, NativeFunction]] = function
+    instruction: Optional[Instruction] = None
+    old_stack: Stack = None
+
+    while True:
+        while pending is not None:
+            function, pending = pending, None
+            if function.tag == "code":
+                owns_scope = not (function.flags & CodeFlags.PARENT_SCOPE or function.closure is None)
+                if pc < len(code):
+                    rest = (code, pc, rest)
+                elif owns_scope and rest is not None and rest[0] is _POP_SCOPE:
+                    # A tail call: the caller's frame is done and its scope
+                    # is popped now instead of after the call. A function
+                    # without a scope of its own runs in the caller's scope,
+                    # so then the scope is popped after the call.
+                    machine.pop_scope()
+                    rest = rest[2]
+                if owns_scope:
+                    rest = (_POP_SCOPE, 0, rest)
+                    if function.flags & CodeFlags.FLAT and function.bindings is None:
+                        machine.enter_scope(function.closure)
+                    else:
+                        machine.make_scope(function.closure, generate_scope_id(), function.bindings)
+                        if collector.due():
+                            collector.collect((function, code, rest))
+                code, pc = function.instructions, 0
+            elif function is call_cc:
+                (pending, machine.stack) = machine.stack  # type: ignore
+                continuation = Continuation(
+                    _resume.fn, "continuation", _resume.stack_fn,
+                    frame=(code, pc, rest),
+                    scope_stack=machine.scope_stack,
+                )
+                machine.stack = (continuation, machine.stack)
+            elif type(function) is Continuation:
+                (code, pc, rest) = function.frame  # type: ignore
+                machine.scope_stack = function.scope_stack
+            elif function.stack_fn is not None:
+                machine.stack = function.stack_fn(machine.stack)
+            else:
+                machine.load(function.fn(machine.snapshot()))
+
+        if middleware is not None and instruction is not None:
+            middleware(instruction, old_stack, machine.stack)
+
+        if pc == len(code):
+            if rest is None:
+                break
+            (code, pc, rest) = rest
+            instruction = None
+            continue
+
+        instruction = code[pc]
+        pc += 1
+        old_stack = machine.stack
+        tag = instruction.tag
+
+        if tag == "put":
+            machine.stack = (instruction.value, machine.stack)
+
+        elif tag == "call":
+            if instruction.address is None:
+                pending = machine.look_up_name_in_current_scope(instruction.function_name)
+            else:
+                pending = machine.look_up_address(instruction.function_name, instruction.address)
+
+        elif tag == "call_by_value":
+            (pending, machine.stack) = machine.stack  # type: ignore
+
+        elif tag == "put_code":
+            machine.stack = (
+                Code(
+                    instructions=instruction.instructions,
+                    closure=machine.scope_stack[0],  # type: ignore
+                    source_code=instruction.source_code,
+                    flags=instruction.flags,
+                ),
+                machine.stack
+            )
+
+        elif tag == "make_vec":
+            stack = machine.stack
+            elements = []
+            for _ in range(instruction.size):
+                head, stack = stack  # type: ignore
+                elements.append(head)
+            machine.stack = (Vec(elements[::-1]), stack)
+
+        elif tag == "make_scope":
+            if instruction.flat:
+                machine.enter_scope(instruction.parent_id)
+            else:
+                machine.make_scope(instruction.parent_id, generate_scope_id(), instruction.bindings)
+                if collector.due():
+                    collector.collect((code, rest))
+
+        elif tag == "pop_scope":
+            machine.pop_scope()
+
+        else:
+            raise RuntimeError(instruction)
+
+    return machine.snapshot()
@@ -0,0 +1,142 @@
+"""
+Constant folding
+
+`optimize` rewrites the AST of a program (see `ast_parser.py`), evaluating
+built-in functions whose inputs are literals:
+- `math` arithmetic and comparisons of two `Int` literals, like `2 3 +`
+- `=` of two `Int` or two `Str` literals, and `not` of `:true` or `:false`
+- `if` with a `:true` or `:false` literal condition, which drops the branch
+  that can't run, so `:true { a } { b } if !` becomes `{ a } !`
+
+Folding repeats as long as it applies, so `1 2 < { a } { b } if` becomes
+`{ a }`. A call is only folded if it can't call anything but the built-in
+function, see `resolver.find_builtin_calls`, and never if it would fail,
+like `1 0 /`.
+"""
+import operator
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .ast_parser import (
+    ASTNode, AtomLiteral, CodeLiteral, IntLiteral, NameCall, VecLiteral,
+    eq, parse_as_ast, por, t_atom, t_code, t_int, t_str, t_vec,
+)
+from .resolver import compile, find_builtin_calls
+from .types import Instruction
+
+_MATH: Dict[str, Callable[[int, int], object]] = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.floordiv,
+    "%": operator.mod,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+    "≤": operator.le,
+    "≥": operator.ge,
+}
+
+t_bool = por(eq(AtomLiteral("true")), eq(AtomLiteral("false")))
+t_value = por(t_int, t_str, t_atom, t_vec, t_code)
+t_math = por(*(eq(NameCall(name)) for name in _MATH))
+
+_Fold = Callable[[Sequence[ASTNode], Dict[int, str]], Optional[ASTNode]]
+
+
+def parse(source: str) -> List[Instruction]:
+    """
+    Parse a program like `resolver.parse`, folding its constants
+    """
+    return compile(optimize(parse_as_ast(source)))
+
+
+def optimize(program: CodeLiteral) -> CodeLiteral:
+    return _fold_code(program, find_builtin_calls(program))
+
+
+def count_instructions(instructions: Sequence[Instruction]) -> int:
+    """
+    Count instructions, including the ones of code literals
+    """
+    return sum(
+        1 + (count_instructions(instruction.instructions) if instruction.tag == "put_code" else 0)
+        for instruction in instructions
+    )
+
+
+def _literal(value: object) -> ASTNode:
+    if isinstance(value, bool):
+        return AtomLiteral("true" if value else "false")
+    return IntLiteral(value)  # type: ignore
+
+
+def _fold_math(nodes: Sequence[ASTNode], builtin_calls: Dict[int, str]) -> Optional[ASTNode]:
+    (x, y, call) = nodes
+    if builtin_calls.get(id(call)) != "math":
+        return None
+    if call.value in ("/", "%") and y.value == 0:  # type: ignore
+        return None
+    return _literal(_MATH[call.value](x.value, y.value))  # type: ignore
+
+
+def _fold_equals(nodes: Sequence[ASTNode], builtin_calls: Dict[int, str]) -> Optional[ASTNode]:
+    (x, y, call) = nodes
+    if builtin_calls.get(id(call)) != "prelude" or type(x) is not type(y):
+        return None
+    return _literal(x.value == y.value)  # type: ignore
+
+
+def _fold_not(nodes: Sequence[ASTNode], builtin_calls: Dict[int, str]) -> Optional[ASTNode]:
+    (x, call) = nodes
+    if builtin_calls.get(id(call)) != "prelude":
+        return None
+    return _literal(x.value != "true")  # type: ignore
+
+
+def _fold_if(nodes: Sequence[ASTNode], builtin_calls: Dict[int, str]) -> Optional[ASTNode]:
+    (condition, then, else_, call) = nodes
+    if builtin_calls.get(id(call)) != "prelude":
+        return None
+    return then if condition.value == "true" else else_  # type: ignore
+
+
+_RULES: List[Tuple[Tuple[Callable[[ASTNode], bool], ...], _Fold]] = [
+    ((t_int, t_int, t_math), _fold_math),
+    ((por(t_int, t_str), por(t_int, t_str), eq(NameCall("="))), _fold_equals),
+    ((t_bool, eq(NameCall("not"))), _fold_not),
+    ((t_bool, t_value, t_value, eq(NameCall("if"))), _fold_if),
+]
+
+
+def _fold_code(code: CodeLiteral, builtin_calls: Dict[int, str]) -> CodeLiteral:
+    nodes: List[ASTNode] = []
+    for node in code.nodes:
+        nodes.append(_fold_node(node, builtin_calls))
+        while _fold_last(nodes, builtin_calls):
+            pass
+    return CodeLiteral(nodes, code.source_code)
+
+
+def _fold_node(node: ASTNode, builtin_calls: Dict[int, str]) -> ASTNode:
+    if isinstance(node, CodeLiteral):
+        return _fold_code(node, builtin_calls)
+    elif isinstance(node, VecLiteral):
+        return VecLiteral([_fold_node(child, builtin_calls) for child in node.nodes])
+    else:
+        return node
+
+
+def _fold_last(nodes: List[ASTNode], builtin_calls: Dict[int, str]) -> bool:
+    """
+    Fold the nodes at the end of `nodes`, return `True` if they changed
+    """
+    for (patterns, fold) in _RULES:
+        window = nodes[-len(patterns):]
+        if len(window) < len(patterns) or not all(p(node) for p, node in zip(patterns, window)):
+            continue
+        folded = fold(window, builtin_calls)
+        if folded is not None:
+            nodes[-len(patterns):] = [folded]
+            return True
+    return False
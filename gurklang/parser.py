@@ -65,7 +65,7 @@ def _parse_vec(source: str, token_stream: TokenStream[TokenName]) -> Iterator[In
         elif token.name == "LEFT_PAREN":
             yield from _parse_vec(source, token_stream)
         elif token.name == "STRING":
-            yield Put(Str(ast.literal_eval(token.value)))
+            yield Put(Str.interned(ast.literal_eval(token.value)))
         elif token.name == "LEFT_BRACE":
             yield PutCode(list(_parse_codeblock(source, token_stream)))
         else:
@@ -115,7 +115,7 @@ def _parse_codeblock(
             yield Put(Atom(token.value[1:]))
 
         elif token.name == "STRING":
-            yield Put(Str(ast.literal_eval(token.value)))
+            yield Put(Str.interned(ast.literal_eval(token.value)))
 
         else:
             raise ParseError(source, "a code literal", token_stream.last_token)
@@ -0,0 +1,283 @@
+"""
+Compiled pattern matching for `case`
+
+The patterns of a `case` are compiled into a decision tree. Every node of
+the tree tests one thing, either the depth of the stack or the shape of a
+value: the length of a vector, an atom, or an int or string constant. Arms
+that don't care about the tested value are copied into every branch, so
+the tree is walked once, no matter how many arms there are.
+
+Captures and variables are resolved to paths at compile time. A path is the
+position of a value on the stack (0 is the top) followed by indices into
+nested vectors.
+"""
+import operator
+from operator import itemgetter
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+from .types import Atom, Stack, Value, Vec
+
+Path = Tuple[int, ...]
+
+# Trees bigger than this are not worth it, `case` falls back to interpreting
+MAX_NODES = 1024
+
+
+class _Arm:
+    """
+    A pattern while the tree is built
+
+    `size` is the number of values the pattern takes from the stack. `depth`
+    is the stack depth and `shapes` are the keys at paths (parents before
+    children) that haven't been tested yet.
+    """
+    __slots__ = ("index", "size", "depth", "shapes", "captures", "variables")
+
+    def __init__(self, index: int, size: int, depth: int, shapes: List[Tuple[Path, Hashable]],
+                 captures: List[Path], variables: List[Tuple[str, Path]]):
+        self.index = index
+        self.size = size
+        self.depth = depth
+        self.shapes = shapes
+        self.captures = captures
+        self.variables = variables
+
+    def without(self, depth: int, shapes: List[Tuple[Path, Hashable]]) -> "_Arm":
+        return _Arm(self.index, self.size, depth, shapes, self.captures, self.variables)
+
+
+class Leaf:
+    __slots__ = ("arm", "size", "captures", "variables")
+
+    def __init__(self, arm: _Arm):
+        self.arm = arm.index
+        self.size = arm.size
+        self.captures = arm.captures
+        self.variables = arm.variables
+
+
+class DepthTest:
+    __slots__ = ("depth", "then", "else_")
+
+    def __init__(self, depth: int, then: "Node", else_: "Node"):
+        self.depth = depth
+        self.then = then
+        self.else_ = else_
+
+
+class ShapeSwitch:
+    __slots__ = ("path", "branches", "default")
+
+    def __init__(self, path: Path, branches: Dict[Hashable, "Node"], default: "Node"):
+        self.path = path
+        self.branches = branches
+        self.default = default
+
+
+Node = Optional[object]  # Leaf, DepthTest, ShapeSwitch or `None` for no match
+
+
+class _CannotCompile(Exception):
+    pass
+
+
+def shape_key(value: Value) -> Hashable:
+    """
+    The key a value is switched on, `None` if no pattern can match it
+    """
+    tag = value.tag
+    if tag == "vec":
+        return ("vec", len(value.values))  # type: ignore
+    elif tag == "atom" or tag == "int" or tag == "str":
+        return value
+    else:
+        return None
+
+
+def _compile_arm(index: int, pattern: Value) -> _Arm:
+    if not isinstance(pattern, Vec):
+        raise _CannotCompile
+    shapes: List[Tuple[Path, Hashable]] = []
+    captures: List[Tuple[int, Path]] = []
+    variables: List[Tuple[str, Path]] = []
+
+    # The same traversal as `prelude._matches`: last element first, depth first
+    def visit(element: Value, path: Path):
+        if isinstance(element, Vec):
+            shapes.append((path, ("vec", len(element.values))))
+            for i in reversed(range(len(element.values))):
+                visit(element.values[i], (*path, i))
+        elif isinstance(element, Atom):
+            label = element.value
+            if label == "_":
+                pass
+            elif label.startswith(":"):
+                shapes.append((path, Atom(label[1:])))
+            elif label and frozenset(label) == {"."}:
+                captures.append((len(label), path))
+            elif label[:1] == "." and all(map("0123456789".__contains__, label[1:])):
+                captures.append((int(label[1:]), path))
+            elif label[:1] == "." or not label:
+                raise _CannotCompile
+            else:
+                variables.append((label, path))
+        elif element.tag == "int" or element.tag == "str":
+            shapes.append((path, element))
+        else:
+            raise _CannotCompile
+
+    depth = len(pattern.values)
+    for position in range(depth):
+        visit(pattern.values[depth - 1 - position], (position,))
+
+    names = [name for name, _ in variables]
+    if len(set(names)) != len(names):
+        raise _CannotCompile
+
+    # `prelude._matches` sorts captures by slot, then pushes the deepest slot first
+    captures.sort(key=itemgetter(0), reverse=True)
+    return _Arm(index, depth, depth, shapes, [path for _, path in reversed(captures)], variables)
+
+
+def _build(arms: List[_Arm], counter: List[int]) -> Node:
+    counter[0] += 1
+    if counter[0] > MAX_NODES:
+        raise _CannotCompile
+    if not arms:
+        return None
+
+    first = arms[0]
+    if first.depth:
+        depth = first.depth
+        then = [arm.without(0, arm.shapes) if arm.depth <= depth else arm for arm in arms]
+        else_ = [arm for arm in arms if arm.depth < depth]
+        return DepthTest(depth, _build(then, counter), _build(else_, counter))
+
+    if not first.shapes:
+        return Leaf(first)
+
+    path = first.shapes[0][0]
+    keys: List[Hashable] = []
+    default: List[_Arm] = []
+    for arm in arms:
+        key = next((key for p, key in arm.shapes if p == path), _NO_KEY)
+        if key is _NO_KEY:
+            default.append(arm)
+        elif key not in keys:
+            keys.append(key)
+
+    branches: Dict[Hashable, Node] = {}
+    for key in keys:
+        branch: List[_Arm] = []
+        for arm in arms:
+            arm_key = next((k for p, k in arm.shapes if p == path), _NO_KEY)
+            if arm_key is _NO_KEY:
+                branch.append(arm)
+            elif arm_key == key:
+                branch.append(arm.without(arm.depth, [(p, k) for p, k in arm.shapes if p != path]))
+        branches[key] = _build(branch, counter)
+    return ShapeSwitch(path, branches, _build(default, counter))
+
+
+_NO_KEY = object()
+
+
+class CaseMatcher:
+    """
+    Decision tree for the patterns of a `case`
+    """
+    __slots__ = ("root", "depth")
+
+    def __init__(self, patterns: Sequence[Value]):
+        arms = [_compile_arm(i, pattern) for i, pattern in enumerate(patterns)]
+        self.depth = max((arm.size for arm in arms), default=0)
+        self.root = _build(arms, [0])
+
+    def match(self, stack: Stack) -> Optional[Tuple[int, Stack, List[Tuple[str, Value]]]]:
+        """
+        Find the first arm matching the stack
+
+        Return the index of the arm, the stack with the matched values
+        replaced by the captures, and the values of the variables.
+        """
+        items: List[Value] = []
+        tails: List[Stack] = [stack]
+        rest = stack
+        for _ in range(self.depth):
+            if rest is None:
+                break
+            (value, rest) = rest  # type: ignore
+            items.append(value)
+            tails.append(rest)
+
+        node = self.root
+        while True:
+            if node is None:
+                return None
+            cls = node.__class__
+            if cls is ShapeSwitch:
+                path = node.path  # type: ignore
+                value = items[path[0]]
+                for i in path[1:]:
+                    value = value.values[i]  # type: ignore
+                node = node.branches.get(shape_key(value), node.default)  # type: ignore
+            elif cls is DepthTest:
+                node = node.then if len(items) >= node.depth else node.else_  # type: ignore
+            else:
+                break
+
+        leaf: Leaf = node  # type: ignore
+        new_stack = tails[leaf.size]
+        for path in leaf.captures:
+            new_stack = (_get(items, path), new_stack)
+        variables = [(name, _get(items, path)) for name, path in leaf.variables]
+        return leaf.arm, new_stack, variables
+
+
+def _get(items: List[Value], path: Path) -> Value:
+    value = items[path[0]]
+    for i in path[1:]:
+        value = value.values[i]  # type: ignore
+    return value
+
+
+# Matchers are cached by the patterns, and by the identity of the patterns.
+# Engines that push the same vector every time a pattern is evaluated (see
+# `PUT_VEC` in `bytecode.py`) never have to hash them.
+_CACHE_SIZE = 1024
+_cache: Dict[Tuple[Value, ...], Optional[CaseMatcher]] = {}
+_identity_cache: Dict[Tuple[int, ...], Tuple[Tuple[Value, ...], Optional[CaseMatcher]]] = {}
+
+
+def compile_case(patterns: Sequence[Value]) -> Optional[CaseMatcher]:
+    """
+    Get the matcher for a sequence of patterns, compiling it if necessary
+
+    Return `None` if the patterns have to be interpreted, for example
+    because one of them is invalid and `case` has to report it.
+    """
+    ids = tuple(map(id, patterns))
+    entry = _identity_cache.get(ids)
+    if entry is not None and all(map(operator.is_, entry[0], patterns)):
+        return entry[1]
+
+    key = tuple(patterns)
+    try:
+        matcher = _cache[key]
+    except KeyError:
+        try:
+            matcher = CaseMatcher(patterns)
+        except _CannotCompile:
+            matcher = None
+        _remember(_cache, key, matcher)
+    except TypeError:
+        return None  # an unhashable value in a pattern
+
+    _remember(_identity_cache, ids, (key, matcher))
+    return matcher
+
+
+def _remember(cache: dict, key: object, value: object):
+    if len(cache) >= _CACHE_SIZE:
+        cache.pop(next(iter(cache)))
+    cache[key] = value
@@ -1,3 +1,4 @@
+import asyncio
 import dataclasses
 import time
 from operator import itemgetter
@@ -7,6 +8,8 @@ from gurklang.types import *  # type: ignore
 from . import stdlib_modules
 from . import vm
 from .builtin_utils import BuiltinModule, Fail, Module, make_simple, raw_function
+from .pattern_matching import compile_case
+from .resolver import detach
 from .vm_utils import stringify_value, render_value_as_source, tuple_equals
 
 module = BuiltinModule("builtins")
@@ -17,104 +20,104 @@ T, V, S = Tuple, Value, Stack
 
 # <`stack` functions>
 
-@module.register_simple()
+@module.register_simple(effect="x -- x x")
 def dup(stack: T[V, S], fail: Fail):
     (x, rest) = stack
     return (x, (x, rest))
 
 
-@module.register_simple()
+@module.register_simple(effect="x --")
 def drop(stack: T[V, S], fail: Fail):
     (x, rest) = stack
     return rest
 
 
-@module.register_simple()
+@module.register_simple(effect="y x -- x y")
 def swap(stack: T[V, T[V, S]], fail: Fail):
     (x, (y, rest)) = stack
     return (y, (x, rest))
 
 
-@module.register_simple()
+@module.register_simple(effect="y x -- y x y")
 def tuck(stack: T[V, T[V, S]], fail: Fail):
     (x, (y, rest)) = stack
     return (y, (x, (y, rest)))
 
 
-@module.register_simple()
+@module.register_simple(effect="x y z -- y z x")
 def rot(stack: T[V, T[V, T[V, S]]], fail: Fail):
     (z, (y, (x, rest))) = stack
     return (x, (z, (y, rest)))
 
 
-@module.register_simple()
+@module.register_simple(effect="x y z -- z x y")
 def unrot(stack: T[V, T[V, T[V, S]]], fail: Fail):
     (z, (y, (x, rest))) = stack
     return (y, (x, (z, rest)))
 
 
 
-@module.register_simple()
+@module.register_simple(effect="x y -- y")
 def nip(stack: T[V, T[V, S]], fail: Fail):
     (y, (x, rest)) = stack
     return (y, rest)
 
 
-@module.register_simple()
+@module.register_simple(effect="x y -- x y x")
 def over(stack: T[V, T[V, S]], fail: Fail):
     (y, (x, rest)) = stack
     return (x, (y, (x, rest)))
 
 
-@module.register_simple('2dup')
+@module.register_simple('2dup', effect="x y -- x y x y")
 def two_dup(stack: T[V, T[V, S]], fail: Fail):
     y, (x, rest) = stack
     return (y, (x, (y, (x, rest))))
 
 
-@module.register_simple('2drop')
+@module.register_simple('2drop', effect="x y --")
 def two_drop(stack: T[V, T[V, S]], fail: Fail):
     (x, rest) = stack
     return rest[1]
 
 
-@module.register_simple('2swap')
+@module.register_simple('2swap', effect="d c b a -- b a d c")
 def two_swap(stack: T[V, T[V, T[V, T[V, S]]]], fail: Fail):
     (a, (b, (c, (d, rest)))) = stack
     return (c, (d, (a, (b, rest))))
 
 
-@module.register_simple('2tuck')
+@module.register_simple('2tuck', effect="d c b a -- d c b a d c")
 def two_tuck(stack: T[V, T[V, T[V, T[V, S]]]], fail: Fail):
     (a, (b, (c, (d, rest)))) = stack
     return (c, (d, (a, (b, (c, (d, rest))))))
 
 
-@module.register_simple('2rot')
+@module.register_simple('2rot', effect="f e d c b a -- b a f e d c")
 def two_rot(stack: T[V, T[V, T[V, T[V, T[V, T[V, S]]]]]], fail: Fail):
     (a, (b, (c, (d, (e, (f, rest)))))) = stack
     return (c, (d, (e, (f, (a, (b, rest))))))
 
 
-@module.register_simple('2unrot')
+@module.register_simple('2unrot', effect="f e d c b a -- d c b a f e")
 def two_unrot(stack: T[V, T[V, T[V, T[V, T[V, T[V, S]]]]]], fail: Fail):
     (a, (b, (c, (d, (e, (f, rest)))))) = stack
     return (e, (f, (a, (b, (c, (d, rest))))))
 
 
-@module.register_simple('2nip')
+@module.register_simple('2nip', effect="d c b a -- b a")
 def two_nip(stack: T[V, T[V, T[V, T[V, S]]]], fail: Fail):
     (a, (b, (_, (_, rest)))) = stack
     return (a, (b, rest))
 
 
-@module.register_simple('2over')
+@module.register_simple('2over', effect="d c b a -- d c b a d c")
 def two_over(stack: T[V, T[V, T[V, T[V, S]]]], fail: Fail):
     (a, (b, (c, (d, rest)))) = stack
     return (c, (d, (a, (b, (c, (d, rest))))))
 
 
-@module.register_simple()
+@module.register_simple(effect="b:str a:str -- c:str")
 def concat(stack: T[V, T[V, S]], fail: Fail):
     (a, (b, rest)) = stack
     if a.tag != "str" or b.tag != "str":
@@ -163,19 +166,19 @@ def equals(stack: T[V, T[V, S]], fail: Fail):
     elif x.tag == "atom":
         fail(f"cannot compare atoms. Use `is` instead")
     elif x.tag in ("str", "int", "code") and x == y:
-        return (Atom("true"), rest)
+        return (TRUE, rest)
     elif x.tag == "vec" and y.tag == "vec":
         return (Atom.bool(tuple_equals(x, y, fail)), rest)
-    return (Atom("false"), rest)
+    return (FALSE, rest)
 
 
 @module.register_simple("not")
 def not_(stack: T[V, S], fail: Fail):
     (head, rest) = stack
-    if head is Atom("true"):
-        return (Atom("false"), rest)
-    elif head is Atom("false"):
-        return (Atom("true"), rest)
+    if head is TRUE:
+        return (FALSE, rest)
+    elif head is FALSE:
+        return (TRUE, rest)
     else:
         fail(f"{render_value_as_source(head)} is not a boolean")
 
@@ -198,12 +201,25 @@ def print_string(stack: T[V, S], fail: Fail):
     return rest
 
 
-@module.register_simple("input")
+async def _input_async(stack: Stack, fail: Fail):
+    text = await asyncio.get_running_loop().run_in_executor(None, input)
+    return (Str(text), stack)
+
+
+@module.register_simple("input", asynchronous=_input_async)
 def input_(stack: Stack, fail: Fail):
     return (Str(input()), stack)
 
 
-@module.register_simple()
+async def _prompt_async(stack: T[V, S], fail: Fail):
+    (head, rest) = stack
+    if head.tag != "str":
+        fail(f"{head} is not a string")
+    text = await asyncio.get_running_loop().run_in_executor(None, input, f"{head.value} ")
+    return (Str(text), rest)
+
+
+@module.register_simple(asynchronous=_prompt_async)
 def prompt(stack: T[V, S], fail: Fail):
     (head, rest) = stack
     if head.tag != "str":
@@ -212,16 +228,25 @@ def prompt(stack: T[V, S], fail: Fail):
     return (text, rest)
 
 
-@module.register_simple()
+def _duration(value: Value, fail: Fail) -> float:
+    if value.tag == "int":
+        return value.value
+    elif value.tag == "vec" and len(value.values) == 2 and value.values[0].tag == "int" and value.values[1].tag == "int":
+        return value.values[0].value / value.values[1].value
+    else:
+        fail(f"Invalid duration: {value}")
+
+
+async def _sleep_async(stack: T[V, S], fail: Fail):
+    (head, rest) = stack
+    await asyncio.sleep(_duration(head, fail))
+    return rest
+
+
+@module.register_simple(asynchronous=_sleep_async)
 def sleep(stack: T[V, S], fail: Fail):
     (head, rest) = stack
-    if head.tag == "int":
-        sleep_time = head.value
-    elif head.tag == "vec" and len(head.values) == 2 and head.values[0].tag == "int" and head.values[1].tag == "int":
-        sleep_time: float = head.values[0].value / head.values[1].value
-    else:
-        fail(f"Invalid duration: {head}")
-    time.sleep(sleep_time)
+    time.sleep(_duration(head, fail))
     return rest
 
 
@@ -230,7 +255,12 @@ def parent_scope(stack: T[V, S], fail: Fail):
     (code, rest) = stack
     if code.tag != "code":
         fail(f"Expected code value, got: {code}")
-    new_code = dataclasses.replace(code, flags=code.flags | CodeFlags.PARENT_SCOPE)
+    code.introduce()
+    new_code = dataclasses.replace(
+        code,
+        flags=code.flags | CodeFlags.PARENT_SCOPE,
+        instructions=detach(code.instructions),
+    )
     return (new_code, rest)
 
 
@@ -247,9 +277,9 @@ module.add("!", Code([CallByValue()], closure=None, name="!", flags=CodeFlags.PA
 @module.register_simple("if")
 def if_(stack: T[V, T[V, T[V, S]]], fail: Fail):
     (else_, (then, (condition, rest))) = stack
-    if condition is Atom("true"):
+    if condition is TRUE:
         return (then, rest)
-    elif condition is Atom("false"):
+    elif condition is FALSE:
         return (else_, rest)
     else:
         fail(f"{condition} is not a boolean (:true/:false)")
@@ -257,12 +287,16 @@ def if_(stack: T[V, T[V, T[V, S]]], fail: Fail):
 
 # <`,` implementation>
 
+_VEC_SENTINEL = Atom("{, sentinel}")
+_STACK_SENTINEL = Atom("{] sentinel}")
+
+
 @make_simple()
 def __spread_vec(stack: T[V, S], fail: Fail):
     (fn, rest) = stack
     if fn.tag not in ["code", "native"]:
         fail(f"{fn} is not a function")
-    sentinel = Atom("{, sentinel}")
+    sentinel = _VEC_SENTINEL
     instructions = [Put(sentinel), Put(fn), CallByValue()]
     code = Code(instructions, closure=None, flags=CodeFlags.PARENT_SCOPE, name="--spreader")
     return (code, rest)
@@ -271,7 +305,7 @@ def __spread_vec(stack: T[V, S], fail: Fail):
 @make_simple()
 def __collect_vec(stack: T[V, S], fail: Fail):
     head, stack = stack  # type: ignore
-    sentinel = Atom("{, sentinel}")
+    sentinel = _VEC_SENTINEL
     elements = []
     while head is not sentinel:
         elements.append(head)
@@ -297,7 +331,7 @@ def __spread_list(stack: T[V, S], fail: Fail):
     (fn, rest) = stack
     if fn.tag not in ["code", "native"]:
         fail(f"{fn} is not a function")
-    sentinel = Atom("{] sentinel}")
+    sentinel = _STACK_SENTINEL
     instructions = [Put(sentinel), Put(fn), CallByValue()]
     code = Code(instructions, closure=None, flags=CodeFlags.PARENT_SCOPE, name="--spreader")
     return (code, rest)
@@ -306,7 +340,7 @@ def __spread_list(stack: T[V, S], fail: Fail):
 @make_simple()
 def __collect_list(stack: T[V, S], fail: Fail):
     head, stack = stack  # type: ignore
-    sentinel = Atom("{] sentinel}")
+    sentinel = _STACK_SENTINEL
     rv = Vec(())
     while head is not sentinel:
         rv = Vec((head, rv))
@@ -338,7 +372,12 @@ def close(stack: T[V, T[V, S]], fail: Fail):
         rv = Code([Put(value), *function.instructions], closure=function.closure, name=function.name,
                   flags=function.flags, finalizer=function.finalizer, introducer=function.introducer)
     elif function.tag == "native":
-        rv = NativeFunction(lambda state: function.fn(state.push(value)), function.name)  # type: ignore
+        stack_fn = function.stack_fn
+        rv = NativeFunction(
+            lambda state: function.fn(state.push(value)),  # type: ignore
+            function.name,
+            stack_fn=None if stack_fn is None else lambda stack: stack_fn((value, stack)),
+        )
     else:
         fail(f"{function} is not a function")
 
@@ -347,6 +386,8 @@ def close(stack: T[V, T[V, S]], fail: Fail):
 
 # <`case` implementation>
 
+_CASE_SENTINEL = Atom('{case sentinel}')
+
 
 Captures = Optional[Tuple[Iterable[Tuple[int, Value]], Dict[str, Value]]]
 
@@ -386,7 +427,7 @@ def _match_with_atom(pattern: Atom, value: Value, fail: Fail) -> Captures:
     elif label[0] == ".":
         fail(f"Invalid . pattern: {label}")
     else:
-        return [], {label: Code([Put(value)], closure=None)}
+        return [], {label: value}
 
 
 def _matches_impl(pattern: Value, value: Value, fail: Fail) -> Captures:
@@ -428,7 +469,7 @@ def _stack_extend(stack: Stack, elems: Iterable[Value]) -> Stack:
 
 
 def _parse_cases(stack: Stack, fail: Fail) -> Tuple[Stack, Sequence[Value], Sequence[Value]]:
-    sentinel = Atom('{case sentinel}')
+    sentinel = _CASE_SENTINEL
     patterns = []
     actions = []
     is_pattern = False
@@ -443,9 +484,26 @@ def _parse_cases(stack: Stack, fail: Fail) -> Tuple[Stack, Sequence[Value], Sequ
     return stack, patterns, actions
 
 
+def _check_actions(actions: Sequence[Value], fail: Fail):
+    for action in actions:
+        if action.tag != "code":
+            fail(f'an action must be code, not {action!r}')
+
+
 @make_simple()
 def __match_case(stack: Stack, fail: Fail):
     stack, patterns, actions = _parse_cases(stack, fail)
+
+    matcher = compile_case(patterns)
+    if matcher is not None:
+        matched_arm = matcher.match(stack[1])  # type: ignore
+        if matched_arm is None:
+            _check_actions(actions, fail)
+            return stack
+        arm, new_stack, variables = matched_arm
+        _check_actions(actions[:arm + 1], fail)
+        return (_bind_variables(actions[arm], variables), new_stack)  # type: ignore
+
     for pattern, action in zip(patterns, actions):
         if pattern.tag != "vec":
             fail(f'a pattern must be a vector, not {pattern!r}')
@@ -458,25 +516,41 @@ def __match_case(stack: Stack, fail: Fail):
             continue
 
         new_stack, new_variables = matched
-        insns = list(action.instructions)
-        for k, v in new_variables.items():
-            insns[:0] = [Put(v), CallByValue(), Put(Atom(k)), Put(def_), CallByValue()]
-        action.introduce()
-        action = Code(
-            instructions=insns,
-            closure=action.closure,
-            flags=action.flags,
-            source_code=action.source_code,
-            finalizer=action.finalizer,
-            introducer=action.introducer
-        )
-        return (action, new_stack)
+        return (_bind_variables(action, [*new_variables.items()]), new_stack)  # type: ignore
     return stack
 
 
+def _bind_variables(action: Code, variables: Sequence[Tuple[str, Value]]) -> Code:
+    if not variables:
+        return action
+
+    if not (action.flags & CodeFlags.PARENT_SCOPE or action.closure is None):
+        # The action gets its own scope, so the variables can be defined
+        # there as soon as it's created
+        bindings = Map() if action.bindings is None else action.bindings
+        return action.with_bindings(bindings.update({
+            k: Code([Put(v)], closure=None, flags=CodeFlags.PARENT_SCOPE)
+            for k, v in variables
+        }))
+
+    # Otherwise they are defined in the caller's scope, like `def` would
+    insns = list(action.instructions)
+    for k, v in variables:
+        insns[:0] = [Put(Code([Put(v)], closure=None)), CallByValue(), Put(Atom(k)), Put(def_), CallByValue()]
+    action.introduce()
+    return Code(
+        instructions=insns,
+        closure=action.closure,
+        flags=action.flags,
+        source_code=action.source_code,
+        finalizer=action.finalizer,
+        introducer=action.introducer
+    )
+
+
 @make_simple()
 def __get_case(stack: T[V, S], fail: Fail):
-    sentinel = Atom('{case sentinel}')
+    sentinel = _CASE_SENTINEL
     fun, rest = stack
     return (fun, (sentinel, rest))
 
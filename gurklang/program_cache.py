@@ -0,0 +1,122 @@
+"""
+Cache of parsed programs on disk
+
+Tokenizing takes most of the time it takes to start a big program. `parse`
+keeps the instructions made by `optimizer.parse` in a cache directory, keyed
+by a hash of the source and of the interpreter, so a program that didn't
+change since the last run is loaded without tokenizing it. The interpreter's
+part of the key hashes the Python version and the modules that decide what
+instructions a program becomes, including the standard library modules whose
+exports the resolver relies on, so changing any of them misses the cache.
+
+The cache lives in `GURKLANG_CACHE_DIR`, `~/.cache/gurklang` by default.
+Setting `GURKLANG_CACHE_DIR` to an empty string turns it off. The last
+`MEMORY_SIZE` programs are also kept in memory, so importing a Gurklang
+module again doesn't even read the cache.
+"""
+import contextlib
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional
+
+from . import optimizer, serialization
+from .types import Instruction
+
+_COMPILER_MODULES = (
+    "parser_utils", "parser", "ast_parser", "resolver", "optimizer", "types", "serialization", "builtin_utils",
+)
+
+MEMORY_SIZE = 256
+
+# Least recently used first
+_memory: "OrderedDict[str, List[Instruction]]" = OrderedDict()
+_memory_lock = threading.Lock()
+_interpreter_hash: Optional[str] = None
+
+
+def cache_dir() -> Optional[Path]:
+    path = os.environ.get("GURKLANG_CACHE_DIR")
+    if path is None:
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return Path(cache_home) / "gurklang"
+    return Path(path) if path else None
+
+
+def interpreter_hash() -> str:
+    global _interpreter_hash
+    if _interpreter_hash is None:
+        digest = hashlib.sha256(sys.version.encode())
+        package = Path(__file__).resolve().parent
+        paths = [package / f"{name}.py" for name in _COMPILER_MODULES]
+        # Imports and folds depend on what the built-in modules export
+        paths += sorted((package / "stdlib_modules").glob("*.py"))
+        for path in paths:
+            digest.update(path.read_bytes())
+        _interpreter_hash = digest.hexdigest()
+    return _interpreter_hash
+
+
+def source_key(source: str) -> str:
+    digest = hashlib.sha256(interpreter_hash().encode())
+    digest.update(source.encode())
+    return digest.hexdigest()
+
+
+def parse(source: str) -> List[Instruction]:
+    """
+    Parse a program like `optimizer.parse`, going through the cache
+    """
+    key = source_key(source)
+    with _memory_lock:
+        instructions = _memory.get(key)
+    if instructions is None:
+        instructions = _load(key)
+    if instructions is None:
+        instructions = optimizer.parse(source)
+        _store(key, instructions)
+    with _memory_lock:
+        _memory[key] = instructions
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_SIZE:
+            _memory.popitem(last=False)
+    return list(instructions)
+
+
+def _load(key: str) -> Optional[List[Instruction]]:
+    directory = cache_dir()
+    if directory is None:
+        return None
+    try:
+        data = (directory / f"{key}.pickle").read_bytes()
+    except OSError:
+        return None
+    try:
+        return serialization.loads(data)
+    except Exception:
+        # A truncated or corrupt entry is parsed and written again
+        return None
+
+
+def _store(key: str, instructions: List[Instruction]):
+    directory = cache_dir()
+    if directory is None:
+        return
+    try:
+        data = serialization.dumps(instructions)
+        directory.mkdir(parents=True, exist_ok=True)
+        # Another process never sees half an entry, since it's renamed when it's written
+        (fd, temporary) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    except (OSError, serialization.SerializationError):
+        return
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temporary, directory / f"{key}.pickle")
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(temporary)
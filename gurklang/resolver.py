@@ -0,0 +1,357 @@
+"""
+Lexical addressing
+
+`compile` turns the AST of a program (see `ast_parser.py`) into the same
+instructions as `parser.parse`, except that a `CallByName` of a name defined
+by an enclosing code literal gets an `Address`: the number of scopes between
+the call and the literal. `Machine.look_up_address` goes straight to that
+scope instead of searching every scope on the way.
+
+A code literal defines a name if its top level has:
+- `:name def` or `:name jar`
+- `:module (name ...) import`, `:module :qual import`, `:module :as:name import`
+  or `:module :all import` of a built-in module
+The action of a `case` arm defines the names captured by its pattern.
+
+`:prefix` imports make a literal opaque: names used under it are looked up
+by walking the scopes, unless a closer literal defines them. If a program
+could redefine `def`, `jar`, `import`, `forget` or `case`, for example with
+a `def` of a name that isn't a literal, nothing is resolved.
+
+A name can still be defined where the resolver can't see it, like by a
+`parent-scope` function, so addresses are checked at run time:
+- Defining a name in a scope where it's already visible marks the name as
+  shadowed (see `types.note_definitions`), and a shadowed name is always
+  looked up by walking the scopes.
+- A call only gets an address if the scopes between it and the literal that
+  defines the name can't exist before the name is defined. A definition in
+  one of those scopes is then always a shadowing one.
+- Code that runs in another scope than its closure, like code passed to
+  `parent-scope`, loses the addresses that point outside of it, see `detach`.
+"""
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .ast_parser import (
+    ASTNode, AtomLiteral, CodeLiteral, IntLiteral, NameCall, StrLiteral, VecLiteral, parse_as_ast,
+)
+from .builtin_utils import BuiltinModule
+from .types import Address, Atom, CallByName, Instruction, Int, LexicalName, MakeVec, Put, PutCode, Str
+
+# Words that have to be the ones from the prelude for the resolver to work
+CORE_WORDS = frozenset(("def", "jar", "import", "forget", "case"))
+
+
+class _Literal:
+    __slots__ = ("node", "parent", "position", "definitions", "sources", "opaque")
+
+    def __init__(self, node: CodeLiteral, parent: Optional["_Literal"], position: int):
+        self.node = node
+        self.parent = parent
+        # Index of the node holding the literal in the parent's nodes
+        self.position = position
+        # Defined names, with the index of the call that defines them,
+        # or -1 if they're defined before the literal runs
+        self.definitions: Dict[str, int] = {}
+        # The built-in module that every definition of a name imports it
+        # from, or `None` if some definition doesn't
+        self.sources: Dict[str, Optional[str]] = {}
+        self.opaque = False
+
+
+def parse(source: str) -> List[Instruction]:
+    """
+    Parse a program like `parser.parse` and resolve its names
+    """
+    return compile(parse_as_ast(source))
+
+
+def compile(program: CodeLiteral) -> List[Instruction]:
+    addresses = resolve(program)
+    return list(_emit_code(program.nodes, addresses))
+
+
+def resolve(program: CodeLiteral) -> Dict[int, Address]:
+    """
+    Find the addresses of the names called by a program
+
+    The addresses are keyed by the `id` of the `NameCall` nodes.
+    """
+    analysis = _analyze(program)
+    if analysis is None:
+        return {}
+    addresses: Dict[int, Address] = {}
+    for call, literal, _ in analysis[1]:
+        binding = _binding(call.value, literal)
+        if binding is not None:
+            addresses[id(call)] = Address(binding[2], LexicalName.get(call.value))
+    return addresses
+
+
+def find_builtin_calls(program: CodeLiteral) -> Dict[int, str]:
+    """
+    Find the calls that can only call a built-in function
+
+    Maps the `id` of the `NameCall` nodes to the module the function is
+    imported from, or to "prelude" if the program never defines the name.
+    Nothing is found if the program calls `forget`, or `case` with arms that
+    aren't a code literal, since they could define any name.
+    """
+    analysis = _analyze(program)
+    if analysis is None:
+        return {}
+    (literals, calls) = analysis
+    if any(call.value == "forget" for call, _, _ in calls):
+        return {}
+    if any(call.value == "case" and _case_arms(literal.node.nodes, index) is None for call, literal, index in calls):
+        # The patterns of a `case` that isn't a literal could capture any name
+        return {}
+
+    sources: Dict[str, Optional[str]] = {}
+    for literal in literals.values():
+        for name, source in literal.sources.items():
+            if sources.setdefault(name, source) != source:
+                sources[name] = None
+
+    builtin_calls: Dict[int, str] = {}
+    for call, literal, index in calls:
+        name = call.value
+        if name not in sources:
+            # A name with a dot could come from a `:prefix` import
+            if "." not in name:
+                builtin_calls[id(call)] = "prelude"
+            continue
+        source = sources[name]
+        binding = _binding(name, literal)
+        if source is None or binding is None:
+            continue
+        (_, definition, depth) = binding
+        if depth > 0 or definition < index:
+            builtin_calls[id(call)] = source
+    return builtin_calls
+
+
+def detach(instructions: Sequence[Instruction], level: int = 0) -> Sequence[Instruction]:
+    """
+    Drop the addresses that point outside of the code
+
+    The code can then run in any scope.
+    """
+    detached: List[Instruction] = []
+    for instruction in instructions:
+        if instruction.tag == "call" and instruction.address is not None and instruction.address.depth > level:
+            instruction = CallByName(instruction.function_name)
+        elif instruction.tag == "put_code":
+            inner = detach(instruction.instructions, level + 1)
+            if inner is not instruction.instructions:
+                instruction = PutCode(inner, instruction.source_code)
+        detached.append(instruction)
+    if all(a is b for a, b in zip(detached, instructions)):
+        return instructions
+    return detached
+
+
+_Calls = List[Tuple[NameCall, _Literal, int]]
+
+
+def _analyze(program: CodeLiteral) -> Optional[Tuple[Dict[int, _Literal], _Calls]]:
+    """
+    Find the literals of a program with their definitions, and the calls
+    with their literals and indices
+
+    Returns `None` if the program could redefine a core word.
+    """
+    literals: Dict[int, _Literal] = {}
+    calls: _Calls = []
+    _collect(program, None, 0, literals, calls)
+    for literal in literals.values():
+        if not _find_definitions(literal, literals):
+            return None
+    return (literals, calls)
+
+
+def _collect(
+    node: CodeLiteral,
+    parent: Optional[_Literal],
+    position: int,
+    literals: Dict[int, _Literal],
+    calls: _Calls,
+):
+    literal = literals[id(node)] = _Literal(node, parent, position)
+    for i, child in enumerate(node.nodes):
+        if isinstance(child, NameCall):
+            calls.append((child, literal, i))
+        for code in _code_literals(child):
+            _collect(code, literal, i, literals, calls)
+
+
+def _code_literals(node: ASTNode) -> Iterator[CodeLiteral]:
+    if isinstance(node, CodeLiteral):
+        yield node
+    elif isinstance(node, VecLiteral):
+        for child in node.nodes:
+            yield from _code_literals(child)
+
+
+def _find_definitions(literal: _Literal, literals: Dict[int, _Literal]) -> bool:
+    """
+    Fill in the definitions of a literal
+
+    Return `False` if the literal could redefine a core word.
+    """
+    nodes = literal.node.nodes
+    for i, node in enumerate(nodes):
+        if not isinstance(node, NameCall):
+            continue
+        if node.value in ("def", "jar"):
+            operand = nodes[i - 1] if i >= 1 else None
+            if not isinstance(operand, AtomLiteral):
+                return False
+            names: Sequence[str] = (operand.value,)
+            source = None
+        elif node.value == "import":
+            if i < 2:
+                return False
+            (module, options) = nodes[i - 2:i]
+            imported = _imported_names(module, options)
+            if imported is None:
+                literal.opaque = True
+                continue
+            names = imported
+            # Other imports define module getters, not the functions
+            imports_functions = isinstance(options, VecLiteral) or options == AtomLiteral("all")
+            source = module.value if imports_functions and isinstance(module, AtomLiteral) else None
+        elif node.value == "case":
+            _find_captures(_case_arms(nodes, i) or (), literals)
+            continue
+        else:
+            continue
+        if CORE_WORDS.intersection(names):
+            return False
+        for name in names:
+            literal.definitions.setdefault(name, i)
+            if literal.sources.setdefault(name, source) != source:
+                literal.sources[name] = None
+    return True
+
+
+def _imported_names(module: ASTNode, options: ASTNode) -> Optional[Sequence[str]]:
+    """
+    Names defined by an import, or `None` if they aren't known
+
+    If the import could define anything, all core words are returned.
+    """
+    if isinstance(options, VecLiteral):
+        if all(isinstance(name, AtomLiteral) for name in options.nodes):
+            return [name.value for name in options.nodes]  # type: ignore
+        return CORE_WORDS
+    if not isinstance(options, AtomLiteral):
+        return CORE_WORDS
+    if options.value == "qual" and isinstance(module, AtomLiteral):
+        return (module.value,)
+    if options.value.startswith("as:"):
+        return (options.value[len("as:"):],)
+    if options.value == "prefix" or options.value.startswith("prefix:"):
+        # Prefixed names have a dot, so they can't be core words
+        return None
+    if options.value == "all" and isinstance(module, AtomLiteral):
+        from .stdlib_modules import modules
+        for m in modules:
+            # A Gurklang module can define more names than it exports
+            if m.name == module.value and isinstance(m, BuiltinModule):
+                return m.exports
+    return CORE_WORDS
+
+
+def _case_arms(nodes: Sequence[ASTNode], index: int) -> Optional[List[Tuple[VecLiteral, CodeLiteral]]]:
+    """
+    The patterns and actions of the `case` called at `nodes[index]`, or
+    `None` if they aren't a code literal of vector and code literals
+    """
+    block = nodes[index - 1] if index >= 1 else None
+    if not isinstance(block, CodeLiteral) or len(block.nodes) % 2 != 0:
+        return None
+    arms = list(zip(block.nodes[::2], block.nodes[1::2]))
+    for pattern, action in arms:
+        if not isinstance(pattern, VecLiteral) or not isinstance(action, CodeLiteral):
+            return None
+    return arms  # type: ignore
+
+
+def _find_captures(arms: Sequence[Tuple[VecLiteral, CodeLiteral]], literals: Dict[int, _Literal]):
+    """
+    Define the variables of `case` patterns in their actions
+    """
+    for pattern, action in arms:
+        action_literal = literals[id(action)]
+        for name in _pattern_variables(pattern):
+            action_literal.definitions[name] = -1
+            action_literal.sources[name] = None
+
+
+def _pattern_variables(pattern: VecLiteral) -> Iterator[str]:
+    # See `prelude._match_with_atom`
+    for node in pattern.nodes:
+        if isinstance(node, VecLiteral):
+            yield from _pattern_variables(node)
+        elif isinstance(node, AtomLiteral):
+            label = node.value
+            if label != "_" and not label.startswith(":") and not label.startswith("."):
+                yield label
+
+
+def _binding(name: str, literal: _Literal) -> Optional[Tuple[_Literal, int, int]]:
+    """
+    Find the literal that defines a name for a call in `literal`, with the
+    index of the definition and the depth of the literal
+    """
+    depth = 0
+    position = 0
+    current: Optional[_Literal] = literal
+    while current is not None:
+        index = current.definitions.get(name)
+        if index is not None:
+            if depth == 0 or _defined_before(current, index, position):
+                return (current, index, depth)
+            return None
+        if current.opaque:
+            return None
+        position = current.position
+        current = current.parent
+        depth += 1
+    return None
+
+
+def _defined_before(literal: _Literal, index: int, position: int) -> bool:
+    """
+    Check if the definition at `index` runs before the code literal at
+    `position` can be called
+    """
+    if index < position:
+        return True
+    between = literal.node.nodes[position + 1:index]
+    return not any(isinstance(node, NameCall) for node in between)
+
+
+def _emit_code(nodes: Sequence[ASTNode], addresses: Dict[int, Address]) -> Iterator[Instruction]:
+    for node in nodes:
+        if isinstance(node, NameCall):
+            yield CallByName(node.value, addresses.get(id(node)))
+        else:
+            yield from _emit_value(node, addresses)
+
+
+def _emit_value(node: ASTNode, addresses: Dict[int, Address]) -> Iterator[Instruction]:
+    if isinstance(node, IntLiteral):
+        yield Put(Int(node.value))
+    elif isinstance(node, StrLiteral):
+        yield Put(Str.interned(node.value))
+    elif isinstance(node, AtomLiteral):
+        yield Put(Atom(node.value))
+    elif isinstance(node, CodeLiteral):
+        yield PutCode(list(_emit_code(node.nodes, addresses)), source_code=node.source_code)
+    elif isinstance(node, VecLiteral):
+        for child in node.nodes:
+            yield from _emit_value(child, addresses)
+        yield MakeVec(len(node.nodes))
+    else:
+        raise TypeError(node)
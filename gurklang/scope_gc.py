@@ -0,0 +1,168 @@
+"""
+Tracing garbage collection of scopes
+
+Reference counting (see `vm.ScopeRefcounts`) kills most scopes as soon as
+they are done, but it depends on `Code.__del__`, and it can't kill a scope
+that holds a function closing over that scope, like a local `jar`. A
+`ScopeCollector` finds the scopes that are still reachable and kills the
+rest, so the scope table of a long-running program stays bounded.
+
+A scope is reachable from:
+- the scope stack
+- the stack and the boxes
+- the instructions that are still going to run, given by the engine
+- the members and the parent of a reachable scope
+
+Values are traced through vectors, functions and the instructions of
+functions. A native function can hold values in its Python closure, so its
+closure and default arguments are traced too.
+
+A collection starts when the scope table reaches the collector's limit.
+The limit is `THRESHOLD` or twice the number of scopes that survived the
+last collection, whichever is larger.
+"""
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from types import FunctionType
+from typing import Callable, Iterable, List, Optional, Set
+
+from immutables import Map
+
+from .types import (
+    ArrayStack, Code, MakeScope, Machine, NativeFunction, Put, PutCode, ScopeStack, Vec,
+)
+
+THRESHOLD = int(os.environ.get("GURKLANG_GC_THRESHOLD", 10_000))
+
+
+@dataclass
+class GcStats:
+    collections: int = 0
+    scopes_collected: int = 0
+    # Scopes that survived the last collection
+    scopes_live: int = 0
+    seconds: float = 0.0
+
+
+# Totals of every collector in the process
+stats = GcStats()
+_stats_lock = threading.Lock()
+
+_CONTAINERS = (tuple, list, deque, set, frozenset)
+
+
+def _scope_ids(scope_stack: ScopeStack) -> Iterable[int]:
+    while scope_stack is not None:
+        yield scope_stack[0]
+        scope_stack = scope_stack[1]
+
+
+class ScopeCollector:
+    def __init__(
+        self,
+        machine: Machine,
+        pinned: Iterable[int] = (),
+        threshold: Optional[int] = None,
+        on_collect: Optional[Callable[[int], None]] = None,
+    ):
+        self.machine = machine
+        self.pinned = tuple(pinned)
+        self.threshold = THRESHOLD if threshold is None else threshold
+        self.limit = self.threshold
+        self.on_collect = on_collect
+        self.stats = GcStats()
+
+    def due(self) -> bool:
+        return len(self.machine.scopes) >= self.limit
+
+    def mark(self, roots: Iterable[object]) -> Set[int]:
+        """
+        Find the ids of the reachable scopes
+        """
+        scopes = self.machine.scopes
+        live: Set[int] = set()
+        seen: Set[int] = set()
+        todo: List[object] = [self.machine.stack, self.machine.boxes, *roots]
+
+        def mark_scope(scope_id: Optional[int]):
+            while scope_id is not None and scope_id not in live and scope_id in scopes:
+                live.add(scope_id)
+                scope = scopes[scope_id]
+                todo.append(scope.values)
+                scope_id = scope.parent
+
+        for scope_id in (*self.pinned, *_scope_ids(self.machine.scope_stack)):
+            mark_scope(scope_id)
+        for (scope_id, scope) in scopes.items():
+            if scope.persistent:
+                mark_scope(scope_id)
+
+        while todo:
+            value = todo.pop()
+            if value is None or type(value) in (int, str) or id(value) in seen:
+                continue
+            seen.add(id(value))
+
+            if isinstance(value, _CONTAINERS):
+                todo.extend(value)
+            elif isinstance(value, (dict, Map)):
+                todo.extend(value.keys())
+                todo.extend(value.values())
+            elif type(value) is Vec:
+                todo.extend(value.values)
+            elif type(value) is ArrayStack:
+                todo.extend(value.items[:value.size])
+            elif type(value) is Code:
+                mark_scope(value.closure)
+                todo.append(value.bindings)
+                todo.append(value.instructions)
+            elif type(value) is Put:
+                todo.append(value.value)
+            elif type(value) is PutCode:
+                todo.append(value.instructions)
+            elif type(value) is MakeScope:
+                mark_scope(value.parent_id)
+                todo.append(value.bindings)
+            elif isinstance(value, NativeFunction):
+                scope_stack = getattr(value, "scope_stack", None)
+                for scope_id in _scope_ids(scope_stack):
+                    mark_scope(scope_id)
+                todo.append(getattr(value, "frame", None))
+                todo.append(value.fn)
+                todo.append(value.stack_fn)
+            elif type(value) is FunctionType:
+                for cell in value.__closure__ or ():
+                    try:
+                        todo.append(cell.cell_contents)
+                    except ValueError:
+                        # The variable isn't assigned yet
+                        pass
+                todo.append(value.__defaults__)
+                todo.append(value.__kwdefaults__)
+
+        return live
+
+    def collect(self, roots: Iterable[object] = ()) -> int:
+        """
+        Kill the unreachable scopes, return how many were killed
+        """
+        start = time.perf_counter()
+        live = self.mark(roots)
+        dead = [scope_id for scope_id in self.machine.scopes.keys() if scope_id not in live]
+        for scope_id in dead:
+            self.machine.kill_scope(scope_id)
+            if self.on_collect is not None:
+                self.on_collect(scope_id)
+        self.limit = max(self.threshold, 2 * len(live))
+        elapsed = time.perf_counter() - start
+
+        for totals in (self.stats, stats):
+            with _stats_lock:
+                totals.collections += 1
+                totals.scopes_collected += len(dead)
+                totals.scopes_live = len(live)
+                totals.seconds += elapsed
+        return len(dead)
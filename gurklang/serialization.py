@@ -0,0 +1,114 @@
+"""
+Serialization of values for sending them to other processes
+
+Values are pickled, with a few exceptions:
+
+- Native functions are sent by the name of the Python module attribute
+  they are stored in, and fail to serialize if they aren't stored in one
+- Code that closes over the global scope is closed over the global scope
+  of the receiving interpreter. Closures over any other scope can't be
+  serialized, since the scope only exists in this interpreter.
+- Boxes can't be serialized, their contents live in the `State`
+
+Stacks are sent as flat lists, so deep stacks don't hit the recursion limit.
+"""
+import importlib
+import io
+import pickle
+import sys
+from typing import Any, Dict, List, Tuple
+
+from .types import ArrayStack, Code, NativeFunction, Stack, Value
+from .vm_utils import repr_stack
+
+
+class SerializationError(ValueError):
+    pass
+
+
+_GLOBAL_SCOPE = "global"
+
+
+def _native_names() -> Dict[int, Tuple[str, str]]:
+    names: Dict[int, Tuple[str, str]] = {}
+    for module_name, module in list(sys.modules.items()):
+        if module_name == "gurklang" or module_name.startswith("gurklang."):
+            for attribute, value in vars(module).items():
+                if isinstance(value, NativeFunction):
+                    names.setdefault(id(value), (module_name, attribute))
+    return names
+
+
+def _load_native(module_name: str, attribute: str) -> NativeFunction:
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def _load_code(instructions, closure, flags, name, source_code, bindings) -> Code:
+    if closure == _GLOBAL_SCOPE:
+        from . import vm
+        closure = vm.global_scope.id
+    return Code(list(instructions), closure, flags, name, source_code, bindings=bindings)
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file: io.BytesIO):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.native_names = None
+
+    def reducer_override(self, obj: Any):
+        tag = getattr(obj, "tag", None)
+        if tag == "code" and isinstance(obj, Code):
+            return _load_code, (
+                tuple(obj.instructions),
+                self._closure(obj),
+                obj.flags,
+                obj.name,
+                obj.source_code,
+                obj.bindings,
+            )
+        elif tag == "native" and isinstance(obj, NativeFunction):
+            if self.native_names is None:
+                self.native_names = _native_names()
+            if id(obj) not in self.native_names:
+                raise SerializationError(f"native function {obj.name} can't be sent to another process")
+            return _load_native, self.native_names[id(obj)]
+        elif tag == "box":
+            raise SerializationError("boxes can't be sent to another process")
+        return NotImplemented
+
+    def _closure(self, code: Code):
+        from . import vm
+        if code.closure is None:
+            return None
+        elif code.closure == vm.global_scope.id:
+            return _GLOBAL_SCOPE
+        raise SerializationError(
+            f"{code.name} closes over a local scope, so it can't be sent to another process"
+        )
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serialize an object that contains gurklang values
+    """
+    file = io.BytesIO()
+    try:
+        _Pickler(file).dump(obj)
+    except RecursionError:
+        raise SerializationError("value is nested too deeply to be sent to another process")
+    return file.getvalue()
+
+
+def loads(data: bytes) -> Any:
+    return pickle.loads(data)
+
+
+def stack_to_list(stack: Stack) -> List[Value]:
+    """
+    List the values on a stack, the topmost value last
+    """
+    return repr_stack(stack)
+
+
+def list_to_stack(values: List[Value]) -> Stack:
+    return ArrayStack.from_values(values)
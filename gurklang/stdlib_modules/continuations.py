@@ -0,0 +1,6 @@
+from ..builtin_utils import BuiltinModule
+from ..continuations import call_cc
+
+module = BuiltinModule("continuations")
+
+module.add("call/cc", call_cc)
@@ -1,6 +1,9 @@
-from typing import List, TypeVar, Tuple
+import threading
+from typing import List, Optional, TypeVar, Tuple
+from ..async_vm import Process
 from ..builtin_utils import BuiltinModule, Fail, make_simple, vec_to_stack, stack_to_vec
-from ..types import CallByValue, Code, CodeFlags, Instruction, Put, Value, Stack, Scope
+from ..types import Atom, CallByValue, Code, CodeFlags, Instruction, NativeFunction, Put, State, Value, Stack, Scope
+from ..vm_utils import render_value_as_source
 
 
 module = BuiltinModule("coro")
@@ -44,3 +47,83 @@ def restore_stack(stack: Stack):
     def __restore_stack(__stack: Stack, __fail: Fail):
         return stack
     return __restore_stack
+
+
+# <generators>
+
+# A generator runs in its own `Process`, which stops at `yield` and keeps
+# its pipe and stack until it's resumed. Generators are streams: calling
+# one pushes the next stream and the yielded value, or `:stream-end`.
+
+
+async def _yield_async(stack: T[V, S], fail: Fail):
+    fail("yield outside of a generator")
+
+
+@module.register_simple("yield", asynchronous=_yield_async)
+def yield_(stack: T[V, S], fail: Fail):
+    """
+    Hand a value to whoever is iterating the generator
+
+    (value --)
+    """
+    fail("yield outside of a generator")
+
+
+def _resume(process: Process) -> Optional[Value]:
+    """
+    Run a generator until it yields a value, return `None` when it's done
+    """
+    machine = process.machine
+    while True:
+        process.run()
+        function = process.waiting_for
+        if function is None:
+            return None
+        process.waiting_for = None
+        if function is yield_:
+            (value, machine.stack) = machine.stack  # type: ignore
+            return value
+        # Processes also stop at I/O, which blocks here
+        machine.stack = function.stack_fn(machine.stack)  # type: ignore
+
+
+def _generator_stream(process: Process) -> NativeFunction:
+    # Streams are values, so calling one twice has to give the same result
+    taken: List[Tuple[Value, NativeFunction]] = []
+    lock = threading.Lock()
+
+    @make_simple()
+    def __generator(stack: S, fail: Fail):
+        with lock:
+            if not taken:
+                value = _resume(process)
+                if value is None:
+                    taken.append((Atom("stream-end"), __generator))
+                else:
+                    taken.append((value, _generator_stream(process)))
+        (value, rest) = taken[0]
+        return value, (rest, stack)
+
+    return __generator
+
+
+@module.register()
+def generator(state: State, fail: Fail):
+    """
+    Make a generator from a function that calls `yield`
+
+    (function -- generator)
+
+    The function starts running when the generator is first called.
+    """
+    (fn, rest) = state.infinite_stack()
+    if fn.tag != "code":
+        fail(f"{render_value_as_source(fn)} is not code")
+    process = Process(state.with_stack(None), fn)
+    if fn.closure is not None:
+        # The scopes came from another interpreter, which still holds them
+        process.refcounts.introduce(fn.closure)
+    return state.with_stack((_generator_stream(process), rest))
+
+# </generators>
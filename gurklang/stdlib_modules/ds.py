@@ -10,6 +10,9 @@ from ..types import Atom, NativeFunction, State, Value, Stack
 module = BuiltinModule("ds")
 Hamt = Map[Value, Value]
 
+_GET, _SET, _DEL, _NIL = Atom("get"), Atom("set"), Atom("del"), Atom("nil")
+
+
 def make_hamt(native_hamt: Hamt) -> NativeFunction:
     @make_function("--hamt")
     def _hamt(state: State, fail: Fail, *, _native_hamt: Hamt=native_hamt) -> State:
@@ -18,19 +21,19 @@ def make_hamt(native_hamt: Hamt) -> NativeFunction:
         if cmd.tag != "atom":
             fail(f"{render_value_as_source(cmd)} is not an atom")
 
-        if cmd is Atom("get"):
+        if cmd is _GET:
             (key, rest2) = rest
             value = _native_hamt.get(key)
             if value is None:
-                return state.with_stack(rest2).push(Atom("nil"))
+                return state.with_stack(rest2).push(_NIL)
             else:
                 return state.with_stack(rest2).push(value)
 
-        elif cmd is Atom("set"):
+        elif cmd is _SET:
             (value, (key, rest2)) = rest
             return state.with_stack(rest2).push(make_hamt(_native_hamt.set(key, value)))
 
-        elif cmd is Atom("del"):
+        elif cmd is _DEL:
             (key, rest2) = rest
             if key not in _native_hamt:
                 return state.with_stack(rest2).push(_hamt)
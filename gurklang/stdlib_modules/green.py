@@ -0,0 +1,219 @@
+"""
+Green threads: many gurklang threads taking turns in one OS thread
+
+Every green thread is an `async_vm.Process`. The scheduler runs the ready
+threads round-robin, each for at most `SWITCH_INTERVAL` instructions. A
+thread also gives up its turn when it calls `yield`, waits in `join` for a
+thread that isn't done, or calls `sleep`, which parks it until its deadline
+instead of blocking the other threads.
+
+Code that isn't running in a green thread drives the scheduler itself:
+`join` runs the threads until the one it waits for is done, and `yield`
+gives every ready thread one turn.
+"""
+import heapq
+import threading
+import time
+import weakref
+from collections import deque
+from itertools import count
+from typing import Deque, List, Optional, Tuple
+
+from ..async_vm import Process
+from ..builtin_utils import BuiltinModule, Fail, _fail, make_simple, vec_to_stack, stack_to_vec
+from ..types import Code, NativeFunction, Stack, State, Value
+from ..vm_utils import render_value_as_source
+
+module = BuiltinModule("green")
+T, V, S = Tuple, Value, Stack
+
+SWITCH_INTERVAL = 1000
+
+
+class GreenThread:
+    __slots__ = ("process", "joiners", "error", "__weakref__")
+
+    def __init__(self, process: Process):
+        self.process = process
+        self.joiners: List["GreenThread"] = []
+        self.error: Optional[BaseException] = None
+
+    @property
+    def done(self) -> bool:
+        return self.process.done or self.error is not None
+
+
+class Scheduler:
+    def __init__(self, interval: int = SWITCH_INTERVAL):
+        self.interval = interval
+        self.ready: Deque[GreenThread] = deque()
+        self.sleeping: List[Tuple[float, int, GreenThread]] = []
+        self.order = count()
+        self.switches = 0
+
+    def spawn(self, state: State, function: Code) -> GreenThread:
+        process = Process(state, function)
+        if function.closure is not None:
+            # The scopes came from another interpreter, which still holds them
+            process.refcounts.introduce(function.closure)
+        thread = GreenThread(process)
+        self.ready.append(thread)
+        return thread
+
+    def run_until(self, thread: GreenThread):
+        while not thread.done:
+            if not self.run_once():
+                raise RuntimeError("deadlock: no green thread can run")
+
+    def run_round(self):
+        for _ in range(len(self.ready)):
+            self.run_once()
+
+    def run_once(self) -> bool:
+        """
+        Give the next ready thread one turn, return `False` if none can run
+        """
+        self._wake_sleepers(block=not self.ready)
+        if not self.ready:
+            return False
+        thread = self.ready.popleft()
+        self.switches += 1
+        try:
+            if thread.process.waiting_for is not None:
+                # Woken up by a thread it joined
+                self._suspend(thread)
+                return True
+            thread.process.run(self.interval)
+            if thread.process.waiting_for is not None:
+                self._suspend(thread)
+                return True
+        except BaseException as e:
+            thread.error = e
+        if thread.done:
+            self.ready.extend(thread.joiners)
+            thread.joiners.clear()
+        else:
+            self.ready.append(thread)
+        return True
+
+    def _suspend(self, thread: GreenThread):
+        from .. import prelude
+        process = thread.process
+        function = process.waiting_for
+        machine = process.machine
+        if function is yield_:
+            process.waiting_for = None
+            self.ready.append(thread)
+        elif function is join:
+            target = _green_threads.get(machine.stack[0])  # type: ignore
+            if target is None or target.done:
+                # Resume, `join` itself reports the result or the error
+                machine.stack = join.stack_fn(machine.stack)  # type: ignore
+                process.waiting_for = None
+                self.ready.append(thread)
+            else:
+                # `join` runs again when the target is done
+                target.joiners.append(thread)
+        elif function is prelude.sleep:
+            stack = machine.stack
+            (duration, machine.stack) = stack  # type: ignore
+            process.waiting_for = None
+            fail: Fail = lambda reason: _fail("sleep", reason, stack)
+            deadline = time.monotonic() + prelude._duration(duration, fail)
+            heapq.heappush(self.sleeping, (deadline, next(self.order), thread))
+        else:
+            # Other I/O blocks all green threads
+            machine.stack = function.stack_fn(machine.stack)  # type: ignore
+            process.waiting_for = None
+            self.ready.append(thread)
+
+    def _wake_sleepers(self, block: bool):
+        if block and self.sleeping:
+            time.sleep(max(0.0, self.sleeping[0][0] - time.monotonic()))
+        now = time.monotonic()
+        while self.sleeping and self.sleeping[0][0] <= now:
+            (_, _, thread) = heapq.heappop(self.sleeping)
+            self.ready.append(thread)
+
+
+_schedulers = threading.local()
+
+
+def get_scheduler() -> Scheduler:
+    """
+    The scheduler of the current OS thread
+    """
+    try:
+        return _schedulers.scheduler
+    except AttributeError:
+        _schedulers.scheduler = Scheduler()
+        return _schedulers.scheduler
+
+
+_green_threads: "weakref.WeakKeyDictionary[NativeFunction, GreenThread]" = weakref.WeakKeyDictionary()
+
+
+def _thread_value(thread: GreenThread) -> NativeFunction:
+    @make_simple()
+    def __green_thread(stack: Stack, fail: Fail):
+        return join.stack_fn((__green_thread, stack))  # type: ignore
+
+    _green_threads[__green_thread] = thread
+    return __green_thread
+
+
+@module.register()
+def spawn(state: State, fail: Fail):
+    """
+    Start a green thread
+
+    (function initial-stack -- thread)
+
+    Unlike the threads of `threading`, a green thread sees the names its
+    function closes over.
+    """
+    (initial, (fn, rest)) = state.infinite_stack()
+    if fn.tag != "code":
+        fail(f"{render_value_as_source(fn)} is not code")
+    thread = get_scheduler().spawn(state.with_stack(vec_to_stack(initial, fail)), fn)  # type: ignore
+    return state.with_stack((_thread_value(thread), rest))
+
+
+# Green threads stop at functions with an asynchronous version, so these
+# two never run inside one: the scheduler handles them instead.
+
+async def _yield_async(stack: Stack, fail: Fail):
+    get_scheduler().run_round()
+    return stack
+
+
+@module.register_simple("yield", asynchronous=_yield_async)
+def yield_(stack: Stack, fail: Fail):
+    """
+    Let the other green threads run
+
+    (--)
+    """
+    get_scheduler().run_round()
+    return stack
+
+
+async def _join_async(stack: T[V, S], fail: Fail):
+    return join.stack_fn(stack)  # type: ignore
+
+
+@module.register_simple(asynchronous=_join_async)
+def join(stack: T[V, S], fail: Fail):
+    """
+    Wait for a green thread to finish
+
+    (thread -- resulting-stack)
+    """
+    (value, rest) = stack
+    thread = _green_threads.get(value) if value.tag == "native" else None  # type: ignore
+    if thread is None:
+        fail(f"{render_value_as_source(value)} is not a green thread")
+    get_scheduler().run_until(thread)
+    if thread.error is not None:
+        raise thread.error
+    return (stack_to_vec(thread.process.machine.stack), rest)
@@ -1,14 +1,30 @@
-from typing import Iterable, TextIO
+from typing import Iterable, Optional, TextIO
 from ..builtin_utils import BuiltinModule, Fail, make_simple
 from ..types import Atom, Str, Value, Stack, Tuple
 from pathlib import Path
+import asyncio
 import sys
 
 module = BuiltinModule('io')
 
 T, V, S = Tuple, Value, Stack
 
-@module.register_simple()
+async def _in_executor(fn, *args):
+    # Files can't be read asynchronously, so reading happens on a thread of
+    # the event loop's default executor
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+async def _read_async(stack: T[V, S], fail: Fail):
+    path, rest = stack
+    if path.tag == "str":
+        return Str(await _in_executor(Path(path.value).read_text)), rest
+    if path.tag == "atom" and path.value == "in":
+        return Str(await _in_executor(sys.stdin.read)), rest
+    fail("read works on the :in atom and a filepath string")
+
+
+@module.register_simple(asynchronous=_read_async)
 def read(stack: T[V, S], fail: Fail):
     path, rest = stack
     if path.tag == "str":
@@ -19,13 +35,24 @@ def read(stack: T[V, S], fail: Fail):
 
     
 def lines_as_stream(file: TextIO):
-    @make_simple()
-    def __file_stream(stack: S, fail: Fail):
+    def step(stack: S, line: Optional[str]):
+        if line is None:
+            file.close()
+            return Atom("stream-end"), (__file_stream, stack)
+        return Str(line), (__file_stream, stack)
+
+    def next_line() -> Optional[str]:
         try:
-            return Str(next(file)), (__file_stream, stack)
+            return next(file)
         except (StopIteration, ValueError):
-            file.close()
-            return Atom("stream-end"), (__file_stream , stack)
+            return None
+
+    async def __file_stream_async(stack: S, fail: Fail):
+        return step(stack, await _in_executor(next_line))
+
+    @make_simple(asynchronous=__file_stream_async)
+    def __file_stream(stack: S, fail: Fail):
+        return step(stack, next_line())
 
     return __file_stream
 
@@ -10,7 +10,7 @@ T, V, S = Tuple, Value, Stack
 Z = TypeVar("Z", bound=Stack)
 
 
-@module.register_simple("<")
+@module.register_simple("<", effect="x:int y:int -- b:atom")
 def less_than(stack: T[V, T[V, S]], fail: Fail):
     (y, (x, rest)) = stack
     if x.tag != "int" or y.tag != "int":
@@ -18,7 +18,7 @@ def less_than(stack: T[V, T[V, S]], fail: Fail):
     return (Atom.bool(x.value < y.value), rest)
 
 
-@module.register_simple(">")
+@module.register_simple(">", effect="x:int y:int -- b:atom")
 def greater_than(stack: T[V, T[V, S]], fail: Fail):
     (y, (x, rest)) = stack
     if x.tag != "int" or y.tag != "int":
@@ -26,7 +26,7 @@ def greater_than(stack: T[V, T[V, S]], fail: Fail):
     return (Atom.bool(x.value > y.value), rest)
 
 
-@module.register_simple(">=")
+@module.register_simple(">=", effect="x:int y:int -- b:atom")
 def greater_than_or_equals(stack: T[V, T[V, S]], fail: Fail):
     (y, (x, rest)) = stack
     if x.tag != "int" or y.tag != "int":
@@ -35,7 +35,7 @@ def greater_than_or_equals(stack: T[V, T[V, S]], fail: Fail):
 module.add("≥", greater_than_or_equals)
 
 
-@module.register_simple("<=")
+@module.register_simple("<=", effect="x:int y:int -- b:atom")
 def less_than_or_equals(stack: T[V, T[V, S]], fail: Fail):
     (y, (x, rest)) = stack
     if x.tag != "int" or y.tag != "int":
@@ -44,7 +44,7 @@ def less_than_or_equals(stack: T[V, T[V, S]], fail: Fail):
 module.add("≤", less_than_or_equals)
 
 
-@module.register_simple("+")
+@module.register_simple("+", effect="x:int y:int -- z:int")
 def add(stack: T[V, T[V, S]], fail: Fail):
     (y, (x, rest)) = stack
     if x.tag != "int" or y.tag != "int":
@@ -52,7 +52,7 @@ def add(stack: T[V, T[V, S]], fail: Fail):
     return (Int(x.value + y.value), rest)
 
 
-@module.register_simple("-")
+@module.register_simple("-", effect="x:int y:int -- z:int")
 def add(stack: T[V, T[V, S]], fail: Fail):
     (y, (x, rest)) = stack
     if x.tag != "int" or y.tag != "int":
@@ -60,7 +60,7 @@ def add(stack: T[V, T[V, S]], fail: Fail):
     return (Int(x.value - y.value), rest)
 
 
-@module.register_simple("*")
+@module.register_simple("*", effect="x:int y:int -- z:int")
 def add(stack: T[V, T[V, S]], fail: Fail):
     (y, (x, rest)) = stack
     if x.tag != "int" or y.tag != "int":
@@ -1,5 +1,5 @@
 from typing import TypeVar, Tuple
-from ..vm_utils import render_value_as_source
+from ..vm_utils import render_value_as_source, split_stack
 from ..builtin_utils import BuiltinModule, Fail, raw_function
 from ..types import CallByName, CallByValue, Put, State, Str, Value, Stack, Scope, Int
 import random
@@ -15,19 +15,12 @@ def stack_repr(stack: T[V, S], fail: Fail):
     if depth.tag != "int":
         fail(f"Depth `{render_value_as_source(depth)}`` is not an integer")
 
-    render = lambda x: x
-    s = rest
-    for _ in range(depth.value):
-        if s is None:
-            break
-        (head, s) = s  # type: ignore
-        # closure gotcha
-        render = lambda x, old_repr=render, head=head: old_repr(f"({render_value_as_source(head)} {x})")
-
-    if s is None:
-        representation = render("()")
-    else:
-        representation = render("(...)")
+    (values, below) = split_stack(rest, depth.value)
+    representation = (
+        "".join(f"({render_value_as_source(value)} " for value in values)
+        + ("()" if below is None else "(...)")
+        + ")" * len(values)
+    )
 
     return (Str(representation), rest)
 
@@ -1,69 +1,222 @@
-from typing import List, Optional, TYPE_CHECKING, TypeVar, Tuple, Deque
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple, Deque
 
-from immutables import Map
-from ..vm_utils import render_value_as_source, stringify_value
+from ..vm_utils import render_value_as_source
 from ..builtin_utils import BuiltinModule, Fail, make_simple, vec_to_stack, stack_to_vec
-from ..types import Atom, CallByValue, Code, CodeFlags, Instruction, Put, State, Value, Stack, Scope, Vec
-from queue import Queue
-import heapq
+from ..types import Atom, Code, Int, NativeFunction, State, Value, Stack, Vec
+from .. import serialization, worker_pool
+from ..resolver import detach
 import gurklang.vm
+import multiprocessing
 import threading
+import weakref
 
 
 module = BuiltinModule("threading")
 T, V, S = Tuple, Value, Stack
-Z = TypeVar("Z", bound=Stack)
-
-if TYPE_CHECKING:
-    ThreadQ = Queue[Tuple[int, Stack]]  # type: ignore
-else:
-    ThreadQ = Queue
-
-
-def _run_function(
-    n: int,
-    queue: ThreadQ,
-    stack: Stack,
-    instructions: List[Instruction],
-    name: str,
-    source_code: Optional[str]
-):
-    begin_state = State.make(gurklang.vm.global_scope, gurklang.vm.builtin_scope).with_stack(stack)
+
+
+@module.register()
+def run_concurrently(state: State, fail: Fail):
+    """
+    Run functions on the worker pool
+
+    (functions intial-stacks -- resulting-stacks)
+    """
+    (stack_vec, (fnvec, rest)) = state.infinite_stack()
+    stacks = [vec_to_stack(sv, fail) for sv in stack_vec.values]  # type: ignore
+
+    pool = worker_pool.get_pool()
+    tasks = [
+        pool.submit(list(fn.instructions), fn.name, fn.source_code, stack)  # type: ignore
+        for stack, fn in zip(stacks, fnvec.values)  # type: ignore
+    ]
+    results = [pool.wait(task) for task in tasks]
+
+    return (
+        state
+        .with_stack(rest)
+        .push(Vec([stack_to_vec(stack) for stack in results]))
+    )
+
+
+class _Completions:
+    """
+    Tasks of one fan-out in the order they finish
+    """
+    def __init__(self, pool: worker_pool.WorkerPool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.done: Deque[Tuple[int, worker_pool.Task]] = deque()
+        self.ready = threading.Event()
+
+    def put(self, index: int, task: worker_pool.Task):
+        with self.lock:
+            self.done.append((index, task))
+            self.ready.set()
+
+    def get(self) -> Tuple[int, worker_pool.Task]:
+        self.pool.wait_until(self.ready)
+        with self.lock:
+            item = self.done.popleft()
+            if not self.done:
+                self.ready.clear()
+            return item
+
+
+def _make_completion_stream(completions: _Completions, remaining: int):
+    # Streams are values, so calling one twice has to give the same result
+    taken: List[Tuple[Value, NativeFunction]] = []
+    lock = threading.Lock()
+
+    @make_simple()
+    def __completion_stream(stack: S, fail: Fail):
+        with lock:
+            if not taken:
+                if remaining == 0:
+                    taken.append((Atom("stream-end"), __completion_stream))
+                else:
+                    (index, task) = completions.get()
+                    if task.error is not None:
+                        raise task.error
+                    pair = Vec([Int(index), stack_to_vec(task.result)])
+                    taken.append((pair, _make_completion_stream(completions, remaining - 1)))
+        (value, rest) = taken[0]
+        return value, (rest, stack)
+
+    return __completion_stream
+
+
+@module.register_simple()
+def stream_concurrently(stack: T[V, T[V, S]], fail: Fail):
+    """
+    Run functions on the worker pool and stream the results as they finish
+
+    (functions intial-stacks -- stream)
+
+    The stream yields `(index resulting-stack)` pairs in the order the
+    functions finish, then `:stream-end`.
+    """
+    (stack_vec, (fnvec, rest)) = stack
+    stacks = [vec_to_stack(sv, fail) for sv in stack_vec.values]  # type: ignore
+
+    pool = worker_pool.get_pool()
+    completions = _Completions(pool)
+    jobs = list(zip(stacks, fnvec.values))  # type: ignore
+    for i, (initial, fn) in enumerate(jobs):
+        pool.submit(
+            list(fn.instructions), fn.name, fn.source_code, initial,
+            on_done=lambda task, i=i: completions.put(i, task)
+        )
+    return (_make_completion_stream(completions, len(jobs)), rest)
+
+
+_tasks: "weakref.WeakKeyDictionary[NativeFunction, worker_pool.Task]" = weakref.WeakKeyDictionary()
+
+
+@module.register_simple()
+def submit(stack: T[V, T[V, S]], fail: Fail):
+    """
+    Start running a function on the worker pool
+
+    (function initial-stack -- task)
+    """
+    (initial, (fn, rest)) = stack
+    if fn.tag != "code":
+        fail(f"{render_value_as_source(fn)} is not code")
+    pool = worker_pool.get_pool()
+    task = pool.submit(list(fn.instructions), fn.name, fn.source_code, vec_to_stack(initial, fail))
+
+    @make_simple()
+    def __task(stack: Stack, fail: Fail):
+        return (stack_to_vec(pool.wait(task)), stack)
+
+    _tasks[__task] = task
+    return (__task, rest)
+
+
+@module.register_simple("await")
+def await_(stack: T[V, S], fail: Fail):
+    """
+    Wait for a task to finish
+
+    (task -- resulting-stack)
+    """
+    (task, rest) = stack
+    if task.tag != "native" or task not in _tasks:
+        fail(f"{render_value_as_source(task)} is not a task")
+    return task.stack_fn(rest)  # type: ignore
+
+
+@module.register_simple()
+def set_pool_size(stack: T[V, S], fail: Fail):
+    """
+    Change the number of workers in the pool
+
+    (size --)
+    """
+    (size, rest) = stack
+    if size.tag != "int" or size.value < 1:
+        fail(f"{render_value_as_source(size)} is not a positive int")
+    worker_pool.set_pool_size(size.value)
+    return rest
+
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # Forking while other threads hold locks can deadlock the child
+            _process_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+        return _process_pool
+
+
+def _run_function_in_process(payload: bytes) -> bytes:
+    (instructions, name, source_code, values) = serialization.loads(payload)
+    begin_state = (
+        State.make(gurklang.vm.global_scope, gurklang.vm.builtin_scope)
+        .with_stack(serialization.list_to_stack(values))
+    )
     end_state = gurklang.vm.call(
         begin_state,
         Code(instructions, None, name=name, source_code=source_code)
     )
-    queue.put((n, end_state.stack))
+    return serialization.dumps(serialization.stack_to_list(end_state.stack))
 
 
 @module.register()
-def run_concurrently(state: State, fail: Fail):
+def run_parallel(state: State, fail: Fail):
     """
-    Launch a new interpreter and run a function in it
+    Run functions in a pool of worker processes
 
     (functions intial-stacks -- resulting-stacks)
+
+    Like `run-concurrently`, but the functions don't share the GIL. Values
+    on the stacks are copied to the workers and back, so they can't contain
+    boxes or closures over local scopes.
     """
     (stack_vec, (fnvec, rest)) = state.infinite_stack()
     stacks = [vec_to_stack(sv, fail) for sv in stack_vec.values]  # type: ignore
 
-    result_queue: ThreadQ = Queue()
-    threads: List[threading.Thread] = []
-    for i, (stack, fn) in enumerate(zip(stacks, fnvec.values)):  # type: ignore
-        thread = threading.Thread(
-            name=f"My Thread {i}",
-            target=_run_function,
-            args=(i, result_queue, stack, list(fn.instructions), fn.name, fn.source_code)  # type: ignore
-        )
-        thread.start()
-        threads.append(thread)
-
-    results: List[Stack] = [None] * len(threads)  # type: ignore
-    for _ in threads:
-        i, stack = result_queue.get()
-        results[i] = stack
+    payloads: List[bytes] = []
+    for stack, fn in zip(stacks, fnvec.values):  # type: ignore
+        if fn.tag != "code":
+            fail(f"{render_value_as_source(fn)} is not code")
+        try:
+            payloads.append(serialization.dumps((
+                tuple(detach(fn.instructions)), fn.name, fn.source_code, serialization.stack_to_list(stack)
+            )))
+        except serialization.SerializationError as e:
+            fail(str(e))
 
-    for thread in threads:
-        thread.join()
+    pool = _get_process_pool()
+    futures = [pool.submit(_run_function_in_process, payload) for payload in payloads]
+    results = [serialization.list_to_stack(serialization.loads(future.result())) for future in futures]
 
     return (
         state
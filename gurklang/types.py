@@ -1,13 +1,16 @@
 from __future__ import annotations
 from enum import  IntFlag
+from itertools import count
+import sys
+import threading
 import weakref
 from immutables import Map
 try:
     from typing_extensions import Literal
 except ImportError:
     from typing import Literal
-from typing import Any, Callable, ClassVar, Dict, Mapping, Sequence, Union, Optional, Tuple
-from dataclasses import dataclass, field, replace as dataclass_replace
+from typing import Any, Awaitable, Callable, ClassVar, Dict, Iterable, Mapping, Sequence, Union, Optional, Tuple
+from dataclasses import dataclass, field, fields, replace as dataclass_replace
 
 
 @dataclass(frozen=True, repr=False)
@@ -28,21 +31,22 @@ class Scope:
         return f"<Scope {self.id!r}: parent={self.parent!r}>"
 
     def without_member(self, key: str):
-        return Scope(self.parent, self.id, self.values.delete(key))
+        return Scope(self.parent, self.id, self.values.delete(key), self.persistent)
 
     def with_member(self, key: str, value: Value) -> Scope:
         if key in self.values:
             raise RuntimeError(f"Trying to reassign {key}")
-        return Scope(self.parent, self.id, self.values.set(key, value))
+        return Scope(self.parent, self.id, self.values.set(key, value), self.persistent)
 
     def with_members(self, update: Mapping[str, Value]):
-        return Scope(self.parent, self.id, self.values.update(update))
+        return Scope(self.parent, self.id, self.values.update(update), self.persistent)
 
     def with_parent(self, parent: Optional[int]):
-        return Scope(parent, self.id, self.values)
+        return Scope(parent, self.id, self.values, self.persistent)
 
 
-# The stack is immutable and is modelled as a linked list:
+# The stack is immutable and is modelled as a linked list (whose tail can
+# be an `ArrayStack`, see below):
 ScopeStack = Optional[Tuple[int, "ScopeStack"]]
 Stack = Optional[Tuple["Value", "Stack"]]
 InfiniteStack = Tuple["Value",
@@ -55,6 +59,96 @@ InfiniteStack = Tuple["Value",
                 Tuple["Value", "InfiniteStack"]]]]]]]]
 
 
+class ArrayStack:
+    """
+    A non-empty stack stored in a list, the topmost value last
+
+    It destructures like the 2-tuple stack, `(head, rest) = stack`, so it
+    can be passed anywhere a `Stack` is expected, and tuples can be pushed
+    on top of it. Stacks share their list: pushing onto the stack whose top
+    is the end of the list appends to it in place, and older stacks only
+    look at a prefix. Pushing onto any other stack falls back to a tuple.
+    Indexing from the top is O(1).
+    """
+    __slots__ = ("items", "size")
+
+    # Checking the length and appending happen together, so two threads
+    # pushing onto the same stack can't both append
+    _push_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, items: "list[Value]", size: int):
+        self.items = items
+        self.size = size
+
+    @staticmethod
+    def from_values(values: Sequence["Value"]) -> Stack:
+        """
+        Make a stack of values, the topmost value last
+        """
+        if not values:
+            return None
+        return ArrayStack(list(values), len(values))  # type: ignore
+
+    def push(self, value: "Value") -> Stack:
+        items, size = self.items, self.size
+        with ArrayStack._push_lock:
+            if len(items) == size:
+                items.append(value)
+                return ArrayStack(items, size + 1)  # type: ignore
+        return (value, self)  # type: ignore
+
+    def peek(self, index: int) -> "Value":
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        return self.items[self.size - 1 - index]
+
+    def __getitem__(self, index: int):
+        if index == 0:
+            return self.items[self.size - 1]
+        elif index == 1:
+            return ArrayStack(self.items, self.size - 1) if self.size > 1 else None
+        raise IndexError(index)
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        size = self.size
+        return iter((self.items[size - 1], ArrayStack(self.items, size - 1) if size > 1 else None))
+
+    def __eq__(self, other):
+        if not isinstance(other, (tuple, ArrayStack)):
+            return NotImplemented
+        # Compare value by value, so deep stacks don't recurse
+        this: Stack = self  # type: ignore
+        while this is not None and other is not None:
+            if type(this) is ArrayStack and type(other) is ArrayStack and this.size == other.size:
+                return this.items[:this.size] == other.items[:other.size]
+            (x, this) = this  # type: ignore
+            (y, other) = other
+            if x != y:
+                return False
+        return this is None and other is None
+
+    def __hash__(self):
+        stack: Stack = None
+        for value in self.items[:self.size]:
+            stack = (value, stack)
+        return hash(stack)
+
+    def __repr__(self):
+        return f"ArrayStack({self.items[:self.size]!r})"
+
+    def __reduce__(self):
+        return (ArrayStack.from_values, (self.items[:self.size],))
+
+
+def push_value(stack: Stack, value: "Value") -> Stack:
+    if type(stack) is ArrayStack:
+        return stack.push(value)  # type: ignore
+    return (value, stack)
+
+
 @dataclass(frozen=True)
 class State:
     stack: Stack
@@ -91,7 +185,7 @@ class State:
     def push(self, *values: "Value"):
         stack = self.stack
         for value in values:
-            stack = (value, stack)
+            stack = push_value(stack, value)
         return self.with_stack(stack)
 
     def read_box(self, id: int) -> Stack:
@@ -159,21 +253,45 @@ class State:
             raise RuntimeError(f"Trying to kill nonexistent box with id {id}")
         return self._with_boxes(self.boxes.delete(id))
 
-    def make_scope(self, parent_id: int, new_id: int, persistent: bool = False) -> "State":
+    def make_scope(
+        self, parent_id: int, new_id: int, persistent: bool = False, bindings: Optional[Map] = None
+    ) -> "State":
         assert parent_id in self.scopes
         assert new_id not in self.scopes
-        new_scope = Scope(parent_id, new_id, Map(), persistent=persistent)
+        if bindings is not None:
+            note_definitions(self.scopes, parent_id, bindings.keys())
+        new_scope = Scope(parent_id, new_id, Map() if bindings is None else bindings, persistent=persistent)
         return dataclass_replace(
             self.set_scope(new_id, new_scope),
             scope_stack=(new_id, self.scope_stack)
         )
 
+    def enter_scope(self, scope_id: int) -> "State":
+        """
+        Run in an existing scope until the next `pop_scope`
+
+        Used for calls of `CodeFlags.FLAT` code. If a name is defined before
+        the scope is popped, it's defined in a new scope, see `_own_scope`.
+        """
+        return dataclass_replace(self, scope_stack=(scope_id, self.scope_stack, True))
+
     def pop_scope(self) -> "State":
         return dataclass_replace(
             self,
             scope_stack=self.scope_stack[1]
         )
 
+    def _own_scope(self) -> "State":
+        if len(self.scope_stack) == 2:  # type: ignore
+            return self
+        from .vm import generate_scope_id
+        (parent_id, rest, _) = self.scope_stack  # type: ignore
+        new_id = generate_scope_id()
+        return dataclass_replace(
+            self.set_scope(new_id, Scope(parent_id, new_id, Map())),
+            scope_stack=(new_id, rest),
+        )
+
     def get_by_name(self, scope_id: int, name: str) -> "Value":
         if scope_id not in self.scopes:
             raise KeyError(f"No scope #{scope_id} when trying to get {name}, scopestack: {self.scope_stack}")
@@ -186,7 +304,9 @@ class State:
         return dataclass_replace(self, scopes=self.scopes.set(id, scope))
 
     def set_name(self, name: str, value: "Value") -> "State":
+        self = self._own_scope()
         old_scope: Scope = self.scopes[self.current_scope_id]
+        note_definitions(self.scopes, old_scope.parent, (name,))
         new_scope = old_scope.with_member(name, value)
         return dataclass_replace(
             self,
@@ -194,12 +314,16 @@ class State:
         )
 
     def forget_name(self, name: str) -> "State":
+        self = self._own_scope()
         old_scope: Scope = self.scopes[self.current_scope_id]
+        note_forgotten(name)
         new_scope = old_scope.without_member(name)
         return self.set_scope(self.current_scope_id, new_scope)
 
     def set_names(self, update: Mapping[str, "Value"]) -> "State":
+        self = self._own_scope()
         old_scope: Scope = self.scopes[self.current_scope_id]
+        note_definitions(self.scopes, old_scope.parent, update.keys())
         new_scope = old_scope.with_members(update)
         return self.set_scope(self.current_scope_id, new_scope)
 
@@ -216,6 +340,120 @@ class State:
         )
 
 
+class Machine:
+    """
+    Mutable counterpart of `State` used by the fast engine.
+
+    The fields are the same as `State`'s, but they're updated in place,
+    so executing an instruction doesn't allocate a new `State`.
+    Native functions still see an immutable `State`: call `snapshot`
+    before handing the state over and `load` after getting it back.
+
+    `shapes` and `cache_epoch` back the inline caches of the bytecode engine
+    (see `bytecode.py`) and aren't part of the `State`.
+    """
+    __slots__ = (
+        "stack", "scopes", "scope_stack", "boxes", "box_in_transaction", "last_box_id",
+        "shapes", "cache_epoch",
+    )
+
+    stack: Stack
+    scopes: "Map[int, Scope]"
+    scope_stack: ScopeStack
+    boxes: "Map[int, Stack]"
+    box_in_transaction: "Map[int, bool]"
+    last_box_id: int
+    shapes: Dict[int, Any]
+    cache_epoch: object
+
+    def __init__(self, state: State):
+        self.load(state)
+        self.shapes = {}
+        self.cache_epoch = object()
+
+    def load(self, state: State):
+        self.stack = state.stack
+        self.scopes = state.scopes
+        self.scope_stack = state.scope_stack
+        self.boxes = state.boxes
+        self.box_in_transaction = state.box_in_transaction
+        self.last_box_id = state.last_box_id
+
+    def snapshot(self) -> State:
+        return State(
+            self.stack,
+            self.scopes,
+            self.scope_stack,
+            self.boxes,
+            self.box_in_transaction,
+            self.last_box_id,
+        )
+
+    @property
+    def current_scope_id(self) -> int:
+        return self.scope_stack[0] # type: ignore
+
+    def get_scope(self, scope_id: int) -> Scope:
+        if scope_id not in self.scopes:
+            raise KeyError(scope_id)
+        return self.scopes[scope_id]
+
+    def look_up_name_in_current_scope(self, name: str) -> "Value":
+        scopes = self.scopes
+        scope_id = self.scope_stack[0]  # type: ignore
+        while True:
+            if scope_id not in scopes:
+                raise KeyError(f"No scope #{scope_id} when trying to get {name}, scopestack: {self.scope_stack}")
+            scope = scopes[scope_id]
+            if name in scope.values:
+                return scope.values[name]
+            if scope.parent is None:
+                raise KeyError(name)
+            scope_id = scope.parent
+
+    def look_up_address(self, name: str, address: "Address") -> "Value":
+        """
+        Look up a name in the scope given by its address
+
+        Falls back to `look_up_name_in_current_scope` if the name isn't
+        there or might be shadowed.
+        """
+        scope_stack = self.scope_stack
+        depth = address.depth
+        if len(scope_stack) == 3:  # type: ignore
+            # A flat call runs in the scope of its closure, see `enter_scope`
+            depth -= 1
+        if depth >= 0 and not address.name.shadowed:
+            scopes = self.scopes
+            scope = scopes[scope_stack[0]]  # type: ignore
+            while depth and scope.parent is not None:
+                scope = scopes[scope.parent]
+                depth -= 1
+            if not depth:
+                value = scope.values.get(name)
+                if value is not None:
+                    return value
+        return self.look_up_name_in_current_scope(name)
+
+    def make_scope(self, parent_id: int, new_id: int, bindings: Optional[Map] = None):
+        assert parent_id in self.scopes
+        assert new_id not in self.scopes
+        if bindings is not None:
+            note_definitions(self.scopes, parent_id, bindings.keys())
+        self.scopes = self.scopes.set(new_id, Scope(parent_id, new_id, Map() if bindings is None else bindings))
+        self.scope_stack = (new_id, self.scope_stack)
+
+    def enter_scope(self, scope_id: int):
+        self.scope_stack = (scope_id, self.scope_stack, True)  # type: ignore
+
+    def pop_scope(self):
+        self.scope_stack = self.scope_stack[1]  # type: ignore
+
+    def kill_scope(self, scope_id: int):
+        self.scopes = self.scopes.delete(scope_id)
+        self.shapes.pop(scope_id, None)
+
+
 @dataclass(frozen=True)
 class Put:
     """Put a single value on top of the stack"""
@@ -230,8 +468,14 @@ class PutCode:
     """Create a closure and put a code value on top of the stack"""
     instructions: Sequence[Instruction]
     source_code: Optional[str] = None
+    # Flags of the code values, worked out from the instructions
+    flags: CodeFlags = field(init=False, compare=False, repr=False)
     tag: ClassVar[Literal["put_code"]] = "put_code"
 
+    def __post_init__(self):
+        flags = CodeFlags.FLAT if can_run_flat(self.instructions) else CodeFlags.EMPTY
+        object.__setattr__(self, "flags", flags)
+
     def as_vec(self):
         rv = (Atom("PutCode"), Vec([i.as_vec() for i in self.instructions]))
         if self.source_code is not None:
@@ -242,6 +486,8 @@ class PutCode:
 class CallByName:
     """Call a function by name"""
     function_name: str
+    # Where the name is defined, if it's known at compile time, see `resolver.py`
+    address: Optional[Address] = field(default=None, compare=False, repr=False)
     tag: ClassVar[Literal["call"]] = "call"
 
     def as_vec(self):
@@ -268,6 +514,10 @@ class MakeVec:
 class MakeScope:
     """Create a local scope given a parent scope"""
     parent_id: int
+    # Names defined in the new scope right away, see `Code.bindings`
+    bindings: Optional[Map] = None
+    # Enter the parent scope instead, see `CodeFlags.FLAT`
+    flat: bool = False
     tag: ClassVar[Literal["make_scope"]] = "make_scope"
 
     def as_vec(self):
@@ -285,6 +535,71 @@ class PopScope:
         return Vec((Atom("PopScope"),))
 
 
+class LexicalName:
+    """
+    A name that is looked up by its lexical address somewhere
+
+    `shadowed` is set when the name is defined in a scope where it's
+    already visible, see `note_definitions`. Such a definition could hide
+    the one an address points to, so the name is then always looked up by
+    walking the scopes.
+    """
+    __slots__ = ("name", "shadowed")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.shadowed = False
+
+    @staticmethod
+    def get(name: str) -> "LexicalName":
+        lexical = _lexical_names.get(name)
+        if lexical is None:
+            lexical = _lexical_names.setdefault(name, LexicalName(name))
+        return lexical
+
+    def __reduce__(self):
+        return (LexicalName.get, (self.name,))
+
+    def __repr__(self):
+        return f"<LexicalName {self.name!r}{' shadowed' if self.shadowed else ''}>"
+
+
+_lexical_names: Dict[str, LexicalName] = {}
+
+
+@dataclass(frozen=True)
+class Address:
+    """
+    A name defined `depth` scopes above the scope of the code that calls it
+    """
+    depth: int
+    name: LexicalName
+
+
+def note_definitions(scopes: "Map[int, Scope]", parent_id: Optional[int], names: Iterable[str]):
+    """
+    Mark the names that are about to be defined in a child of `parent_id`
+    as shadowed if they're visible from it
+    """
+    for name in names:
+        lexical = _lexical_names.get(name)
+        if lexical is None or lexical.shadowed:
+            continue
+        scope_id = parent_id
+        while scope_id is not None and scope_id in scopes:
+            scope = scopes[scope_id]
+            if name in scope.values:
+                lexical.shadowed = True
+                break
+            scope_id = scope.parent
+
+
+def note_forgotten(name: str):
+    lexical = _lexical_names.get(name)
+    if lexical is not None:
+        lexical.shadowed = True
+
+
 # `Instruction` is a single step executed by the interpreter
 Instruction = Union[Put, PutCode, CallByName, CallByValue, MakeVec, MakeScope, PopScope]
 
@@ -294,9 +609,34 @@ class CodeFlags(IntFlag):
     """Optimization flags used by `Code`"""
     EMPTY = 0
     PARENT_SCOPE = 1
+    # The code can run in its closure's scope instead of a new one, see
+    # `State.enter_scope` and `can_run_flat`
+    FLAT = 2
+
+
+# Words that change the current scope
+DEFINING_WORDS = frozenset(("def", "jar", "import", "forget"))
+
+
+def can_run_flat(instructions: Sequence[Instruction]) -> bool:
+    """
+    Check if code doesn't need a scope of its own
+
+    It mustn't call a word that defines names. A name can still be defined
+    in other ways, like by a function made with `parent-scope`, so the
+    code mustn't create closures either: they would close over the wrong
+    scope once the call gets its own.
+    """
+    for instruction in instructions:
+        if instruction.tag == "put_code":
+            return False
+        if instruction.tag == "call" and instruction.function_name in DEFINING_WORDS:
+            return False
+    return True
 
 
 _atom_cache: Dict[str, Atom] = {}
+_atom_ids = count()
 
 
 _bool = bool
@@ -304,56 +644,140 @@ class Atom:
     """
     Atom, like :true
 
-    Atoms are cached and compared by identity.
+    Atoms are cached and compared by identity. Each atom gets an integer
+    `id` and its hash when it's made.
     """
+    __slots__ = ("value", "id", "_hash")
     value: str
+    id: int
     tag: ClassVar[Literal["atom"]] = "atom"
 
     def __new__(cls, value: str):
-        if value in _atom_cache:
-            return _atom_cache[value]
-        rv = object.__new__(cls)
-        rv.__init__(value)
-        _atom_cache[value] = rv
+        rv = _atom_cache.get(value)
+        if rv is None:
+            rv = object.__new__(cls)
+            rv.value = value
+            rv.id = next(_atom_ids)
+            rv._hash = hash(("atom", value))
+            # If another thread made the same atom first, use that one
+            rv = _atom_cache.setdefault(value, rv)
         return rv
 
     def __hash__(self):
-        return hash(("atom", self.value))
+        return self._hash
 
-    def __init__(self, value: str):
-        self.value = value
+    def __reduce__(self):
+        return (Atom, (self.value,))
 
     def __repr__(self):
         return f"Atom({self.value!r})"
 
-    def __eq__(self, other):
-        if not isinstance(other, Atom):
-            return NotImplemented
-        return self.value == other.value
-
     @staticmethod
     def make(name: str) -> Atom:
-        if name not in _atom_cache:
-            _atom_cache[name] = Atom(name)
-        return _atom_cache[name]
+        return Atom(name)
 
     @staticmethod
     def bool(x: _bool) -> Atom:
-        return Atom("true" if x else "false")
+        return TRUE if x else FALSE
+
+
+TRUE = Atom("true")
+FALSE = Atom("false")
+
 
+def _slots(*extra: str):
+    """
+    Give a frozen dataclass `__slots__` for its fields and `extra` names
 
+    Like `dataclass(slots=True)`, which needs Python 3.10.
+    """
+    def inner(cls):
+        names = tuple(f.name for f in fields(cls))
+        namespace = dict(cls.__dict__)
+        for name in names:
+            namespace.pop(name, None)
+        namespace.pop("__dict__", None)
+        namespace.pop("__weakref__", None)
+        namespace["__slots__"] = names + extra
+
+        def __getstate__(self):
+            return [getattr(self, name) for name in names]
+
+        def __setstate__(self, state):
+            for (name, value) in zip(names, state):
+                object.__setattr__(self, name, value)
+
+        namespace.setdefault("__getstate__", __getstate__)
+        namespace.setdefault("__setstate__", __setstate__)
+        new_cls = type(cls)(cls.__name__, cls.__bases__, namespace)
+        # Generated methods like the frozen `__setattr__` refer to the class
+        for member in namespace.values():
+            for cell in getattr(member, "__closure__", None) or ():
+                if cell.cell_contents is cls:
+                    cell.cell_contents = new_cls
+        return new_cls
+    return inner
+
+
+_str_cache: Dict[str, Str] = {}
+
+
+@_slots()
 @dataclass(frozen=True)
 class Str:
     """String, like 'hello'"""
     value: str
     tag: ClassVar[Literal["str"]] = "str"
 
-@dataclass(frozen=True)
+    def __hash__(self):
+        return hash(self.value)
+
+    @staticmethod
+    def interned(value: str) -> Str:
+        """
+        Get a shared `Str`, for strings that are made over and over again
+
+        Interned values are never freed.
+        """
+        rv = _str_cache.get(value)
+        if rv is None:
+            rv = _str_cache.setdefault(value, Str(sys.intern(value)))
+        return rv
+
+
+# Integers in this range are cached, like in CPython
+_SMALL_INTS = range(-5, 257)
+_int_cache: Dict[int, Int] = {}
+
+
+@_slots()
+@dataclass(frozen=True, init=False)
 class Int:
     """Integer, like 42"""
     value: int
     tag: ClassVar[Literal["int"]] = "int"
 
+    def __new__(cls, value: int):
+        rv = _int_cache.get(value)
+        if rv is None:
+            rv = object.__new__(cls)
+            object.__setattr__(rv, "value", value)
+            if value in _SMALL_INTS:
+                _int_cache[value] = rv
+        return rv
+
+    def __init__(self, value: int):
+        # Set by `__new__`
+        pass
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __reduce__(self):
+        return (Int, (self.value,))
+
+
+@_slots("_hash")
 @dataclass(frozen=True)
 class Vec:
     """
@@ -365,10 +789,16 @@ class Vec:
     tag: ClassVar[Literal["vec"]] = "vec"
 
     def __hash__(self):
-        # We'll promise that self.values will never be mutated
-        return hash(("vec", *self.values))
+        try:
+            return self._hash
+        except AttributeError:
+            # We'll promise that self.values will never be mutated
+            rv = hash(("vec", *self.values))
+            object.__setattr__(self, "_hash", rv)
+            return rv
 
 
+@_slots("_hash")
 @dataclass(frozen=True)
 class Code:
     """Code value like { :b def :a def b a }"""
@@ -379,16 +809,24 @@ class Code:
     source_code: Optional[str] = None
     introducer: Optional[weakref.ReferenceType[Callable[[int], Any]]] = None
     finalizer: Optional[weakref.ReferenceType[Callable[[int], Any]]] = None
+    # Names defined in the scope of a call before the instructions run.
+    # Ignored for code that doesn't get its own scope.
+    bindings: Optional[Map] = None
     tag: ClassVar[Literal["code"]] = "code"
 
     def __hash__(self):
-        return hash((
-            *self.instructions,
-            self.closure,
-            self.flags,
-            self.name,
-            self.source_code,
-        ))
+        try:
+            return self._hash
+        except AttributeError:
+            rv = hash((
+                *self.instructions,
+                self.closure,
+                self.flags,
+                self.name,
+                self.source_code,
+            ))
+            object.__setattr__(self, "_hash", rv)
+            return rv
 
     def introduce(self):
         if self.introducer is not None and self.closure is not None:
@@ -403,15 +841,32 @@ class Code:
                 finalizer(self.closure)
 
     def with_name(self, name: str) -> Code:
+        # The copy will call the finalizer when it dies, so it needs its own reference
+        self.introduce()
         return dataclass_replace(self, name=name)
 
+    def with_flags(self, flags: CodeFlags) -> Code:
+        self.introduce()
+        return dataclass_replace(self, flags=flags)
+
+    def with_bindings(self, bindings: Map) -> Code:
+        self.introduce()
+        return dataclass_replace(self, bindings=bindings)
+
 @dataclass(frozen=True)
 class NativeFunction:
     """A function implemented in Python, like `if` or `+`"""
     fn: Callable[[State], State]
     name: str = "λ"
+    # Set for functions that only touch the stack. Engines can call it
+    # directly instead of wrapping the stack in a `State`.
+    stack_fn: Optional[Callable[[Stack], Stack]] = field(default=None, compare=False, repr=False)
+    # Set for functions that wait for I/O. `async_vm` awaits it instead of
+    # blocking the event loop.
+    async_fn: Optional[Callable[[Stack], Awaitable[Stack]]] = field(default=None, compare=False, repr=False)
     tag: ClassVar[Literal["native"]] = "native"
 
+@_slots()
 @dataclass(frozen=True)
 class Box:
     id: int
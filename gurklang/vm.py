@@ -1,26 +1,45 @@
+import os
 import weakref
 from immutables import Map
-from typing import Callable, Optional, Sequence, Tuple, Union
+from typing import Callable, Dict, Optional, Sequence, Tuple, Union
 
 from . import prelude
 from gurklang.types import (
-    CallByValue, CodeFlags, MakeScope, NativeFunction, PopScope, Put,
+    CallByValue, CodeFlags, MakeScope, Machine, NativeFunction, PopScope, Put,
     Scope, Stack, Instruction, Code, State, Vec
 )
+from gurklang.vm_utils import FinalizerQueue
+from gurklang.scope_gc import ScopeCollector
 from collections import defaultdict, deque
+import itertools
 import threading
 
 
 MiddlewareT = Callable[[Instruction, Stack, Stack], None]
 
+# A scope is finalized only after this many instructions have been executed
+# since the last reference to it was dropped. This gives the instructions
+# right after a `PopScope` (or after a closure dies) a chance to
+# re-introduce the scope before it's killed.
+FINALIZER_DELAY = 3
 
-_SCOPE_ID_LOCK = threading.Lock()
-_SCOPE_ID = 0
-def generate_scope_id():
-    global _SCOPE_ID
-    with _SCOPE_ID_LOCK:
-        _SCOPE_ID += 1
-    return _SCOPE_ID
+
+# Every thread allocates scope ids from its own block of the id space, so
+# interpreters running in different threads never contend for a lock. A
+# thread takes the next free block when it first needs an id. Blocks never
+# overlap, so ids are still unique across interpreters.
+SCOPE_ID_BLOCK_SIZE = 1 << 40
+_scope_id_blocks = itertools.count()
+_scope_ids = threading.local()
+
+
+def generate_scope_id() -> int:
+    try:
+        return next(_scope_ids.counter)
+    except AttributeError:
+        block = next(_scope_id_blocks)
+        _scope_ids.counter = itertools.count(block * SCOPE_ID_BLOCK_SIZE + 1)
+        return next(_scope_ids.counter)
 
 
 def make_scope(parent: Optional[int]) -> Scope:
@@ -33,30 +52,63 @@ def _load_function(pipe: "deque[Instruction]", function: Union[Code, NativeFunct
         pipe.append(Put(function))
     elif function.flags & CodeFlags.PARENT_SCOPE or function.closure is None:
         pipe.extend(reversed(function.instructions))
+    elif pipe and pipe[-1].tag == "pop_scope":
+        # A tail call: the caller's scope is popped before the call instead
+        # of after it, so tail recursion doesn't grow the pipe or the scope stack
+        pipe.extend(reversed(function.instructions))
+        pipe.append(_make_scope_for(function))
+        pipe.append(PopScope())
     else:
         pipe.append(PopScope())
         pipe.extend(reversed(function.instructions))
-        pipe.append(MakeScope(function.closure))
+        pipe.append(_make_scope_for(function))
 
 
-def call(state: State, function: Union[Code, NativeFunction]) -> State:
+def _make_scope_for(function: Code) -> MakeScope:
+    flat = function.flags & CodeFlags.FLAT and function.bindings is None
+    return MakeScope(function.closure, function.bindings, flat=bool(flat))
+
+
+def call(state: State, function: Union[Code, NativeFunction], engine: Optional[str] = None) -> State:
     """
     Stackless implementation of calling a function.
 
     Instructions are piped into a deque, from which they're popped
     and executed one by one.
+
+    `engine` is one of the keys of `ENGINES`. By default, `DEFAULT_ENGINE`
+    is used.
     """
-    return call_with_middleware(state, function, lambda _, __, ___: None)
+    return get_engine(engine)(state, function, None)
 
 
 def call_with_middleware(
     state: State,
     function: Union[Code, NativeFunction],
     middleware: MiddlewareT,
+    engine: Optional[str] = None,
 ) -> State:
     """
     Like `call`, but execute some action on each change
     """
+    return get_engine(engine)(state, function, middleware)
+
+
+def _no_middleware(_: Instruction, __: Stack, ___: Stack):
+    pass
+
+
+def _call_reference(
+    state: State,
+    function: Union[Code, NativeFunction],
+    middleware: Optional[MiddlewareT],
+) -> State:
+    """
+    Reference engine: every instruction produces a new immutable `State`
+    """
+    if middleware is None:
+        middleware = _no_middleware
+
     pipe: "deque[Instruction]" = deque()
 
     _load_function(pipe, function)
@@ -64,7 +116,7 @@ def call_with_middleware(
     refcount = defaultdict(int, {builtin_scope.id: 1, global_scope.id: 1})
 
     def finalizer(scope_id: int):
-        future_callbacks.append((3, lambda: _real_finalizer(scope_id)))
+        finalizers.schedule(scope_id)
 
     def _real_finalizer(scope_id: int):
         nonlocal state
@@ -96,16 +148,10 @@ def call_with_middleware(
         if parent_id is not None:
             introducer(parent_id)
 
-    future_callbacks = []
+    finalizers = FinalizerQueue(_real_finalizer, FINALIZER_DELAY)
 
     while pipe:
-        new_future_callbacks = []
-        for (i, cb) in future_callbacks[:]:
-            if i <= 0:
-                cb()
-            else:
-                new_future_callbacks.append((i-1, cb))
-        future_callbacks = new_future_callbacks
+        finalizers.advance()
 
         instruction = pipe.pop()
 
@@ -136,11 +182,142 @@ def call_with_middleware(
 
         middleware(instruction, old_state.stack, state.stack)
 
-    for (_, cb) in future_callbacks:
-        cb()
+    finalizers.flush()
     return state
 
 
+class ScopeRefcounts:
+    """
+    Scope reference counting for engines running on a `Machine`
+
+    `Code` values created by the engine refer to `introduce` and `finalize`
+    through weak references, so a `Code` that outlives the engine doesn't
+    keep it alive. The scopes that reference counting misses are killed by
+    `collector`, which the engine runs when it's due.
+    """
+    def __init__(self, machine: Machine):
+        self.machine = machine
+        self.pinned_scopes = (builtin_scope.id, global_scope.id)
+        self.refcount = defaultdict(int, {scope_id: 1 for scope_id in self.pinned_scopes})
+        self.finalizers = FinalizerQueue(self._finalize_now, FINALIZER_DELAY)
+        self.introducer_ref = weakref.WeakMethod(self.introduce)
+        self.finalizer_ref = weakref.WeakMethod(self.finalize)
+        self.collector = ScopeCollector(machine, self.pinned_scopes, on_collect=self._forget)
+
+    def introduce(self, scope_id: int):
+        if scope_id in self.pinned_scopes:
+            return
+        self.refcount[scope_id] += 1
+        scope = self.machine.get_scope(scope_id)
+        if scope.persistent:
+            return
+        parent_id = scope.parent
+        if parent_id is not None:
+            self.introduce(parent_id)
+
+    def finalize(self, scope_id: int):
+        self.finalizers.schedule(scope_id)
+
+    def load(self, state: State):
+        """
+        Load the state returned by a native function into the machine
+        """
+        old_scope_stack = self.machine.scope_stack
+        self.machine.load(state)
+        scope_stack = self.machine.scope_stack
+        if (
+            len(old_scope_stack) == 3  # type: ignore
+            and len(scope_stack) == 2  # type: ignore
+            and scope_stack[1] is old_scope_stack[1]  # type: ignore
+        ):
+            # A flat frame got its own scope (see `State.enter_scope`), which
+            # the frame now holds instead of the closure's scope
+            self.refcount[scope_stack[0]] += 1  # type: ignore
+
+    def _forget(self, scope_id: int):
+        self.refcount.pop(scope_id, None)
+
+    def _finalize_now(self, scope_id: int):
+        if scope_id in self.pinned_scopes or scope_id not in self.machine.scopes:
+            # Pinned, or killed by the collector
+            return
+        self.refcount[scope_id] -= 1
+        scope = self.machine.get_scope(scope_id)
+        if scope.persistent:
+            return
+        parent_id = scope.parent
+        if parent_id is not None:
+            self._finalize_now(parent_id)
+        if self.refcount[scope_id] == 0:
+            self.machine.kill_scope(scope_id)
+            del self.refcount[scope_id]
+
+
+def _call_fast(
+    state: State,
+    function: Union[Code, NativeFunction],
+    middleware: Optional[MiddlewareT],
+) -> State:
+    """
+    Fast engine: the state is kept in a mutable `Machine`
+
+    An immutable `State` is only created when a native function needs one.
+    Functions that only transform the stack (see `NativeFunction.stack_fn`)
+    are called without materializing a `State` at all.
+
+    This is an `async_vm.Process` that runs to the end, calling asynchronous
+    functions synchronously.
+    """
+    from .async_vm import Process
+    process = Process(state, function)
+    process.run(suspend_on_io=False, middleware=middleware)
+    return process.result()
+
+
+EngineT = Callable[[State, Union[Code, NativeFunction], Optional[MiddlewareT]], State]
+
+def _call_bytecode(
+    state: State,
+    function: Union[Code, NativeFunction],
+    middleware: Optional[MiddlewareT],
+) -> State:
+    """
+    Bytecode engine: see `bytecode.py`
+    """
+    from . import bytecode
+    return bytecode.call(state, function, middleware)
+
+
+def _call_persistent(
+    state: State,
+    function: Union[Code, NativeFunction],
+    middleware: Optional[MiddlewareT],
+) -> State:
+    """
+    Persistent engine: supports `call/cc`, see `continuations.py`
+    """
+    from . import continuations
+    return continuations.call(state, function, middleware)
+
+
+ENGINES: Dict[str, EngineT] = {
+    "reference": _call_reference,
+    "fast": _call_fast,
+    "bytecode": _call_bytecode,
+    "persistent": _call_persistent,
+}
+
+DEFAULT_ENGINE = os.environ.get("GURKLANG_ENGINE", "reference")
+
+
+def get_engine(name: Optional[str] = None) -> EngineT:
+    if name is None:
+        name = DEFAULT_ENGINE
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine {name!r}, expected one of: {', '.join(ENGINES)}")
+    return ENGINES[name]
+
+
 ClosureCallback = Callable[[int], None]
 
 def execute(
@@ -161,6 +338,7 @@ def execute(
                 instructions=instruction.instructions,
                 closure=state.current_scope_id,
                 source_code=instruction.source_code,
+                flags=instruction.flags,
                 introducer=weakref.ref(introducer),
                 finalizer=weakref.ref(finalizer),
             ),
@@ -176,7 +354,11 @@ def execute(
 
     elif instruction.tag == "make_scope":
         new_id = generate_scope_id()
-        return state.make_scope(instruction.parent_id, new_id), (instruction.parent_id, new_id,), ()
+        return (
+            state.make_scope(instruction.parent_id, new_id, bindings=instruction.bindings),
+            (new_id,),
+            (),
+        )
 
     elif instruction.tag == "pop_scope":
         return state.pop_scope(), (), (state.current_scope_id,)
@@ -189,13 +371,18 @@ builtin_scope = prelude.module.make_scope(generate_scope_id())
 global_scope = make_scope(parent=builtin_scope.id)
 
 
-def run(instructions: Sequence[Instruction]):
-    return run_with_middleware(instructions, middleware = lambda _, __, ___: None)
+def run(instructions: Sequence[Instruction], engine: Optional[str] = None):
+    return call(
+        State.make(global_scope, builtin_scope),
+        Code(instructions, closure=None, name="<entry-point>", flags=CodeFlags.PARENT_SCOPE),
+        engine
+    )
 
 
-def run_with_middleware(instructions: Sequence[Instruction], middleware: MiddlewareT):
+def run_with_middleware(instructions: Sequence[Instruction], middleware: MiddlewareT, engine: Optional[str] = None):
     return call_with_middleware(
         State.make(global_scope, builtin_scope),
         Code(instructions, closure=None, name="<entry-point>", flags=CodeFlags.PARENT_SCOPE),
-        middleware
+        middleware,
+        engine
     )
@@ -1,5 +1,6 @@
-from .types import Scope, Stack, Value, Vec
-from typing import Any, Iterator, List, Dict
+from collections import deque
+from .types import ArrayStack, Scope, Stack, Value, Vec
+from typing import Any, Callable, Iterator, List, Dict, Tuple
 
 
 def stringify_value(v: Value, depth: int = 0):
@@ -44,12 +45,65 @@ def render_value_as_source(v: Value, depth: int = 0):
 
 def unwrap_stack(stack: Stack) -> Iterator[Value]:
     while stack is not None:
+        if type(stack) is ArrayStack:
+            yield from reversed(stack.items[:stack.size])  # type: ignore
+            return
         x, stack = stack  # type: ignore
         yield x
 
 
 def repr_stack(stack) -> List[Value]:
-    return [*unwrap_stack(stack)][::-1]
+    """
+    List the values on a stack, the topmost value last
+    """
+    top: List[Value] = []
+    while stack is not None and type(stack) is not ArrayStack:
+        x, stack = stack
+        top.append(x)
+    top.reverse()
+    if stack is None:
+        return top
+    return stack.items[:stack.size] + top
+
+
+def stack_depth(stack: Stack) -> int:
+    depth = 0
+    while stack is not None:
+        if type(stack) is ArrayStack:
+            return depth + stack.size  # type: ignore
+        depth += 1
+        stack = stack[1]
+    return depth
+
+
+def split_stack(stack: Stack, count: int) -> Tuple[List[Value], Stack]:
+    """
+    Take up to `count` values from the top of the stack, the topmost first
+    """
+    values: List[Value] = []
+    while stack is not None and len(values) < count:
+        if type(stack) is ArrayStack:
+            size = stack.size  # type: ignore
+            taken = min(count - len(values), size)
+            values.extend(reversed(stack.items[size - taken:size]))  # type: ignore
+            return values, ArrayStack(stack.items, size - taken) if taken < size else None  # type: ignore
+        x, stack = stack  # type: ignore
+        values.append(x)
+    return values, stack
+
+
+def peek(stack: Stack, index: int) -> Value:
+    """
+    Get the value `index` places below the top of the stack
+    """
+    while stack is not None:
+        if type(stack) is ArrayStack:
+            return stack.peek(index)  # type: ignore
+        if index == 0:
+            return stack[0]
+        index -= 1
+        stack = stack[1]
+    raise IndexError(index)
 
 
 def stringify_stack(stack: Stack, max_depth: int = 0):
@@ -74,3 +128,48 @@ def tuple_equals(x: Vec, y: Vec, fail) -> bool:
         elif x_val != y_val:
             return False
     return True
+
+
+class FinalizerQueue:
+    """
+    Deadline-ordered queue of scopes waiting to be finalized.
+
+    The interpreter advances the queue once per instruction. A scope
+    scheduled for finalization is passed to `callback` after `delay` more
+    instructions have been executed.
+
+    Since every entry is scheduled with the same delay, deadlines are
+    non-decreasing in insertion order, so a plain FIFO is already sorted:
+    scheduling and running finalizers are both O(1) amortized, no matter
+    how many finalizers are pending.
+    """
+    __slots__ = ("callback", "delay", "tick", "_queue")
+
+    def __init__(self, callback: Callable[[int], None], delay: int):
+        self.callback = callback
+        self.delay = delay
+        self.tick = 0
+        self._queue: "deque[Tuple[int, int]]" = deque()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def schedule(self, scope_id: int):
+        self._queue.append((self.tick + self.delay + 1, scope_id))
+
+    def advance(self):
+        """
+        Move to the next instruction and run the finalizers that became due
+        """
+        tick = self.tick = self.tick + 1
+        queue = self._queue
+        while queue and queue[0][0] <= tick:
+            self.callback(queue.popleft()[1])
+
+    def flush(self):
+        """
+        Run all pending finalizers right away
+        """
+        queue = self._queue
+        while queue:
+            self.callback(queue.popleft()[1])
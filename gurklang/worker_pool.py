@@ -0,0 +1,213 @@
+"""
+Pool of warm interpreter threads for `threading`
+
+Every worker owns a deque of tasks. Tasks submitted from outside the pool
+are dealt to the workers in turn, tasks submitted by a running task go to
+the deque of its own worker. A worker takes tasks from the front of its own
+deque, and when it runs out it steals from the back of the others.
+
+A worker waiting for a task doesn't block: it runs other tasks until the
+one it waits for is done, so tasks can submit and await other tasks without
+running out of workers.
+"""
+import os
+import threading
+from collections import deque
+from itertools import count
+from typing import Callable, Deque, List, Optional
+
+from .resolver import detach
+from .types import Code, Instruction, Stack, State
+
+DEFAULT_SIZE = int(os.environ.get("GURKLANG_WORKERS", 0)) or os.cpu_count() or 4
+
+
+class Task:
+    __slots__ = ("function", "stack", "on_done", "done", "result", "error")
+
+    def __init__(self, function: Code, stack: Stack, on_done: Optional[Callable[["Task"], None]]):
+        self.function = function
+        self.stack = stack
+        self.on_done = on_done
+        self.done = threading.Event()
+        self.result: Stack = None
+        self.error: Optional[BaseException] = None
+
+
+class _Worker:
+    def __init__(self, pool: "WorkerPool", index: int):
+        self.pool = pool
+        self.index = index
+        self.tasks: Deque[Task] = deque()
+        # Only the worker's own thread steals for it, so the count needs no lock
+        self.steals = 0
+        self.thread = threading.Thread(name=f"gurklang-worker-{index}", target=self._loop, daemon=True)
+
+    def _loop(self):
+        self.pool._local.worker = self
+        while self.run_one() or not self.pool._closed:
+            self.pool._wait_for_work()
+
+    def run_one(self) -> bool:
+        task = self.pool._take(self)
+        if task is None:
+            return False
+        self.pool._run(task)
+        return True
+
+
+class WorkerPool:
+    """
+    A fixed number of interpreter threads that run tasks
+    """
+    def __init__(self, size: int = DEFAULT_SIZE):
+        if size < 1:
+            raise ValueError(f"A pool needs at least one worker, got {size}")
+        from . import vm
+        # The start state is immutable, so all tasks can share it
+        self._start = State.make(vm.global_scope, vm.builtin_scope)
+        self._call: Callable[[State, Code], State] = vm.call
+        self._local = threading.local()
+        self._next_worker = count()
+        self._pending = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self.workers = [_Worker(self, i) for i in range(size)]
+        for worker in self.workers:
+            worker.thread.start()
+
+    @property
+    def size(self) -> int:
+        return len(self.workers)
+
+    @property
+    def steals(self) -> int:
+        """
+        How many tasks workers took from the deques of other workers
+        """
+        return sum(worker.steals for worker in self.workers)
+
+    def submit(
+        self,
+        instructions: List[Instruction],
+        name: str,
+        source_code: Optional[str],
+        stack: Stack,
+        on_done: Optional[Callable[[Task], None]] = None,
+    ) -> Task:
+        """
+        Queue a function to run on a stack
+
+        `on_done` is called with the task on the worker thread when it's done.
+        """
+        # The function runs in the worker's global scope, not in its closure
+        code = Code(list(detach(instructions)), None, name=name, source_code=source_code)
+        task = Task(code, stack, on_done)
+        worker: Optional[_Worker] = getattr(self._local, "worker", None)
+        if worker is None:
+            worker = self.workers[next(self._next_worker) % len(self.workers)]
+        worker.tasks.append(task)
+        with self._condition:
+            self._pending += 1
+            self._condition.notify()
+        return task
+
+    def wait(self, task: Task) -> Stack:
+        """
+        Wait for a task and return its resulting stack
+
+        On a worker thread, other tasks are run in the meantime.
+        """
+        self.wait_until(task.done)
+        if task.error is not None:
+            raise task.error
+        return task.result
+
+    def wait_until(self, event: threading.Event):
+        """
+        Wait for an event, running other tasks in the meantime on a worker thread
+        """
+        worker: Optional[_Worker] = getattr(self._local, "worker", None)
+        if worker is not None:
+            while not event.is_set():
+                if not worker.run_one():
+                    event.wait(0.001)
+        event.wait()
+
+    def close(self):
+        """
+        Stop the workers once they have run all submitted tasks
+
+        Called on one of the pool's own workers, it doesn't wait for that
+        worker, which stops when the task it's running returns.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        current = threading.current_thread()
+        for worker in self.workers:
+            if worker.thread is not current:
+                worker.thread.join()
+
+    def _take(self, worker: _Worker) -> Optional[Task]:
+        try:
+            task = worker.tasks.popleft()
+        except IndexError:
+            task = self._steal(worker)
+            if task is None:
+                return None
+        with self._condition:
+            self._pending -= 1
+        return task
+
+    def _steal(self, thief: _Worker) -> Optional[Task]:
+        n = len(self.workers)
+        for offset in range(1, n):
+            victim = self.workers[(thief.index + offset) % n]
+            try:
+                task = victim.tasks.pop()
+            except IndexError:
+                continue
+            thief.steals += 1
+            return task
+        return None
+
+    def _wait_for_work(self):
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+
+    def _run(self, task: Task):
+        try:
+            task.result = self._call(self._start.with_stack(task.stack), task.function).stack
+        except BaseException as e:
+            task.error = e
+        task.done.set()
+        if task.on_done is not None:
+            task.on_done(task)
+
+
+_pool: Optional[WorkerPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> WorkerPool:
+    """
+    The shared pool, created on first use
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool()
+        return _pool
+
+
+def set_pool_size(size: int):
+    """
+    Replace the shared pool with one of a different size
+    """
+    global _pool
+    with _pool_lock:
+        old, _pool = _pool, WorkerPool(size)
+    if old is not None:
+        old.close()
@@ -0,0 +1,17 @@
+import os
+
+import pytest
+
+
+@pytest.fixture(scope="session", autouse=True)
+def program_cache_dir(tmp_path_factory):
+    """
+    Keep programs parsed by the tests out of the user's cache
+    """
+    old = os.environ.get("GURKLANG_CACHE_DIR")
+    os.environ["GURKLANG_CACHE_DIR"] = str(tmp_path_factory.mktemp("gurklang-cache"))
+    yield
+    if old is None:
+        del os.environ["GURKLANG_CACHE_DIR"]
+    else:
+        os.environ["GURKLANG_CACHE_DIR"] = old
@@ -1,4 +1,4 @@
-from pytest import raises
+from pytest import mark, raises
 
 from tests.test_examples import run, number_stack
 
@@ -106,3 +106,57 @@ def test_empty_stack_does_not_crash():
         run('{ (.){1} (){2} } case')
         == run('2')
     )
+
+
+def test_invalid_dot_pattern_fails():
+    with raises(RuntimeError):
+        run('1 { (.x) {} } case')
+
+
+def _values(source: str):
+    from gurklang.vm_utils import repr_stack
+    return [*repr_stack(run(source))]
+
+
+@mark.parametrize("patterns", [
+    "(b _ ()) (b f (a as))",
+    "(1 2 4) (1 2 3) (.) ()",
+    "((:rect . .)) ((:sqr x y)) (_)",
+    "(. ... .. .) ((. (.. (. .) ..) ..)) ((. .3 .2 .))",
+    "(x :a) (:a x) ('s' 's') ((a (b c)) d)",
+])
+def test_compiled_case_agrees_with_interpreted(patterns: str):
+    from gurklang.pattern_matching import CaseMatcher
+    from gurklang.prelude import _matches
+
+    compiled = CaseMatcher(_values(patterns))
+    stacks = [
+        "", "1", "1 2 3", "1 2 4", "(rect 1 2)", "(sqr 1 2)", ":a :a", "2 :a", ":a 'b'", "'s' 's'",
+        "(1 (2 (3 4) 5) 6)", "(1 2 3 4)", "1 2 3 4 5", "1 (+) (1 ())", "0 (0 0) ((1 (2 3)) 4)",
+    ]
+    for source in stacks:
+        stack = run(source)
+        expected = None
+        for i, pattern in enumerate(_values(patterns)):
+            matched = _matches(pattern, stack, lambda reason: None)
+            if matched is not None:
+                expected = (i, matched[0], matched[1])
+                break
+        actual = compiled.match(stack)
+        if actual is not None:
+            actual = (actual[0], actual[1], dict(actual[2]))
+        assert actual == expected, source
+
+
+def test_case_does_not_copy_actions():
+    from gurklang.prelude import _bind_variables
+    from gurklang.types import Int
+    (action, _) = run('{ a }')
+    bound = _bind_variables(action, [("a", Int(1))])
+    assert bound.instructions is action.instructions
+    assert [*bound.bindings] == ["a"]
+    assert _bind_variables(action, []) is action
+
+
+def test_case_variables_shadow_outer_names():
+    assert run('1 :a def { 2 { (a) { a } } case a } !') == number_stack(2, 1)
@@ -0,0 +1,36 @@
+from pytest import raises
+
+from ..test_examples import run
+
+
+def test_generator_yields_values():
+    assert run("""
+    :coro (generator yield) import
+    { 1 yield 2 yield 3 yield } generator
+    ! swap ! swap ! swap ! nip
+    """) == run("1 2 3 :stream-end")
+
+
+def test_generator_keeps_its_stack():
+    assert run("""
+    :coro (generator yield) import
+    :math (+) import
+    { 10 20 30 dup yield + dup yield + yield } generator
+    ! swap ! swap ! nip
+    """) == run("30 50 60")
+
+
+def test_generator_steps_are_values():
+    assert run("""
+    :coro (generator yield) import
+    { :a yield :b yield } generator
+    :g def
+    g ! nip
+    g ! nip
+    g ! drop ! nip
+    """) == run(":a :a :b")
+
+
+def test_yield_outside_of_generator():
+    with raises(RuntimeError, match="outside of a generator"):
+        run(":coro (yield) import 1 yield")
@@ -0,0 +1,50 @@
+import time
+
+from pytest import raises
+
+from gurklang.stdlib_modules import green
+from tests.test_examples import run
+
+
+def test_spawn_and_join():
+    assert run("""
+    :green (spawn join) import
+    :math (+) import
+    { 1 + } (41 ()) spawn :t def
+    { :green (join) import t join } () spawn join
+    """) == run("((42 ()) ())")
+
+
+def test_sleeping_threads_overlap():
+    start = time.perf_counter()
+    assert run("""
+    :green (spawn join) import
+    { (1 5) sleep :x } () spawn :a def
+    { (1 5) sleep :y } () spawn :b def
+    { (1 5) sleep :z } () spawn :c def
+    c join b join a join
+    """) == run("(z ()) (y ()) (x ())")
+    assert time.perf_counter() - start < 1
+
+
+def test_threads_are_preempted():
+    before = green.get_scheduler().switches
+    run("""
+    :green (spawn join) import
+    :math (-) import
+    { { (0) { } (n) { n 1 - loop } } case } :loop jar
+    { 2000 loop } () spawn :a def
+    { 2000 loop } () spawn :b def
+    a join b join
+    """)
+    assert green.get_scheduler().switches - before > 10
+
+
+def test_join_rejects_other_functions():
+    with raises(RuntimeError, match="not a green thread"):
+        run(":green (join) import { } join")
+
+
+def test_sleep_rejects_invalid_durations():
+    with raises(RuntimeError, match="Invalid duration"):
+        run(':green (spawn join) import { "soon" sleep } () spawn join')
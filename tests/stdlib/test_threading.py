@@ -0,0 +1,73 @@
+import pickle
+
+from pytest import raises
+
+from gurklang import serialization
+from gurklang.types import Atom, Code, Int, Put, Vec
+from tests.test_examples import run
+
+
+def test_run_parallel():
+    assert run("""
+    :threading (run-parallel) import
+    ( { :math (+) import 1 2 + }
+      { :math (*) import dup * }
+      { swap } )
+    ( () (7 ()) (1 (2 ())) )
+    run-parallel
+    """) == run("((3 ()) (49 ()) (2 (1 ())))")
+
+
+def test_run_parallel_rejects_boxes():
+    with raises(RuntimeError, match="boxes"):
+        run(":threading (run-parallel) import :boxes (box) import ({ }) { { 1 box } ] } , run-parallel")
+
+
+def test_run_parallel_rejects_local_closures():
+    with raises(RuntimeError, match="local scope"):
+        run(":threading (run-parallel) import ({ }) { { { 1 :x def { x } } ! } ] } , run-parallel")
+
+
+def test_atoms_survive_serialization():
+    (value,) = pickle.loads(pickle.dumps((Atom("abc"),)))
+    assert value == Atom("abc")
+    assert serialization.loads(serialization.dumps(Vec([Atom("abc"), Int(1)]))) == Vec([Atom("abc"), Int(1)])
+
+
+def test_global_code_is_serialized():
+    from gurklang.vm import global_scope
+    code = Code([Put(Int(1))], global_scope.id, name="one")
+    copy = serialization.loads(serialization.dumps(code))
+    assert copy.closure == global_scope.id
+    assert copy.instructions == [Put(Int(1))]
+    assert serialization.stack_to_list(serialization.list_to_stack([Int(1), Int(2)])) == [Int(1), Int(2)]
+
+
+def test_submit_and_await():
+    assert run("""
+    :threading (submit await) import
+    { :math (+) import 1 + } (1 ()) submit :a def
+    { :threading (submit await) import { 5 } () submit await } () submit :b def
+    b await a await
+    """) == run("((5 ()) ()) (2 ())")
+
+
+def test_await_rejects_other_functions():
+    with raises(RuntimeError, match="not a task"):
+        run(":threading (await) import { } await")
+
+
+def test_stream_concurrently():
+    assert run("""
+    :threading (stream-concurrently set-pool-size) import
+    2 set-pool-size
+    ( { (1 10) sleep :slow } { :fast } ) ( () () ) stream-concurrently
+    ! swap ! swap ! nip
+    """) == run("(1 (fast ())) (0 (slow ())) :stream-end")
+
+
+def test_set_pool_size_in_a_task():
+    assert run("""
+    :threading (submit await) import
+    { :threading (set-pool-size) import 3 set-pool-size :resized } () submit await
+    """) == run("(resized ())")
@@ -0,0 +1,72 @@
+import pickle
+
+import pytest
+import gurklang.vm as vm
+from gurklang.builtin_utils import stack_to_vec, vec_to_stack
+from gurklang.parser import parse
+from gurklang.types import ArrayStack, Code, Int, State
+from gurklang.vm_utils import peek, repr_stack, split_stack, stack_depth
+
+
+def ints(*values: int):
+    return ArrayStack.from_values([Int(v) for v in values])
+
+
+def test_destructures_like_a_tuple_stack():
+    (a, (b, rest)) = ints(1, 2, 3)
+    assert (a, b) == (Int(3), Int(2))
+    assert rest == (Int(1), None)
+    assert ints(1)[1] is None
+
+
+def test_pushing_shares_the_list_until_stacks_diverge():
+    base = ints(1, 2)
+    top = base.push(Int(3))
+    assert type(top) is ArrayStack and top.items is base.items  # type: ignore
+    other = base.push(Int(4))
+    assert other == (Int(4), (Int(2), (Int(1), None)))
+    assert top == (Int(3), (Int(2), (Int(1), None)))
+
+
+def test_branches_leave_nothing_in_the_shared_list():
+    import threading
+    base = ints(1, 2)
+
+    def branch(value: int):
+        for _ in range(1000):
+            base.push(Int(value))
+
+    threads = [threading.Thread(target=branch, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Only the first push appended, the others fell back to tuples
+    assert len(base.items) == 3  # type: ignore
+    assert base.push(Int(5)) == (Int(5), (Int(2), (Int(1), None)))
+    assert len(base.items) == 3  # type: ignore
+
+
+def test_indexing():
+    stack = (Int(5), ints(1, 2, 3, 4))
+    assert stack_depth(stack) == 5
+    assert [peek(stack, i).value for i in range(5)] == [5, 4, 3, 2, 1]  # type: ignore
+    with pytest.raises(IndexError):
+        peek(stack, 5)
+    (values, rest) = split_stack(stack, 3)
+    assert [v.value for v in values] == [5, 4, 3]  # type: ignore
+    assert rest == ints(1, 2)
+    assert repr_stack(stack) == [Int(i) for i in range(1, 6)]
+
+
+def test_vec_conversions_round_trip():
+    stack = ints(1, 2, 3)
+    assert vec_to_stack(stack_to_vec(stack), None) == stack  # type: ignore
+    assert pickle.loads(pickle.dumps(stack)) == stack
+
+
+def test_programs_run_on_array_stacks():
+    state = State.make(vm.global_scope, vm.builtin_scope).with_stack(ints(1, 2, 3))
+    program = parse(":math ( + ) import + + 10 swap")
+    state = vm.call(state, Code(program, closure=None, name="test"))
+    assert repr_stack(state.stack) == [Int(10), Int(6)]
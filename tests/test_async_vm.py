@@ -0,0 +1,42 @@
+import asyncio
+import time
+
+import pytest
+import gurklang.vm as vm
+from gurklang.async_vm import Process, run_async
+from gurklang.parser import parse
+from gurklang.types import CodeFlags, Code, Int, State
+
+from .test_engines import PROGRAMS, outcome
+
+
+@pytest.mark.parametrize("source", PROGRAMS)
+def test_async_agrees_with_reference(source: str):
+    try:
+        actual = asyncio.run(run_async(parse(source))).stack
+    except Exception as e:
+        actual = type(e)
+    assert actual == outcome(parse(source), "reference")
+
+
+def test_sleeps_overlap():
+    program = parse(":math (+) import (1 10) sleep 1 2 +")
+
+    async def main():
+        return await asyncio.gather(*[run_async(program) for _ in range(20)])
+
+    start = time.perf_counter()
+    states = asyncio.run(main())
+    assert time.perf_counter() - start < 1
+    assert all(state.stack == (Int(3), None) for state in states)
+
+
+def test_process_runs_in_slices():
+    process = Process(
+        State.make(vm.global_scope, vm.builtin_scope),
+        Code(parse("1 2 3 4 5"), closure=None, flags=CodeFlags.PARENT_SCOPE),
+    )
+    assert process.run(budget=2) == 2
+    assert process.machine.stack == (Int(2), (Int(1), None))
+    assert process.run() == 3
+    assert process.done
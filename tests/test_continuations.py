@@ -0,0 +1,40 @@
+import pytest
+import gurklang.vm as vm
+from gurklang.parser import parse
+from gurklang.types import Int
+
+
+def run(source: str):
+    return vm.run(parse(":continuations (call/cc) import " + source), engine="persistent").stack
+
+
+def test_escape():
+    assert run(":math (+) import { :k def 1 2 k ! 3 4 } call/cc 10 +") == (Int(12), (Int(1), None))
+
+
+def test_escape_from_deep_recursion():
+    # `foldr` goes from the right, so the sum stops at -5
+    assert run("""
+    :math (+ <) import
+    :recursion (foldr) import
+    { :exit def
+      0 { :x def x 0 < { x exit ! } { } if ! x + } (1 (2 (-5 (3 ())))) foldr
+    } call/cc
+    """) == (Int(-5), (Int(3), None))
+
+
+def test_reentry():
+    assert run("""
+    :math (+ <) import
+    :boxes (box <= ->) import
+    0 box :b def
+    { } call/cc
+    b { 1 + } <=
+    b -> 3 < { dup ! } { drop } if !
+    b ->
+    """) == (Int(3), None)
+
+
+def test_other_engines_refuse_call_cc():
+    with pytest.raises(RuntimeError):
+        vm.run(parse(":continuations (call/cc) import { } call/cc"), engine="fast")
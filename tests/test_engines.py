@@ -0,0 +1,243 @@
+import pytest
+import gurklang.vm as vm
+from gurklang.parser import parse
+from gurklang.types import Atom, Int, Machine, Str
+
+
+PROGRAMS = [
+    """
+    :math (* -) import
+    { { (1) {}
+        (. .) { dup 1 - unrot * swap n! }
+      } case
+    } :n! jar
+    1 10 n!
+    """,
+    """
+    :math ( + ) import
+    { :f def :x def { x f ! } } :my-close jar
+    { { + } my-close } :make-adder jar
+    5 make-adder :add5 jar
+    37 add5 40 add5
+    """,
+    """
+    :boxes ( box -> <= ) import
+    :math ( + ) import
+    1 box :b def
+    b { 41 + } <=
+    b ->
+    """,
+    """
+    1 :x def
+    { { x } :get jar
+      get
+      2 :x def
+      get
+    } !
+    """,
+    """
+    { { y } } :make-getter jar
+    make-getter :get-global jar
+    { 5 :y def make-getter } ! :get-local jar
+    7 :y def
+    get-global get-local get-global get-local
+    """,
+    """
+    :recursion :all import
+    :math :all import
+    0 {+} (1 (2 (3 (4 ())))) foldr
+    1 { 2 } close ! (a b) {1 2 3}, swap
+    """,
+    """
+    :math (+) import
+    { 1 2 swap 3 + } :f jar
+    f
+    { drop } :swap jar
+    f
+    """,
+    """
+    { :x def } parent-scope :define-x jar
+    { define-x x } :f jar
+    1 f 2 f
+    { { x } 9 define-x ! } :g jar
+    g
+    """,
+    """
+    { :x def } parent-scope :define-x jar
+    { 5 define-x } :f jar
+    f
+    { x } :get jar
+    get
+    """,
+    """
+    { :x def } parent-scope :define-x jar
+    { 5 :y def 6 define-x } :f jar
+    f x
+    """,
+]
+
+
+def outcome(program, engine: str):
+    """
+    The resulting stack of a program, or the type of the error it fails with
+    """
+    try:
+        return vm.run(program, engine=engine).stack
+    except Exception as e:
+        return type(e)
+
+
+@pytest.mark.parametrize("engine", [*vm.ENGINES])
+@pytest.mark.parametrize("source", PROGRAMS)
+def test_engines_agree_with_reference(engine: str, source: str):
+    assert outcome(parse(source), engine) == outcome(parse(source), "reference")
+
+
+@pytest.mark.parametrize("engine", [*vm.ENGINES])
+def test_middleware_sees_every_stack(engine: str):
+    stacks = []
+    vm.run_with_middleware(parse("1 2 drop"), lambda _, __, new: stacks.append(new), engine=engine)
+    assert stacks[-1] == stacks[0]
+
+
+@pytest.mark.parametrize("engine", [*vm.ENGINES])
+@pytest.mark.parametrize("source", ["{ dup + } !", ":math (+) import 'a' { 1 + } !"])
+def test_engines_fail_alike(engine: str, source: str):
+    with pytest.raises(RuntimeError):
+        vm.run(parse(source), engine=engine)
+
+
+def test_stack_effects_match_implementations():
+    from gurklang.builtin_utils import specializations
+    for name, specialization in specializations.items():
+        inputs = {}
+        stack = None
+        for i, (input_name, tag) in enumerate(specialization.effect.inputs):
+            value = Int(i) if tag == "int" else Str(str(i))
+            inputs[input_name] = value
+            stack = (value, stack)
+
+        outputs = []
+        stack = specialization.direct(stack)
+        while stack is not None:
+            value, stack = stack
+            outputs.append(value)
+        outputs.reverse()
+
+        assert len(outputs) == len(specialization.effect.outputs), name
+        for value, (output_name, tag) in zip(outputs, specialization.effect.outputs):
+            if output_name in inputs:
+                assert value is inputs[output_name], name
+            else:
+                assert tag is None or value.tag == tag, name
+
+
+def test_scope_ids_are_unique_across_threads():
+    import threading
+    ids = []
+
+    def allocate():
+        ids.extend(vm.generate_scope_id() for _ in range(1000))
+
+    threads = [threading.Thread(target=allocate) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == len(ids)
+    assert len({scope_id // vm.SCOPE_ID_BLOCK_SIZE for scope_id in ids}) == 4
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        vm.run(parse("1"), engine="warp-drive")
+
+
+def test_superinstructions():
+    from gurklang import bytecode
+    block = bytecode.compile(parse("1 2 (3 (a b) ()) dup { } !"))
+    ops = block.code[::2]
+    assert ops[0] == bytecode.PUT_PUT
+    assert bytecode.PUT_VEC in ops
+    assert bytecode.CALL_NAME in ops
+
+    with bytecode.profiling() as profile:
+        state = vm.run(parse("1 2 (3 (a b) ()) dup { } !"), engine="bytecode")
+    assert state.stack == vm.run(parse("1 2 (3 (a b) ()) dup { } !"), engine="reference").stack
+    assert 0 < profile.hit_rate() < 1
+
+
+
+@pytest.mark.parametrize("source, fused_op, then_op", [
+    # `dup` is redefined, so a `DIRECT_RUN` continues without specializations after `swap`
+    ("{ 1 2 swap dup 3 } :f jar { drop } :dup jar f", "DIRECT_RUN", "CALL_NAME"),
+    # The first function is code, so it returns to the second `CALL_NAME`
+    ("{ 1 } :one jar { 2 } :two jar { one two 3 } :f jar f one two", "CALL_NAME_NAME", "CALL_NAME"),
+])
+def test_superinstructions_without_middleware(source: str, fused_op: str, then_op: str):
+    from gurklang import bytecode
+    with bytecode.profiling() as profile:
+        state = vm.run(parse(source), engine="bytecode")
+    assert state.stack == vm.run(parse(source), engine="reference").stack
+    assert profile.ops[getattr(bytecode, fused_op)] > 0
+    assert profile.ops[getattr(bytecode, then_op)] > 0
+
+@pytest.mark.parametrize("engine", [*vm.ENGINES])
+@pytest.mark.parametrize("loop", [
+    "{ { (0) { } (n) { probe n 1 - loop } } case } :loop jar",
+    "{ dup 0 = { drop } { probe 1 - loop } if ! } :loop jar",
+])
+def test_tail_calls_run_in_constant_space(engine: str, loop: str):
+    from gurklang.types import Code, CodeFlags, NativeFunction, State
+    depths = []
+
+    def probe(state: State):
+        depth, scope_stack = 0, state.scope_stack
+        while scope_stack is not None:
+            depth, scope_stack = depth + 1, scope_stack[1]
+        depths.append(depth)
+        return state
+
+    global_scope = vm.global_scope.with_member("probe", NativeFunction(probe, "probe"))
+    program = parse(f":math (-) import {loop} 500 loop")
+    vm.call(
+        State.make(global_scope, vm.builtin_scope),
+        Code(program, closure=None, flags=CodeFlags.PARENT_SCOPE),
+        engine,
+    )
+    assert len(depths) == 500
+    assert max(depths) == min(depths)
+
+
+@pytest.mark.parametrize("engine", ["reference", "fast", "bytecode"])
+def test_nested_scopes_are_killed(engine: str):
+    state = vm.run(parse(":math (-) import { { 1 - } ! } :f jar 50 f f f f f f f f f f"), engine=engine)
+    assert len(state.scopes) < 5
+
+
+@pytest.mark.parametrize("engine", ["fast", "bytecode", "persistent"])
+def test_flat_functions_make_no_scope(engine: str, monkeypatch):
+    made = []
+    make_scope = Machine.make_scope
+    monkeypatch.setattr(Machine, "make_scope", lambda *args: made.append(1) or make_scope(*args))
+    vm.run(parse(":math (+) import { 1 + } :inc jar 1 inc inc inc inc inc"), engine=engine)
+    assert len(made) < 5
+
+
+@pytest.mark.parametrize("engine", ["fast", "bytecode", "persistent"])
+def test_collector_bounds_the_scope_table(engine: str, monkeypatch):
+    from gurklang import scope_gc
+    monkeypatch.setattr(scope_gc, "THRESHOLD", 100)
+    collected = scope_gc.stats.scopes_collected
+    state = vm.run(parse(
+        """
+        :math (-) import
+        { { 1 } :one jar one } :f jar
+        { { (0) { } (n) { f drop n 1 - loop } } case } :loop jar
+        { :kept } :g jar
+        1000 loop g
+        """
+    ), engine=engine)
+    assert len(state.scopes) < 300
+    assert scope_gc.stats.scopes_collected > collected
+    assert state.stack == (Atom("kept"), None)
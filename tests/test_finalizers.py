@@ -0,0 +1,41 @@
+from gurklang.vm_utils import FinalizerQueue
+
+
+def test_finalizer_runs_after_delay_instructions():
+    finalized = []
+    queue = FinalizerQueue(finalized.append, delay=3)
+    queue.advance()
+    queue.schedule(42)
+    for _ in range(3):
+        queue.advance()
+        assert finalized == []
+    queue.advance()
+    assert finalized == [42]
+
+
+def test_finalizers_run_in_scheduling_order():
+    finalized = []
+    queue = FinalizerQueue(finalized.append, delay=1)
+    queue.schedule(1)
+    queue.schedule(2)
+    queue.advance()
+    queue.schedule(3)
+    queue.advance()
+    assert finalized == [1, 2]
+    queue.flush()
+    assert finalized == [1, 2, 3]
+    assert len(queue) == 0
+
+
+def test_finalizer_scheduled_by_finalizer_is_deferred():
+    finalized = []
+    def callback(scope_id: int):
+        finalized.append(scope_id)
+        if scope_id > 0:
+            queue.schedule(scope_id - 1)
+    queue = FinalizerQueue(callback, delay=0)
+    queue.schedule(2)
+    queue.advance()
+    assert finalized == [2]
+    queue.advance()
+    assert finalized == [2, 1]
@@ -0,0 +1,56 @@
+import pytest
+import gurklang.vm as vm
+from gurklang.optimizer import count_instructions, parse as optimize_and_parse
+from gurklang.parser import parse
+from tests.test_engines import PROGRAMS, outcome
+
+CAPTURED_BUILTINS = [
+    ":math (+) import { (+) { 1 2 + } } :arms def 5 arms case",
+    "{ (if) { :true 1 2 if } } :arms def 5 arms case",
+]
+
+FOLDABLE = [
+    ":math :all import 2 3 * 1 +",
+    ":math (< -) import 1 2 < { 10 } { 20 } if ! 5 3 - 4 =",
+    '{ :math (%) import "a" "b" = not { 7 3 % } { 0 } if ! } !',
+]
+
+
+@pytest.mark.parametrize("source, expected", [
+    (":math :all import 2 3 * 1 +", ":math :all import 7"),
+    (":true { a } { b } if !", "{ a } !"),
+    (":math (<) import 1 2 < { 1 } { 2 } if", ":math (<) import { 1 }"),
+    ('"a" "a" = :false not', ":true :true"),
+])
+def test_folds(source: str, expected: str):
+    assert optimize_and_parse(source) == parse(expected)
+
+
+def test_folds_nested_code():
+    [code, _] = optimize_and_parse("{ :math (*) import 2 3 * } !")
+    assert code.instructions == parse(":math (*) import 6")
+
+
+@pytest.mark.parametrize("source", [
+    "1 2 +",
+    "1 2 + :math (+) import",
+    ":math (+) import { * } :+ jar 1 2 +",
+    ":math (/) import 1 0 /",
+    "{ drop } :if jar :true 1 2 if",
+    ":math :all import :x forget 1 2 +",
+    "1 :x def x x =",
+    *CAPTURED_BUILTINS,
+])
+def test_leaves_calls_that_might_not_be_builtins(source: str):
+    assert optimize_and_parse(source) == parse(source)
+
+
+@pytest.mark.parametrize("engine", [*vm.ENGINES])
+@pytest.mark.parametrize("source", PROGRAMS + FOLDABLE + CAPTURED_BUILTINS)
+def test_optimized_programs_agree_with_reference(engine: str, source: str):
+    assert outcome(optimize_and_parse(source), engine) == outcome(parse(source), "reference")
+
+
+def test_count_instructions():
+    assert count_instructions(parse(FOLDABLE[2])) == 18
+    assert count_instructions(optimize_and_parse(FOLDABLE[2])) == 9
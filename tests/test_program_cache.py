@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+import pytest
+from gurklang import optimizer, parser, program_cache
+
+SOURCE = """
+:math (+ *) import
+{ :x def { x 2 * } :double jar 1 2 + double } :f jar
+"""
+
+
+def addresses(instructions):
+    for instruction in instructions:
+        if instruction.tag == "call":
+            yield instruction.address
+        elif instruction.tag == "put_code":
+            yield from addresses(instruction.instructions)
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("GURKLANG_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(program_cache, "_memory", OrderedDict())
+    return tmp_path
+
+
+def test_hits_load_without_tokenizing(cache, monkeypatch):
+    expected = optimizer.parse(SOURCE)
+    assert program_cache.parse(SOURCE) == expected
+    assert len(list(cache.glob("*.pickle"))) == 1
+
+    program_cache._memory.clear()
+
+    def lex(source):
+        raise AssertionError("tokenized a cached program")
+    monkeypatch.setattr(parser, "lex", lex)
+    loaded = program_cache.parse(SOURCE)
+    assert loaded == expected
+    assert list(addresses(loaded)) == list(addresses(expected))
+
+
+def test_keys_depend_on_the_interpreter(cache, monkeypatch):
+    key = program_cache.source_key(SOURCE)
+    assert program_cache.source_key(SOURCE + " ") != key
+    monkeypatch.setattr(program_cache, "_interpreter_hash", "another interpreter")
+    assert program_cache.source_key(SOURCE) != key
+
+
+def test_corrupt_entries_are_parsed_again(cache):
+    (cache / f"{program_cache.source_key(SOURCE)}.pickle").write_bytes(b"garbage")
+    assert program_cache.parse(SOURCE) == optimizer.parse(SOURCE)
+    program_cache._memory.clear()
+    assert program_cache.parse(SOURCE) == optimizer.parse(SOURCE)
+
+
+def test_empty_cache_dir_turns_the_cache_off(cache, monkeypatch):
+    monkeypatch.setenv("GURKLANG_CACHE_DIR", "")
+    assert program_cache.parse(SOURCE) == optimizer.parse(SOURCE)
+    assert list(cache.iterdir()) == []
+
+
+def test_memory_keeps_the_most_recent_programs(cache, monkeypatch):
+    monkeypatch.setenv("GURKLANG_CACHE_DIR", "")
+    monkeypatch.setattr(program_cache, "MEMORY_SIZE", 2)
+    for source in ["1", "2", "1", "3"]:
+        program_cache.parse(source)
+    assert list(program_cache._memory) == [program_cache.source_key("1"), program_cache.source_key("3")]
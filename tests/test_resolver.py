@@ -0,0 +1,66 @@
+import pytest
+import gurklang.vm as vm
+from gurklang.parser import parse
+from gurklang.resolver import detach, parse as resolve_and_parse
+from tests.test_engines import PROGRAMS, outcome
+
+# The names are unique to this file, so other tests can't shadow them
+SHADOWING = [
+    """
+    1 :res-v def
+    { :res-v def } parent-scope :res-set-v jar
+    { { res-v } :get jar
+      get 2 res-set-v get
+    } !
+    """,
+    """
+    :math (+) import
+    { { (res-x res-y) { { res-x res-y + } ! } } case } :add-pair jar
+    3 4 add-pair
+    """,
+]
+
+
+def addresses(instructions, depth=0):
+    for instruction in instructions:
+        if instruction.tag == "call" and instruction.address is not None:
+            yield (depth, instruction.function_name, instruction.address.depth)
+        elif instruction.tag == "put_code":
+            yield from addresses(instruction.instructions, depth + 1)
+
+
+def test_addresses():
+    program = resolve_and_parse("""
+    :math (+) import
+    { :a def { a 1 + } :f def { b } :h def 2 :b def 3 f ! } :g jar
+    """)
+    assert set(addresses(program)) == {(2, "a", 1), (2, "+", 2), (1, "f", 0)}
+
+
+@pytest.mark.parametrize("source", [
+    "{ :name def } :def jar",
+    ":x2 { 1 } swap def",
+    ":repl-utils :all import",
+])
+def test_programs_that_could_redefine_core_words_get_no_addresses(source: str):
+    program = resolve_and_parse(f"{source} 1 :x def x")
+    assert list(addresses(program)) == []
+
+
+@pytest.mark.parametrize("source", PROGRAMS + SHADOWING)
+def test_resolved_programs_equal_parsed_programs(source: str):
+    assert resolve_and_parse(source) == parse(source)
+
+
+@pytest.mark.parametrize("engine", [*vm.ENGINES])
+@pytest.mark.parametrize("source", PROGRAMS + SHADOWING)
+def test_resolved_programs_agree_with_reference(engine: str, source: str):
+    assert outcome(resolve_and_parse(source), engine) == outcome(parse(source), "reference")
+
+
+def test_detach_drops_outer_addresses():
+    [outer] = resolve_and_parse("{ :a def { :b def a b } }")
+    code = outer.instructions[2]
+    assert set(addresses(code.instructions)) == {(0, "a", 1), (0, "b", 0)}
+    assert set(addresses(detach(code.instructions))) == {(0, "b", 0)}
+    assert detach(code.instructions, level=1) is code.instructions
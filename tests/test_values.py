@@ -0,0 +1,30 @@
+import pickle
+from dataclasses import FrozenInstanceError
+
+import pytest
+from gurklang.types import FALSE, TRUE, Atom, Box, Int, Str, Vec
+
+
+def test_small_ints_are_shared():
+    assert Int(7) is Int(7)
+    assert Int(10**6) == Int(10**6)
+
+
+def test_values_are_frozen_and_slotted():
+    for value in (Int(1), Str("x"), Vec((Int(1),)), Box(0)):
+        assert not hasattr(value, "__dict__")
+        with pytest.raises(FrozenInstanceError):
+            value.tag = "nope"  # type: ignore
+        assert pickle.loads(pickle.dumps(value)) == value
+
+
+def test_vec_hash_matches_equality():
+    a = Vec((Int(1), Str("a")))
+    b = Vec((Int(1), Str.interned("a")))
+    assert hash(a) == hash(a) == hash(b) and a == b
+
+
+def test_atoms_are_unique():
+    assert Atom("x") is Atom.make("x") is pickle.loads(pickle.dumps(Atom("x")))
+    assert Atom("x").id != Atom("y").id
+    assert (Atom.bool(True), Atom.bool(False)) == (TRUE, FALSE) == (Atom("true"), Atom("false"))